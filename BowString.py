@@ -13,6 +13,9 @@ import os
 import time
 import subprocess
 import shlex
+import sys
+import threading
+from Queue import Queue
 
 
 class CurrentXYScannerControl:
@@ -60,6 +63,55 @@ class CurrentXYScannerControl:
             return self.getMaxScanRectangle().contains(x, y)
 
 
+class PointStream(object):
+    # Points of the block being executed, taken from the reader thread as
+    # they arrive. Iteration ends with the block, or early if the block is
+    # damaged or the widget closes. Interrupted then holds the item that
+    # stopped it, for the main loop to handle.
+    def __init__(self, Items, NumPoints):
+        self.Items = Items
+        self.NumPoints = NumPoints
+        self.Interrupted = None
+
+    def __len__(self):
+        return self.NumPoints or 0
+
+    def __iter__(self):
+        while True:
+            Item = self.Items.get()
+            if Item[0] == BLOCK_POINT:
+                yield Item[1]
+            elif Item[0] == BLOCK_END:
+                return
+            else:
+                self.Interrupted = Item
+                return
+
+
+def read_instructions(Stream, Parser, Items):
+    # Runs on its own thread and parses the widget output while the main
+    # thread moves the stage. Items is bounded, so the reader stays at most
+    # that many lines ahead.
+    for line in Stream:
+        # Print out all lines to the console
+        print(line) # DEBUG: disable when deploying
+
+        ChannelPort = parse_announcement(line)
+        if ChannelPort is not None:
+            Items.put((STREAM_ANNOUNCEMENT, ChannelPort))
+            continue
+        # Blocks are checked line by line, a damaged one is dropped as soon
+        # as the damage shows up
+        try:
+            Event = Parser.read(line)
+        except ProtocolError as e:
+            Items.put((STREAM_ERROR, e))
+            continue
+        if Event is not None:
+            Items.put(Event)
+    Items.put((STREAM_CLOSED,))
+
+
 def execute_instruction_list(Points,TTLInstance,Mode,
 RecordRealTimeScan,RecordVideo,RecordVideoNthFrame,TargetDir,RootName):
     
@@ -85,8 +137,11 @@ RecordRealTimeScan,RecordVideo,RecordVideoNthFrame,TargetDir,RootName):
     # and move on to next point. At each point also trigger a 
     # TTL pulse. If the point is out of the scan range of the 
     # X-Y-Scanner inform the user and move on to the next point.
+    # Every reached point is reported back to the widget.
     
-    for P in Points:
+    Start = time.time()
+    Channel.send(EVENT_STARTED, len(Points))
+    for idx, P in enumerate(Points):
         if P[4]=='Approached' and not PiezoEngaged:
             print('Approaching...')
             Scanner.approach()
@@ -96,9 +151,20 @@ RecordRealTimeScan,RecordVideo,RecordVideoNthFrame,TargetDir,RootName):
             Scanner.retractPiezo()
             PiezoEngaged = False
         TTLInstance.trigger_pulse()
-        xyScanner.moveToXYPosition(P[0],P[1],P[2])
+        try:
+            xyScanner.moveToXYPosition(P[0],P[1],P[2])
+        except CurrentXYScannerControl.PositionOutOfRangeException as e:
+            print('Point %d: %s' % (idx, e))
+            Channel.send(EVENT_FAILED, idx, e)
+            continue
         if P[3]>0:
             time.sleep(P[3])
+        Channel.send(EVENT_POINT, idx, '%.3f' % (time.time() - Start))
+
+    if Points.Interrupted is not None:
+        # The rest of the program is lost, leave the sample alone
+        print('Program interrupted, retracting...')
+        Scanner.retractPiezo()
     
     # Stop recordings
     if RecordRealTimeScan:
@@ -108,10 +174,12 @@ RecordRealTimeScan,RecordVideo,RecordVideoNthFrame,TargetDir,RootName):
     if RecordVideo:
         Snapshooter.stopImageSequenceSaving()
 
-    print('\nProcess complete. Waiting for new instructions...\n')
+    if Points.Interrupted is None:
+        Channel.send(EVENT_FINISHED, '%.3f' % (time.time() - Start))
+        print('\nProcess complete. Waiting for new instructions...\n')
     
 
-def execute_calibration(Points, TTLInstance, RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TempDir, RootName):
+def execute_calibration(Points, TTLInstance, RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TempDir, RootName, ImageFormat='jpg'):
     # make sure piezo is retracted and get current position
     Scanner.retractPiezo()
     PiezoEngaged = False
@@ -119,6 +187,8 @@ def execute_calibration(Points, TTLInstance, RecordRealTimeScan, RecordVideo, Re
     if not os.path.exists(TempDir):
         os.makedirs(TempDir)
 
+    Start = time.time()
+    Channel.send(EVENT_STARTED, len(Points))
     for idx, P in enumerate(Points):
         if P[4] == 'Approached' and not PiezoEngaged:
             print('Approaching...')
@@ -128,34 +198,27 @@ def execute_calibration(Points, TTLInstance, RecordRealTimeScan, RecordVideo, Re
             print('Retracting...')
             Scanner.retractPiezo()
             PiezoEngaged = False
-        xyScanner.moveToXYPosition(P[0], P[1], P[2])
+        try:
+            xyScanner.moveToXYPosition(P[0], P[1], P[2])
+        except CurrentXYScannerControl.PositionOutOfRangeException as e:
+            print('Calibration point %d: %s' % (idx, e))
+            Channel.send(EVENT_FAILED, idx, e)
+            continue
         if P[3] > 0:
             time.sleep(P[3])
-        # Capture and save image
-        image_filename = os.path.join(TempDir, "calibration_image_" + str(idx) + ".jpg")
+        # Capture and save image, the widget picks it up once it is reported
+        image_filename = os.path.join(TempDir, "calibration_image_" + str(idx) + "." + ImageFormat)
         Snapshooter.saveOpticalSnapshot(image_filename)
+        Channel.send(EVENT_POINT, idx, '%.3f' % (time.time() - Start))
 
+    if Points.Interrupted is not None:
+        print('Calibration interrupted')
+        return
+    Channel.send(EVENT_FINISHED, '%.3f' % (time.time() - Start))
     print('\nCalibration complete. Waiting for new instructions...\n')
 
 
-def parse_and_execute_instructions(InList, TTLInstance, TargetDir, RootName):
-    SplitList = []
-    for S in InList:
-        SplitList.append(S.split(';'))
-    
-    StartStringCounter = 0
-    EndStringCounter = 0
-    for S in SplitList:
-        if S[0] == 'InstructionStart':
-            StartStringCounter += 1
-        elif S[0] == 'InstructionEnd':
-            EndStringCounter += 1
-    if not (StartStringCounter == 1 and EndStringCounter == 1):
-        print('Error: Instructions are faulty!')
-        return
-    SplitList.pop(0)
-    SplitList.pop(-1)
-    ModeSettings = SplitList.pop(0)
+def execute_instructions(ModeSettings, Points, TTLInstance, TargetDir, RootName):
     print(ModeSettings)
     Mode = ModeSettings[0]
     if ModeSettings[1] == 'True':
@@ -164,6 +227,7 @@ def parse_and_execute_instructions(InList, TTLInstance, TargetDir, RootName):
         RecordRealTimeScan = False
     else:
         print('Error: Instructions are faulty!')
+        Channel.send(EVENT_REJECTED, 'Faulty settings')
         return
     if ModeSettings[2] == 'True':
         RecordVideo = True
@@ -171,29 +235,33 @@ def parse_and_execute_instructions(InList, TTLInstance, TargetDir, RootName):
         RecordVideo = False
     else:
         print('Error: Instructions are faulty!')
+        Channel.send(EVENT_REJECTED, 'Faulty settings')
         return
     RecordVideoNthFrame = int(ModeSettings[3])
     TempDir = ModeSettings[4] if Mode == 'Calibration' else None
-
-    Points = []
-    for S in SplitList:
-        P = [float(S[0]), float(S[1]), float(S[2]), float(S[3]), S[4]]
-        Points.append(P)
+    # Older widgets do not send a snapshot format
+    ImageFormat = ModeSettings[5] if Mode == 'Calibration' and len(ModeSettings) > 5 else 'jpg'
 
     if Mode == 'PullAndHold':
         execute_instruction_list(Points, TTLInstance, Mode,
                                  RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TargetDir, RootName)
+    elif Mode == 'PullAndHoldQueue':
+        # Several pull and hold experiments in a row, the widget has already
+        # ordered them and only returns to the start after the last one
+        execute_instruction_list(Points, TTLInstance, Mode,
+                                 RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TargetDir, RootName)
     elif Mode == 'PullAndHoldPositionCheck':
         execute_instruction_list(Points, TTLInstance, Mode,
                                  RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TargetDir, RootName)
     elif Mode == 'Calibration':
         execute_calibration(Points, TTLInstance,
-                            RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TempDir, RootName)
+                            RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TempDir, RootName, ImageFormat)
     elif Mode == 'Scratch Off':
         execute_instruction_list(Points, TTLInstance, Mode,
                                  RecordRealTimeScan, RecordVideo, RecordVideoNthFrame, TargetDir, RootName)
     else:
         print('%s is not an available Bowstring-mode' % Mode)
+        Channel.send(EVENT_REJECTED, '%s is not an available Bowstring-mode' % Mode)
     return
 
 
@@ -206,10 +274,24 @@ def parse_and_execute_instructions(InList, TTLInstance, TargetDir, RootName):
 # DEAR USER: First, set target directory and file name root for the outputs.
 # Then just press 'Run' up above in the Experiment Planner.
 # Make sure to also set the correct path to the compiled BowstringWidget further
-# below!
+# below and to the Bowstring repository, which holds the instruction protocol
+# shared with the widget.
 
 TargetDir = "/home/jpkuser/jpkdata/Jaritz_Simon_AFM/2022_09_23-BowstringStretching/"
 RootName = "Image2Piezo-PrecisionTest"
+BowstringRepository = "./jpkdata/Jaritz_Simon_AFM/BowstringApp/Bowstring"
+
+sys.path.insert(0, BowstringRepository)
+from instruction_protocol import (InstructionParser, ProtocolError, EventSender, parse_announcement,
+                                  BLOCK_SETTINGS, BLOCK_POINT, BLOCK_END,
+                                  EVENT_STARTED, EVENT_POINT, EVENT_FAILED, EVENT_FINISHED, EVENT_REJECTED)
+
+# Items the reader thread passes on besides the parser events
+STREAM_ANNOUNCEMENT = 'announcement'
+STREAM_ERROR = 'error'
+STREAM_CLOSED = 'closed'
+# Parsed lines the reader may be ahead of the stage
+Lookahead = 64
 
 # DEAR USER: If desired, reposition the AFM tip e.g. to the top left (x=-4.9e-5,y=4.9e-5)
 # before starting the experiment# Set the scanner
@@ -254,23 +336,40 @@ cmd = SplitCommand
 
 
 p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1,universal_newlines=True)
-Instructions=['Waiting']
-for line in p.stdout:
-    # Print out all lines to the console
-    print(line) # DEBUG: disable when deploying
-    
-    if line=='InstructionStart\n':
-        Instructions = ['InstructionStart']
-    elif line=='InstructionEnd\n' and Instructions[0]=='InstructionStart':
-        Instructions.append(line[0:-1])
-        BlockNewInstructions = True
-        parse_and_execute_instructions(Instructions,output,TargetDir,RootName)
-        Instructions = ['Waiting']
-    elif Instructions[0]=='Waiting':
-        print('Waiting...')
-        continue
-    else:
-        Instructions.append(line[0:-1])
+# Progress reports back to the widget, it announces the port on startup
+Channel = EventSender()
+
+# The output of the widget is parsed on a second thread. Each point is
+# executed as soon as its line has arrived instead of waiting for the whole
+# program.
+Items = Queue(Lookahead)
+Reader = threading.Thread(target=read_instructions, args=(p.stdout, InstructionParser(), Items))
+Reader.daemon = True
+Reader.start()
+
+Item = None
+while True:
+    if Item is None:
+        Item = Items.get()
+    Next = None
+    if Item[0] == STREAM_CLOSED:
+        break
+    elif Item[0] == STREAM_ANNOUNCEMENT:
+        Channel.connect(Item[1])
+    elif Item[0] == STREAM_ERROR:
+        print('Error: Instructions are faulty! %s' % Item[1])
+        Channel.block = Item[1].block_id
+        Channel.send(EVENT_REJECTED, Item[1])
+    elif Item[0] == BLOCK_SETTINGS:
+        ModeSettings, Channel.block, NumPoints = Item[1:]
+        Points = PointStream(Items, NumPoints)
+        execute_instructions(ModeSettings, Points, output, TargetDir, RootName)
+        # Whatever cut the program short is handled like any other item,
+        # points of a rejected block are skipped below
+        Next = Points.Interrupted
+    Item = Next
+
+Channel.close()
 
 
 print('Program ended successfully')
@@ -10,6 +10,8 @@ import PyQt5.QtGui as PyGui
 import PyQt5.QtWidgets as PyWidgets
 import PyQt5.QtCore as PyCore
 import time
+import atexit
+import itertools
 import tempfile
 import shutil
 import sys
@@ -17,10 +19,19 @@ import traceback
 import logging
 import os
 import numpy as np
-from calibration import load_images, phase_correlation, estimate_transformation, transform_coordinates, preprocess_image
+from calibration import load_images, PhaseCorrelator, PyramidPhaseCorrelator, AdaptiveCalibrationPlanner, correlate_image, correlate_images_parallel, estimate_transformation, transform_coordinates, preprocess_image, DistortionModel, DistortionCorrectedTransform
+from bowstring_geometry import CoordinateTransform, bowstring_geometry, scratch_off_plan, accessible_area, order_experiments, route_length, scratch_off_order
+from calibration_watcher import CalibrationImageWatcher
+from instruction_protocol import iter_block, new_block_id, encode_announcement
+from instruction_writer import InstructionWriter
+from instrument_channel import InstrumentChannel
+from calibration_cache import CalibrationCache, reference_fingerprint, adjusted_shifts
+from image_canvas import ImageCanvas
+from background_tasks import BackgroundTask
+from live_view import LiveView, DirectoryFrameSource, CaptureFrameSource
+from calibration_stack import CalibrationStack, CalibrationStackWriter, stack_path, STACK_EXTENSION
 import cv2
 import matplotlib.pyplot as plt
-import re
 
 # Exception hook
 def handle_exception(exc_type, exc_value, exc_traceback):
@@ -54,6 +65,13 @@ class StreamToLogger:
     def flush(self):
         pass
 
+# Log output shares stdout with the instructions for the instrument. All of
+# it goes through one writer thread, which keeps other output out of a
+# block while the block is sent.
+instruction_writer = InstructionWriter(sys.stdout)
+sys.stdout = instruction_writer
+atexit.register(instruction_writer.close)
+
 # Configure logging
 log_file_path = "application.log"
 logging.basicConfig(level=logging.DEBUG,
@@ -66,91 +84,10 @@ logging.basicConfig(level=logging.DEBUG,
 stderr_logger = logging.getLogger('STDERR')
 sys.stderr = StreamToLogger(stderr_logger, logging.ERROR)
 
-class PaintPixmap(PyGui.QPixmap):
-    def __init__(self, Path):
-        super().__init__(Path)
-
-    def paintEvent(self, PointList, PaintedObject='TestDrawing'):
-        if len(PointList) == 0:
-            return
-
-        Points = []
-        FPoints = []
-        for P in PointList:
-            Points.append(PyCore.QPoint(int(P[0]), int(P[1])))
-            FPoints.append(PyCore.QPointF(int(P[0]), int(P[1])))
-
-        painter = PyGui.QPainter(self)
-
-        if PaintedObject == 'User Points':
-            painter.setPen(PyGui.QPen(PyCore.Qt.red, 3))
-            painter.setRenderHint(PyGui.QPainter.Antialiasing)
-            for p in FPoints:
-                painter.drawPoint(p)
-            painter.end()
-            painter = PyGui.QPainter(self)
-            painter.setPen(PyGui.QPen(PyCore.Qt.red, 3))
-            painter.setRenderHint(PyGui.QPainter.Antialiasing)
-            for p in FPoints:
-                Dist = 6
-                Len = 6
-                DistLen = Dist + Len
-                p11 = PyCore.QPointF(p)
-                p12 = PyCore.QPointF(p)
-                p11.setX(p11.x() - DistLen)
-                p12.setX(p12.x() - Dist)
-                p21 = PyCore.QPointF(p)
-                p22 = PyCore.QPointF(p)
-                p21.setX(p21.x() + DistLen)
-                p22.setX(p22.x() + Dist)
-                p31 = PyCore.QPointF(p)
-                p32 = PyCore.QPointF(p)
-                p31.setY(p31.y() - DistLen)
-                p32.setY(p32.y() - Dist)
-                p41 = PyCore.QPointF(p)
-                p42 = PyCore.QPointF(p)
-                p41.setY(p41.y() + DistLen)
-                p42.setY(p42.y() + Dist)
-                painter.drawLine(p11, p12)
-                painter.drawLine(p21, p22)
-                painter.drawLine(p31, p32)
-                painter.drawLine(p41, p42)
-        elif PaintedObject == 'Accessible Area':
-            # Rectangle = PyCore.QRect(Points[0], Points[1])
-            painter.setPen(PyGui.QPen(PyCore.Qt.cyan, 4))
-            painter.setRenderHint(PyGui.QPainter.Antialiasing)
-            # painter.drawRect(Rectangle)
-            painter.drawLine(FPoints[0], FPoints[1])
-            painter.drawLine(FPoints[1], FPoints[2])
-            painter.drawLine(FPoints[2], FPoints[3])
-            painter.drawLine(FPoints[3], FPoints[0])
-        elif PaintedObject == 'Bowstring Geometry':
-            painter.setPen(PyGui.QPen(PyCore.Qt.green, 2))
-            painter.setRenderHint(PyGui.QPainter.Antialiasing)
-            painter.drawLine(FPoints[0], FPoints[1])
-            painter.drawLine(FPoints[0], FPoints[2])
-            painter.drawLine(FPoints[1], FPoints[2])
-            painter.drawLine(FPoints[3], FPoints[2])
-            painter.setPen(PyGui.QPen(PyCore.Qt.green, 1, PyCore.Qt.DashLine))
-            painter.drawLine(FPoints[4], FPoints[3])
-        elif PaintedObject == 'Scratch-Off Geometry':
-            painter.setPen(PyGui.QPen(PyCore.Qt.darkGreen, 1))
-            painter.setRenderHint(PyGui.QPainter.Antialiasing)
-            
-            # Draw each scratch line between points
-            for i in range(0, int(len(FPoints)/2)):
-                painter.drawLine(FPoints[i], FPoints[i+int(len(FPoints)/2)])
-            
-
-        elif PaintedObject == 'TestDrawing':
-            painter = PyGui.QPainter(self)
-            painter.setPen(PyGui.QPen(PyCore.Qt.black, 30, PyCore.Qt.DashLine))
-            painter.setRenderHint(PyGui.QPainter.Antialiasing)
-            painter.drawEllipse(450, 250, 200, 400)
-
-        painter.end()
-
 class MainWindow(PyWidgets.QMainWindow):
+    # Id of the block and the error, emitted from the writer thread
+    instruction_write_failed = PyCore.pyqtSignal(str, str)
+
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
 
@@ -186,11 +123,11 @@ class MainWindow(PyWidgets.QMainWindow):
         self.ImageFullFile = os.path.abspath(self.ImageFullFile)
         self.ImagePath = os.path.dirname(self.ImageFullFile)
 
-        self.InstructionStartString = 'InstructionStart'
-        self.InstructionEndString = 'InstructionEnd'
 
         self.UpperPiezoRange = 4.999999e-5
         self.LowerPiezoRange = -4.999999e-5
+        # Instruction lines written to stdout at once
+        self.InstructionChunkSize = 256
 
         # General settings
         self.PositioningVelocity = float(1e-5)
@@ -206,14 +143,76 @@ class MainWindow(PyWidgets.QMainWindow):
         self.grid_size = 5
         self.calibration_matrix = None
         self.use_model_based_transformation = True
+        # Cached CoordinateTransform and the inputs it was built from
+        self.CoordTransform = None
+        self.CoordTransformKey = None
+        # Thin-plate-spline correction of the calibrated transformation for
+        # objective distortion, baked into lookup tables
+        self.use_distortion_correction = False
+        self.DistortionModel = None
+        self.DistortionModelKey = None
         self.calibration_phasecorr_shifts = []
-        # Load the initial image as reference
-        self.reference_image = load_images([self.ImageFullFile])[0]
+        self.calibration_workers = os.cpu_count() or 1
+        # Decoding, correlation and other heavy work runs on this pool, the
+        # results come back to the GUI thread as signals
+        self.TaskPool = PyCore.QThreadPool(self)
+        self.TaskPool.setMaxThreadCount(self.calibration_workers)
+        self.BackgroundTasks = []
+        self.calibration_tasks = {}
+        self.calibration_results = {}
+        self.calibration_images_received = False
+        # Results of an aborted round that arrive late are ignored
+        self.calibration_round_id = 0
+        # Coarse-to-fine registration around the expected tip position
+        self.use_pyramid_registration = False
+        # Adaptive grid: stop adding points once the fit is within tolerance [m]
+        self.use_adaptive_calibration = False
+        self.adaptive_tolerance = float(5e-7)
+        self.calibration_planner = None
+        # Seconds without a new snapshot before a running calibration is given up
+        self.calibration_timeout = 60
+        self.calibration_watcher = None
+        # Keep the snapshots of a calibration as one memory-mapped stack file
+        # in the info log folder instead of discarding them
+        self.save_calibration_stack = False
+        self.calibration_stack = None
+        # File format the instrument saves the calibration snapshots in
+        self.calibration_image_format = 'jpg'
+        # Live view of the cantilever. Frames are tracked at reduced
+        # resolution to keep up with the camera frame rate.
+        self.LiveView = None
+        self.LiveSource = None
+        self.LiveViewScale = 0.5
+        self.LiveViewDevice = 0
+        # Return channel from the instrument script. While it reports a
+        # running program no further instructions are sent.
+        self.InstrumentChannel = InstrumentChannel(self)
+        self.RunningProgram = None
+        # Load the initial image as reference. Calibration only needs the
+        # intensities, so it is kept as a single channel image.
+        self.reference_image = load_images([self.ImageFullFile], grayscale=True)[0]
         
         print(self.reference_image.dtype, self.reference_image.shape)
         
+        # Calibrations from earlier sessions with the same optical setup
+        self.calibration_cache = CalibrationCache()
+        self.reference_fingerprint = reference_fingerprint(self.reference_image)
+        
         self.PointCounter = 0
         self.Points = list()
+        self.Geometry = None
+        # Queued fibrils as (anchors in real world, anchors in image) pairs
+        self.FibrilQueue = []
+
+        # Parameter edits and clicks only mark what has to be recomputed, a
+        # single-shot timer then does the work once per burst of edits
+        self.DirtyFlags = set()
+        self.RecomputeDelay = 50
+        self.RecomputeCount = 0
+        self.SkippedRecomputes = 0
+        self.RecomputeTimer = PyCore.QTimer(self)
+        self.RecomputeTimer.setSingleShot(True)
+        self.RecomputeTimer.timeout.connect(self.run_scheduled_recompute)
 
         # Pull and Hold mode
         self.PaHStrainRate = float(2e-6)
@@ -229,8 +228,11 @@ class MainWindow(PyWidgets.QMainWindow):
         self.SONumScratchPoints = 20
         self.SONumRepeats = 1
         self.SOShowScratchLines = True
+        self.SOOptimizeOrder = True
         self.SOFinalStrainPoints = []
         self.SOBufferPoints = []
+        self.SOValidMask = np.zeros(0, dtype=bool)
+        self.SOPlan = None
 
         toolbar = PyWidgets.QToolBar('My main toolbar')
         toolbar.setIconSize(PyCore.QSize(64, 64))
@@ -261,11 +263,9 @@ class MainWindow(PyWidgets.QMainWindow):
         self.ImageDescription = PyWidgets.QLabel(self.ImageDescriptionPrompts[self.PointCounter])
         self.ImageDescription.setFont(PyGui.QFont('Arial', 20))
 
-        self.Pixmap = PaintPixmap(self.ImageFullFile)
-        self.Image = PyWidgets.QLabel()
-        self.Image.setPixmap(self.Pixmap)
-        self.Image.setAlignment(PyCore.Qt.AlignHCenter | PyCore.Qt.AlignTop)
-        self.Image.mousePressEvent = self.getPos
+        self.Canvas = ImageCanvas(self.ImageFullFile)
+        self.Canvas.clicked.connect(self.getPos)
+        self.Canvas.point_moved.connect(self.move_point)
 
         self.TitleFontSize = 16
         self.MaxEditLength = 10
@@ -335,9 +335,46 @@ class MainWindow(PyWidgets.QMainWindow):
         self.HoldingTimeEdit.setValidator(PyGui.QDoubleValidator())
         self.HoldingTimeEdit.textChanged.connect(self.set_holding_time_calibration)
 
+        self.PyramidSwitch = PyWidgets.QCheckBox('Coarse-to-Fine Registration')
+        self.PyramidSwitch.setChecked(self.use_pyramid_registration)
+        self.PyramidSwitch.stateChanged.connect(self.set_pyramid_registration)
+
+        self.AdaptiveSwitch = PyWidgets.QCheckBox('Adaptive Grid')
+        self.AdaptiveSwitch.setChecked(self.use_adaptive_calibration)
+        self.AdaptiveSwitch.stateChanged.connect(self.set_adaptive_calibration)
+
+        AdaptiveToleranceLabel = PyWidgets.QLabel('Adaptive Tolerance [um]:')
+        self.AdaptiveToleranceEdit = PyWidgets.QLineEdit('%.2f' % (self.adaptive_tolerance * 1e6))
+        self.AdaptiveToleranceEdit.setMaxLength(self.MaxEditLength)
+        self.AdaptiveToleranceEdit.setValidator(PyGui.QDoubleValidator())
+        self.AdaptiveToleranceEdit.textChanged.connect(self.set_adaptive_tolerance)
+
         self.CalibrateButton = PyWidgets.QPushButton('Start Calibration')
         self.CalibrateButton.clicked.connect(self.start_calibration)
 
+        self.StackSwitch = PyWidgets.QCheckBox('Save Calibration Stack')
+        self.StackSwitch.setChecked(self.save_calibration_stack)
+        self.StackSwitch.stateChanged.connect(self.set_save_calibration_stack)
+
+        ImageFormatLabel = PyWidgets.QLabel('Snapshot Format:')
+        self.ImageFormatBox = PyWidgets.QComboBox()
+        # Lossless formats avoid JPEG artifacts in the sub-pixel correlation
+        self.ImageFormatBox.addItems(['jpg', 'png', 'tif'])
+        self.ImageFormatBox.setCurrentText(self.calibration_image_format)
+        self.ImageFormatBox.currentTextChanged.connect(self.set_calibration_image_format)
+
+        self.LoadStackButton = PyWidgets.QPushButton('Load Calibration Stack')
+        self.LoadStackButton.clicked.connect(self.load_calibration_stack)
+
+        self.DistortionSwitch = PyWidgets.QCheckBox('Non-Linear Distortion Correction')
+        self.DistortionSwitch.setChecked(self.use_distortion_correction)
+        self.DistortionSwitch.stateChanged.connect(self.set_distortion_correction)
+
+        self.LiveFolderButton = PyWidgets.QPushButton('Live View from Folder')
+        self.LiveFolderButton.clicked.connect(self.toggle_live_view_folder)
+        self.LiveCameraButton = PyWidgets.QPushButton('Live View from Camera')
+        self.LiveCameraButton.clicked.connect(self.toggle_live_view_camera)
+
         # Layout adjustments
         Spacing = 24
         Grid = PyWidgets.QGridLayout()
@@ -345,7 +382,7 @@ class MainWindow(PyWidgets.QMainWindow):
         
         # Add the image description and image
         Grid.addWidget(self.ImageDescription, 0, 0, 1, 4)
-        Grid.addWidget(self.Image, 1, 0, Spacing-1, 4)
+        Grid.addWidget(self.Canvas, 1, 0, Spacing-1, 4)
         
         # General Settings
         Grid.addWidget(Title0, 0, 4, 1, 2)
@@ -375,7 +412,18 @@ class MainWindow(PyWidgets.QMainWindow):
         Grid.addWidget(self.GridSizeEdit, 13, 5)
         Grid.addWidget(HoldingTimeLabel, 14, 4)
         Grid.addWidget(self.HoldingTimeEdit, 14, 5)
-        Grid.addWidget(self.CalibrateButton, 15, 4, 1, 2)
+        Grid.addWidget(self.PyramidSwitch, 15, 4, 1, 2)
+        Grid.addWidget(self.AdaptiveSwitch, 16, 4, 1, 2)
+        Grid.addWidget(AdaptiveToleranceLabel, 17, 4)
+        Grid.addWidget(self.AdaptiveToleranceEdit, 17, 5)
+        Grid.addWidget(self.CalibrateButton, 18, 4, 1, 2)
+        Grid.addWidget(self.StackSwitch, 19, 4, 1, 2)
+        Grid.addWidget(ImageFormatLabel, 20, 4)
+        Grid.addWidget(self.ImageFormatBox, 20, 5)
+        Grid.addWidget(self.LoadStackButton, 21, 4, 1, 2)
+        Grid.addWidget(self.DistortionSwitch, 22, 4, 1, 2)
+        Grid.addWidget(self.LiveFolderButton, 23, 4)
+        Grid.addWidget(self.LiveCameraButton, 23, 5)
 
         # Pull and Hold settings
         Title1 = PyWidgets.QLabel('Pull and Hold')
@@ -424,6 +472,24 @@ class MainWindow(PyWidgets.QMainWindow):
         Grid.addWidget(self.StartPaHPCButton, 5, 6, 1, 2)
         Grid.addWidget(self.StartPaHButton, 6, 6, 1, 2)
         
+        # Fibril queue
+        TitleQueue = PyWidgets.QLabel('Fibril Queue')
+        TitleQueue.setFont(PyGui.QFont('Arial', self.TitleFontSize))
+
+        self.AddToQueueButton = PyWidgets.QPushButton('Add Fibril to Queue')
+        self.AddToQueueButton.clicked.connect(self.add_fibril_to_queue)
+        self.AddToQueueButton.setEnabled(False)
+
+        self.QueueLabel = PyWidgets.QLabel()
+
+        ClearQueueButton = PyWidgets.QPushButton('Clear Queue')
+        ClearQueueButton.clicked.connect(self.clear_fibril_queue)
+
+        self.StartQueueButton = PyWidgets.QPushButton('Start Queued Experiments')
+        self.StartQueueButton.mousePressEvent = self.send_instructions_pull_and_hold_queue
+        self.StartQueueButton.setEnabled(False)
+        self.update_queue_label()
+
         # Scratch Off settings
         Title2 = PyWidgets.QLabel('Scratch Off')
         Title2.setFont(PyGui.QFont('Arial', self.TitleFontSize))
@@ -467,6 +533,10 @@ class MainWindow(PyWidgets.QMainWindow):
         Input17.setChecked(self.SOShowScratchLines)
         Input17.stateChanged.connect(self.set_so_show_scratch_lines)
         
+        SOOrderSwitch = PyWidgets.QCheckBox('Optimize Scratch Order')
+        SOOrderSwitch.setChecked(self.SOOptimizeOrder)
+        SOOrderSwitch.stateChanged.connect(self.set_so_optimize_order)
+
         self.StartSOButton = PyWidgets.QPushButton('Start Scratching Off')
         self.StartSOButton.mousePressEvent = self.send_instructions_scratch_off
         self.StartSOButton.setEnabled(False)
@@ -485,12 +555,41 @@ class MainWindow(PyWidgets.QMainWindow):
         Grid.addWidget(InputText16, 13, 6)
         Grid.addWidget(Input16, 13, 7)
         Grid.addWidget(Input17, 14, 6, 1, 2)
-        Grid.addWidget(self.StartSOButton, 15, 6, 1, 2)
+        Grid.addWidget(SOOrderSwitch, 15, 6, 1, 2)
+        Grid.addWidget(self.StartSOButton, 16, 6, 1, 2)
+
+        Grid.addWidget(TitleQueue, 17, 6, 1, 2)
+        Grid.addWidget(self.AddToQueueButton, 18, 6, 1, 2)
+        Grid.addWidget(self.QueueLabel, 19, 6, 1, 2)
+        Grid.addWidget(ClearQueueButton, 20, 6, 1, 2)
+        Grid.addWidget(self.StartQueueButton, 21, 6, 1, 2)
 
         self.Widget = PyWidgets.QWidget()
         self.Widget.setLayout(Grid)
 
         self.setCentralWidget(self.Widget)
+
+        # Progress of background work, e.g. the correlation of a calibration
+        self.ProgressBar = PyWidgets.QProgressBar()
+        self.ProgressBar.setMaximumWidth(200)
+        self.ProgressBar.hide()
+        self.CancelTaskButton = PyWidgets.QPushButton('Cancel')
+        self.CancelTaskButton.clicked.connect(self.cancel_background_tasks)
+        self.CancelTaskButton.hide()
+        self.statusBar().addPermanentWidget(self.ProgressBar)
+        self.statusBar().addPermanentWidget(self.CancelTaskButton)
+
+        self.InstrumentChannel.program_started.connect(self.on_program_started)
+        self.InstrumentChannel.point_done.connect(self.on_program_point_done)
+        self.InstrumentChannel.point_failed.connect(self.on_program_point_failed)
+        self.InstrumentChannel.program_finished.connect(self.on_program_finished)
+        self.InstrumentChannel.program_rejected.connect(self.on_program_rejected)
+        self.InstrumentChannel.disconnected.connect(self.on_instrument_disconnected)
+        self.instruction_write_failed.connect(self.on_instruction_write_failed)
+        ChannelPort = self.InstrumentChannel.listen()
+        if ChannelPort is not None:
+            # Older instrument scripts ignore the announcement
+            sys.stdout.write(encode_announcement(ChannelPort) + '\n')
         
         # Screen Size Calculation
         screen = PyWidgets.QDesktopWidget().screenGeometry()
@@ -507,6 +606,10 @@ class MainWindow(PyWidgets.QMainWindow):
         self.setWindowTitle('Bowstring')
         # self.setGeometry(200, 200, 300, 600)
         self.show()
+        self.Canvas.fit_if_larger()
+        
+        # Offer a stored calibration once the window is up
+        PyCore.QTimer.singleShot(0, self.offer_cached_calibration)
         
     def choose_log_path(self):
         # Open a dialog to select the folder for saving log files
@@ -516,7 +619,132 @@ class MainWindow(PyWidgets.QMainWindow):
             self.log_path_label.setText(f"Current path: {self.info_log_path}")
 
 
+    def run_in_background(self, function, *args, on_result=None, on_error=None, on_progress=None, pass_task=False,
+                          **kwargs):
+        # Callbacks are connected before the task starts, so no signal can
+        # be missed
+        task = BackgroundTask(function, *args, pass_task=pass_task, **kwargs)
+        if on_result is not None:
+            task.signals.result.connect(on_result)
+        if on_progress is not None:
+            task.signals.progress.connect(on_progress)
+        task.signals.error.connect(self.on_background_task_error if on_error is None else on_error)
+        task.signals.finished.connect(lambda: self.on_background_task_finished(task))
+        self.BackgroundTasks.append(task)
+        self.CancelTaskButton.show()
+        self.TaskPool.start(task)
+        return task
+
+    def on_background_task_finished(self, task):
+        if task in self.BackgroundTasks:
+            self.BackgroundTasks.remove(task)
+        self.hide_progress_when_idle()
+
+    def hide_progress_when_idle(self):
+        # A running calibration also waits for snapshots between its tasks
+        if not self.BackgroundTasks and self.calibration_watcher is None and self.RunningProgram is None:
+            self.ProgressBar.hide()
+            self.CancelTaskButton.hide()
+
+    def on_background_task_error(self, message):
+        self.statusBar().showMessage("Background computation failed, see the log for details")
+
+    def show_progress(self, done, total):
+        self.ProgressBar.setMaximum(total)
+        self.ProgressBar.setValue(done)
+        self.ProgressBar.show()
+        self.CancelTaskButton.show()
+
+    def cancel_tasks(self, tasks):
+        for task in tasks:
+            task.cancel()
+            # Tasks still waiting in the queue never start and never finish
+            if self.TaskPool.tryTake(task):
+                self.on_background_task_finished(task)
+
+    def cancel_background_tasks(self):
+        if self.calibration_watcher is not None:
+            self.abort_calibration()
+        self.cancel_tasks(list(self.BackgroundTasks))
+        self.statusBar().showMessage("Cancelled")
+
+    def toggle_live_view_folder(self):
+        if self.LiveView is not None:
+            self.stop_live_view()
+            return
+        folder = PyWidgets.QFileDialog.getExistingDirectory(self, "Select Snapshot Folder",
+                                                            os.path.dirname(self.ImageFullFile))
+        if not folder:
+            return
+        self.start_live_view(lambda live_view: DirectoryFrameSource(folder, live_view, parent=self))
+
+    def toggle_live_view_camera(self):
+        if self.LiveView is not None:
+            self.stop_live_view()
+            return
+        self.start_live_view(lambda live_view: CaptureFrameSource(self.LiveViewDevice, live_view))
+
+    def start_live_view(self, create_source):
+        # Frames are registered against the launch snapshot first, so the
+        # tracked tip starts where it has been clicked
+        height, width = self.reference_image.shape[:2]
+        tip = self.Points[2] if len(self.Points) == 3 else (width / 2, height / 2)
+        self.LiveView = LiveView(self.reference_image, tip, scale=self.LiveViewScale, parent=self)
+        self.LiveView.tip_tracked.connect(self.on_tip_tracked)
+        self.LiveView.failed.connect(self.on_live_view_failed)
+        self.LiveSource = create_source(self.LiveView)
+        try:
+            self.LiveSource.start()
+        except OSError as e:
+            logging.error(f"Could not start live view: {e}")
+            self.on_live_view_failed(str(e))
+            return
+        self.LiveFolderButton.setText('Stop Live View')
+        self.LiveCameraButton.setText('Stop Live View')
+        self.statusBar().showMessage("Live view running, waiting for frames")
+
+    def stop_live_view(self):
+        if self.LiveView is None:
+            return
+        self.LiveSource.stop()
+        live_view = self.LiveView
+        if live_view.stop():
+            live_view.deleteLater()
+        else:
+            # A frame is still being processed, the view stays alive with
+            # the window so it can't signal into a deleted object
+            live_view.tip_tracked.disconnect()
+            live_view.failed.disconnect()
+            logging.error("Live view worker did not stop in time")
+        logging.info(f"Live view stopped, {live_view.buffer.count} frames, {live_view.dropped} dropped, "
+                     f"max latency {live_view.max_latency * 1e3:.0f} ms")
+        if live_view.unreadable or live_view.tracking_errors:
+            logging.error(f"Live view: {live_view.unreadable} frames could not be read, "
+                          f"{live_view.tracking_errors} could not be tracked (last error: {live_view.last_error})")
+        self.LiveView = None
+        self.LiveSource = None
+        self.Canvas.clear_layer('Tracked Tip')
+        self.LiveFolderButton.setText('Live View from Folder')
+        self.LiveCameraButton.setText('Live View from Camera')
+
+    def on_tip_tracked(self, x, y, latency):
+        if self.LiveView is None or self.sender() is not self.LiveView:
+            return
+        self.Canvas.set_layer('Tracked Tip', [[x, y]])
+        message = f"Tracked tip at ({x:.1f}, {y:.1f}) px"
+        if len(self.Points) == 3:
+            message += f", drift {x - self.Points[2][0]:+.1f}, {y - self.Points[2][1]:+.1f} px"
+        self.statusBar().showMessage(message + f", latency {latency * 1e3:.0f} ms")
+
+    def on_live_view_failed(self, reason):
+        self.stop_live_view()
+        self.statusBar().showMessage(f"Live view stopped: {reason}")
+
     def start_calibration(self):
+        if self.calibration_watcher is not None:
+            self.abort_calibration()
+            return
+        self.flush_recompute()
         if self.DebugMode:
             self.start_calibration_debug()
         else:
@@ -722,11 +950,12 @@ class MainWindow(PyWidgets.QMainWindow):
         self.images = images
     
         # Perform phase correlation and visualize results
+        correlator = PhaseCorrelator(self.reference_image)
         shifts = []
         transshifts = []
         for i in range(len(images)):
             self.visualize_images(self.reference_image, images[i])
-            shift = phase_correlation(self.reference_image, images[i])
+            shift = correlator.correlate(images[i])
             shifts.append(shift)
             transshifts.append((shift[0] + self.Points[2][0] , shift[1] + self.Points[2][1]))
             print(f"Shift for image {i}: {shift}")
@@ -762,8 +991,6 @@ class MainWindow(PyWidgets.QMainWindow):
     def start_calibration_standard(self):
         # Retrieve input values
         grid_size = self.grid_size
-        holding_time = self.holding_time_calibration
-        positioning_velocity = self.PositioningVelocity
     
         # Define movement boundaries
         lower_bound = self.LowerPiezoRange
@@ -773,82 +1000,336 @@ class MainWindow(PyWidgets.QMainWindow):
         x_positions = np.linspace(lower_bound, upper_bound, grid_size)
         y_positions = np.linspace(lower_bound, upper_bound, grid_size)
     
+        # One correlator for the whole run, also across adaptive rounds
+        self.calibration_correlator = self.create_calibration_correlator()
+        grid_positions = [(x, y) for x in x_positions for y in y_positions]
+        self.calibration_grid_indices = {p: idx for idx, p in enumerate(grid_positions)}
+        if self.save_calibration_stack:
+            self.create_calibration_stack(grid_positions)
+    
+        if self.use_adaptive_calibration:
+            # Start with a few well spread points and add more only while
+            # the fit has not converged
+            self.calibration_planner = AdaptiveCalibrationPlanner(x_positions, y_positions, self.adaptive_tolerance)
+            afm_positions = self.calibration_planner.initial_points()
+        else:
+            self.calibration_planner = None
+            afm_positions = [[x, y] for x in x_positions for y in y_positions]
+            # Store afm_positions for later use
+            self.afm_positions = afm_positions
+    
+        self.send_calibration_round(afm_positions)
+    
+    def send_calibration_round(self, afm_positions):
         temp_dir = tempfile.mkdtemp()
         self.calibration_temp_dir = temp_dir
     
         # Compile instruction list
-        instruction_list = [['Calibration', str(False), str(False), str(self.RecordVideoNthFrame), temp_dir]]
-        afm_positions = []
-        for x in x_positions:
-            for y in y_positions:
-                afm_positions.append([x, y])
-                instruction_list.append([
-                    str(x), str(y), str(positioning_velocity), str(holding_time), 'Retracted'
-                ])
+        settings = ['Calibration', str(False), str(False), str(self.RecordVideoNthFrame), temp_dir,
+                    self.calibration_image_format]
+        points = [[x, y, self.PositioningVelocity, self.holding_time_calibration, 'Retracted']
+                  for x, y in afm_positions]
     
-        # Store afm_positions for later use
-        self.afm_positions = afm_positions
+        # Watch for the snapshots before sending, so no image can be missed
+        self.watch_calibration_images(temp_dir, afm_positions)
     
         # Send instruction list to the second script
-        self.construct_and_send_instructions(instruction_list)
+        if self.construct_and_send_instructions(settings, points) is None:
+            self.on_calibration_failed('instrument busy')
     
-        # Wait for the required number of images
-        required_images = grid_size * grid_size
-        self.wait_for_images(temp_dir, required_images)
+    def create_calibration_correlator(self, reference_image=None, anchor=None):
+        # anchor is the tip in reference_image. For the current reference it
+        # is the clicked tip if it has been set, without one the pyramid
+        # correlator falls back to the full frame.
+        if reference_image is None:
+            reference_image = self.reference_image
+            if len(self.Points) == 3:
+                anchor = self.Points[2]
+        if self.use_pyramid_registration:
+            return PyramidPhaseCorrelator(reference_image, anchor=anchor)
+        return PhaseCorrelator(reference_image)
     
-    def wait_for_images(self, folder, num_images):
-        print(folder)
-        while True:
-            files = os.listdir(folder)
-            if len(files) >= num_images:
-                break
-            time.sleep(1)  # Check every second
+    def create_calibration_stack(self, grid_positions):
+        DT = time.strftime('%Y-%m-%dT%H-%M-%S')
+        path = stack_path(self.info_log_path, f"calibration_{DT}")
+        metadata = {
+            'magnification': self.Magnification,
+            'pixel_size': self.PixelSize,
+            'starting_tip_position': [float(v) for v in self.StartingTipPosition],
+            'grid_size': self.grid_size,
+            'reference_image': self.ImageFullFile,
+            # Tip in the reference frame, the windows of the pyramid
+            # correlator are placed around it when the stack is reloaded
+            'tip_position': [float(v) for v in self.Points[2]] if len(self.Points) == 3 else None,
+        }
+        try:
+            self.calibration_stack = CalibrationStackWriter(path, self.reference_image, grid_positions, metadata=metadata)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not create calibration stack {path}: {e}")
+            self.calibration_stack = None
+    
+    def stack_and_correlate_image(self, stack, grid_idx, path, expected_shift):
+        # Runs on the task pool. The decoded snapshot goes into the
+        # stack and is correlated from there, the file itself is not needed
+        # anymore.
+        image = load_images([path], grayscale=True)[0]
+        if image is None:
+            logging.error(f"Failed to load image: {path}")
+            return None
+        stack.write(grid_idx, image)
+        return correlate_image(self.calibration_correlator, stack.frame(grid_idx),
+                               expected_shift=expected_shift)
+    
+    def close_calibration_stack(self):
+        if self.calibration_stack is None:
+            return
+        self.calibration_stack.close()
+        logging.info(f"Calibration stack saved to {self.calibration_stack.path}")
+        self.calibration_stack = None
     
-        # Proceed with the next steps after all images are present
-        self.process_calibration_images(folder)
+    def load_calibration_stack(self):
+        path, _ = PyWidgets.QFileDialog.getOpenFileName(self, "Load Calibration Stack", self.info_log_path,
+                                                        f"Calibration Stacks (*{STACK_EXTENSION})")
+        if not path:
+            return
+        try:
+            stack = CalibrationStack(path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read calibration stack {path}: {e}")
+            self.statusBar().showMessage("Could not read calibration stack")
+            return
+    
+        # Only the recorded frames are read from the mapping
+        written = [idx for idx, done in enumerate(stack.header['written']) if done]
+        if len(written) < 3:
+            logging.error(f"Calibration stack {path} holds only {len(written)} frames")
+            self.statusBar().showMessage("Calibration stack is incomplete")
+            return
+        afm_positions = [stack.afm_positions[idx] for idx in written]
+    
+        # The shifts are relative to the reference of that session, so
+        # correlate against it, around the tip of that session, and translate
+        # them to the current starting position afterwards
+        correlator = self.create_calibration_correlator(np.asarray(stack.reference), stack.metadata.get('tip_position'))
+        expected_shifts = [self.expected_calibration_shift(p, stack.metadata) for p in afm_positions]
+        entry = {
+            'afm_positions': afm_positions,
+            'starting_tip_position': stack.metadata.get('starting_tip_position', self.StartingTipPosition),
+        }
+
+        def correlate_stack(task):
+            return correlate_images_parallel(correlator, [stack[idx] for idx in written], self.calibration_workers,
+                                             expected_shifts=expected_shifts, progress=task.report_progress,
+                                             cancelled=lambda: task.cancelled)
+
+        def on_result(shifts):
+            if any(shift is None for shift in shifts):
+                logging.error("One or more frames of the calibration stack could not be processed.")
+                self.statusBar().showMessage("Calibration stack could not be processed")
+                return
+            self.afm_positions = afm_positions
+            self.finish_calibration(adjusted_shifts(dict(entry, shifts=shifts), self.StartingTipPosition), store=False)
+            self.statusBar().showMessage(f"Using calibration stack {os.path.basename(path)} ({len(written)} frames)")
+
+        self.statusBar().showMessage(f"Correlating calibration stack {os.path.basename(path)}")
+        self.run_in_background(correlate_stack, on_result=on_result, on_progress=self.show_progress, pass_task=True)
+    
+    def expected_calibration_shift(self, afm_position, stack_metadata=None):
+        # Cantilever shift between the reference snapshot and the snapshot at
+        # afm_position, as predicted by the current transformation. The
+        # current transformation belongs to the current reference, for a
+        # stored stack the optics and starting position saved with it are used.
+        if stack_metadata is None and len(self.Points) == 3:
+            return tuple(self.transform_coordinates_rl2image(afm_position) - np.array(self.Points[2]))
+        metadata = {} if stack_metadata is None else stack_metadata
+        scaling = np.array([1, -1]) * metadata.get('magnification', self.Magnification) / metadata.get('pixel_size', self.PixelSize)
+        starting_tip_position = metadata.get('starting_tip_position', self.StartingTipPosition)
+        return tuple((np.array(afm_position) - np.array(starting_tip_position)) * scaling)
+    
+    def watch_calibration_images(self, folder, afm_positions):
+        # Correlate every snapshot as soon as it is written instead of waiting
+        # for the whole grid. The GUI stays responsive while the stage moves.
+        self.calibration_round_positions = afm_positions
+        self.calibration_expected_shifts = [self.expected_calibration_shift(p) for p in afm_positions]
+        self.calibration_tasks = {}
+        self.calibration_results = {}
+        self.calibration_images_received = False
+        self.calibration_round_id += 1
+        self.show_progress(0, len(afm_positions))
+    
+        # Allow for the longest possible stage move plus the holding time
+        max_travel_time = np.hypot(self.UpperPiezoRange - self.LowerPiezoRange,
+                                   self.UpperPiezoRange - self.LowerPiezoRange) / self.PositioningVelocity
+        timeout = self.calibration_timeout + self.holding_time_calibration + max_travel_time
+    
+        self.calibration_watcher = CalibrationImageWatcher(folder, len(afm_positions), timeout=timeout, parent=self)
+        self.calibration_watcher.image_ready.connect(self.on_calibration_image_ready)
+        self.calibration_watcher.finished.connect(self.on_calibration_images_complete)
+        self.calibration_watcher.failed.connect(self.on_calibration_failed)
+        self.CalibrateButton.setText('Abort Calibration')
+        self.calibration_watcher.start()
+    
+    def on_calibration_image_ready(self, idx, path):
+        logging.debug(f"Calibration image {idx} ready: {path}")
+        expected_shift = self.calibration_expected_shifts[idx] if idx < len(self.calibration_expected_shifts) else None
+        round_id = self.calibration_round_id
+        on_result = lambda shift: self.on_calibration_image_correlated(round_id, idx, shift)
+        # A failed correlation counts as an unreadable image
+        on_error = lambda message: self.on_calibration_image_correlated(round_id, idx, None)
+        if self.calibration_stack is not None and idx < len(self.calibration_round_positions):
+            grid_idx = self.calibration_grid_indices[tuple(self.calibration_round_positions[idx])]
+            self.calibration_tasks[idx] = self.run_in_background(
+                self.stack_and_correlate_image, self.calibration_stack, grid_idx, path, expected_shift,
+                on_result=on_result, on_error=on_error)
+        else:
+            self.calibration_tasks[idx] = self.run_in_background(
+                correlate_image, self.calibration_correlator, path, expected_shift=expected_shift,
+                on_result=on_result, on_error=on_error)
+        self.statusBar().showMessage(f"Calibration image {len(self.calibration_tasks)}/{self.calibration_watcher.num_images} received")
 
+    def on_calibration_image_correlated(self, round_id, idx, shift):
+        if round_id != self.calibration_round_id:
+            return
+        self.calibration_results[idx] = shift
+        self.show_progress(len(self.calibration_results), self.calibration_watcher.num_images)
+        self.complete_calibration_round()
+
+    def on_calibration_images_complete(self):
+        # All snapshots are there, only the correlations of the last few
+        # images can still be running
+        self.calibration_images_received = True
+        self.complete_calibration_round()
+
+    def complete_calibration_round(self):
+        num_images = self.calibration_watcher.num_images
+        if not self.calibration_images_received or len(self.calibration_results) < num_images:
+            return
+        folder = self.calibration_watcher.folder
+        shifts = [self.calibration_results.get(i) for i in range(num_images)]
+        self.stop_calibration_watcher()
+        # Every snapshot of the round is in, so the instrument is done with
+        # it even if its last events haven't arrived yet. The next adaptive
+        # round must not be refused as busy.
+        if self.RunningProgram is not None and self.RunningProgram['mode'] == 'Calibration':
+            self.end_running_program()
     
-    def process_calibration_images(self, folder):
-        # Load images and associate them with AFM positions
-        image_paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.startswith("calibration_image_")]
-        
-        logging.debug(f"Expected number of images: {self.grid_size**2}")
-        logging.debug(f"Found {len(image_paths)} images in the folder.")
-        
-        # Sort image paths numerically
-        image_paths = sorted(image_paths, key=self.numerical_sort)
-        
-        images = load_images(image_paths)
-        
-        print(image_paths)
-        
-        if len(images) != self.grid_size**2:
-            logging.error(f"Number of images loaded ({len(images)}) does not match the expected number ({self.grid_size**2}).")
+        if any(shift is None for shift in shifts):
+            logging.error("One or more calibration images could not be processed. Aborting calibration.")
+            self.statusBar().showMessage("Calibration failed: missing or unreadable images")
+            self.close_calibration_stack()
             return
-        
-        if not images:
-            logging.error("No images were loaded successfully. Aborting calibration.")
+    
+        # Clean up temporary folder
+        shutil.rmtree(folder, ignore_errors=True)
+    
+        self.on_calibration_round_complete(self.calibration_round_positions, shifts)
+    
+    def on_calibration_round_complete(self, afm_positions, shifts):
+        planner = self.calibration_planner
+        if planner is None:
+            self.close_calibration_stack()
+            self.finish_calibration(shifts)
+            self.statusBar().showMessage("Calibration complete")
             return
-        
-        # Perform phase correlation
-        shifts = []
-        for i in range(len(images)):
-            shift = phase_correlation(self.reference_image, images[i])
-            shifts.append(shift)
-        
+    
+        planner.add_results(afm_positions, shifts)
+        if planner.converged or planner.exhausted:
+            self.close_calibration_stack()
+            self.afm_positions = list(planner.positions)
+            self.finish_calibration(list(planner.shifts))
+            self.statusBar().showMessage(f"Adaptive calibration finished after {len(planner.positions)} of "
+                                         f"{len(planner.candidates)} grid points ({planner.rounds} rounds)")
+            return
+    
+        if planner.residuals is not None:
+            logging.info(f"Adaptive calibration round {planner.rounds}: {len(planner.positions)} points, "
+                         f"max residual {np.max(planner.residuals) * 1e6:.3f} um, "
+                         f"fit change {planner.fit_change * 1e6:.3f} um")
+        self.send_calibration_round(planner.next_points())
+    
+    def on_calibration_failed(self, reason):
+        folder = self.calibration_watcher.folder
+        self.stop_calibration_watcher()
+        logging.error(f"Calibration stopped: {reason}")
+        self.statusBar().showMessage(f"Calibration stopped: {reason}")
+        shutil.rmtree(folder, ignore_errors=True)
+        # Whatever has been recorded so far is kept, the header marks the
+        # missing frames
+        self.close_calibration_stack()
+    
+    def abort_calibration(self):
+        # The instrument keeps taking the remaining snapshots, they are ignored
+        if self.calibration_images_received:
+            # Only correlations are left, the watcher has stopped already
+            self.on_calibration_failed('aborted')
+        else:
+            self.calibration_watcher.abort()
+    
+    def stop_calibration_watcher(self):
+        self.calibration_watcher.stop()
+        self.calibration_watcher.deleteLater()
+        self.calibration_watcher = None
+        self.cancel_tasks(self.calibration_tasks.values())
+        self.calibration_tasks = {}
+        self.calibration_results = {}
+        self.calibration_images_received = False
+        self.calibration_round_id += 1
+        self.hide_progress_when_idle()
+        self.CalibrateButton.setText('Start Calibration')
+    
+    def finish_calibration(self, shifts, store=True):
         self.calibration_phasecorr_shifts = shifts
         self.use_model_based_transformation = False
         
-        # Estimate transformation matrix
+        # Estimate transformation matrix. A calibration applied before the
+        # tip has been clicked, e.g. a stored one at startup, stays pending
+        # until the tip is known, the matrix is fitted then.
         self.recalculate_transformation_matrix()
+        self.TransformSwitch.blockSignals(True)
         self.TransformSwitch.setChecked(False)
+        self.TransformSwitch.blockSignals(False)
         self.TransformSwitch.setEnabled(True)
         
+        if store:
+            self.store_calibration()
+        
         self.draw_geometry()
         self.initialize_scratch_off_points()
+    
+    def calibration_image_size(self):
+        height, width = self.reference_image.shape[:2]
+        return (width, height)
+    
+    def store_calibration(self):
+        self.calibration_cache.store(
+            self.Magnification, self.PixelSize, self.calibration_image_size(), self.reference_fingerprint,
+            self.calibration_phasecorr_shifts, self.afm_positions, self.StartingTipPosition,
+            tip_position=self.Points[2] if len(self.Points) == 3 else None,
+            calibration_matrix=self.calibration_matrix, grid_size=self.grid_size)
+        logging.info(f"Calibration stored in {self.calibration_cache.path}")
+    
+    def offer_cached_calibration(self):
+        entry = self.calibration_cache.lookup(self.Magnification, self.PixelSize,
+                                              self.calibration_image_size(), self.reference_fingerprint)
+        if entry is None:
+            return
         
-        # Clean up temporary folder
-        shutil.rmtree(folder)
+        created = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))
+        text = f"A calibration from {created} ({entry['grid_size']}x{entry['grid_size']} grid) matches the current setup."
+        if entry['rms_residual'] is not None:
+            text += f"\nRMS residual: {entry['rms_residual'] * 1e6:.3f} um"
+        reply = PyWidgets.QMessageBox.question(self, 'Stored Calibration', text + "\n\nUse it instead of recalibrating?",
+                                               PyWidgets.QMessageBox.Yes | PyWidgets.QMessageBox.No)
+        if reply == PyWidgets.QMessageBox.Yes:
+            self.apply_cached_calibration(entry)
+    
+    def apply_cached_calibration(self, entry):
+        self.afm_positions = [tuple(p) for p in entry['afm_positions']]
+        if entry['grid_size']:
+            self.grid_size = entry['grid_size']
+            self.GridSizeEdit.setText(str(self.grid_size))
+        self.finish_calibration(adjusted_shifts(entry, self.StartingTipPosition), store=False)
+        self.statusBar().showMessage("Using stored calibration")
 
 
 
@@ -860,70 +1341,44 @@ class MainWindow(PyWidgets.QMainWindow):
         if not Bool:
             return
         
-        # Calculate anchor points and scale based on pixel size and magnification
-        anchor1 = np.array(self.transform_coordinates_image2rl(self.Points[0]))
-        anchor2 = np.array(self.transform_coordinates_image2rl(self.Points[1]))
-    
-        # Compute the total distance between the anchors
-        total_anchor_distance = np.linalg.norm(anchor2 - anchor1)
-    
-        # Compute the effective length of scratch-off points, subtracting the safety distances from both sides
-        effective_length = total_anchor_distance - 2 * self.SODistToAnchors
-    
-        # Calculate the position of each scratch point along the base line
-        self.SOBufferPoints = []
-        self.SOFinalStrainPoints = []
-        if self.SONumScratchPoints >= 1:
-            for i in range(self.SONumScratchPoints):
-                # Position of each point along the line, normalized to effective length
-                t = (i + 1) / (self.SONumScratchPoints + 1)
-                scratch_point = anchor1 + (anchor2 - anchor1) * ((self.SODistToAnchors / total_anchor_distance) + t * (effective_length / total_anchor_distance))  # linear interpolation
-                
-                mid_point = anchor1 + (anchor2 - anchor1) / 2
-                
-                # Calculate orthogonal direction from scratch point
-                orthogonal_direction = np.array([-(anchor2[1] - anchor1[1]), anchor2[0] - anchor1[0]])
-                orthogonal_direction = orthogonal_direction / np.linalg.norm(orthogonal_direction)  # normalize
-    
-                # Calculate half point (offset by half buffer)
-                buffer_point = scratch_point + self.SOTip2HalfPointBuffer * orthogonal_direction
-                self.SOBufferPoints.append(buffer_point)
-    
-                # Calculate final strain point based on a percentage of the base line length
-                final_strain_height = self.SOFinalStrain * total_anchor_distance
-                final_strain_height = (1 - np.linalg.norm(mid_point - scratch_point)*2/total_anchor_distance) * total_anchor_distance / 2 * np.sqrt((1 + self.SOFinalStrain) ** 2 - 1)
-                final_strain_point = scratch_point - final_strain_height * orthogonal_direction
-                self.SOFinalStrainPoints.append(final_strain_point)
-        else:
+        if self.SONumScratchPoints < 1:
             print("Error: Number of scratch points must be greater than zero")
-    
-    
-        LogList = []
-        for i in range(len(self.SOFinalStrainPoints)):
-            LogList.append(all([abs(self.SOBufferPoints[i][0]) < 5e-5, 
-                        abs(self.SOBufferPoints[i][1]) < 5e-5, 
-                        abs(self.SOFinalStrainPoints[i][0]) < 5e-5, 
-                        abs(self.SOFinalStrainPoints[i][1]) < 5e-5]))
-        
-        if all(LogList):
-            self.StartSOButton.setEnabled(True)
-        else:
-            self.StartSOButton.setEnabled(False)    
+
+        self.SOPlan = scratch_off_plan(*self.transform_coordinates_image2rl(self.Points[0:2]),
+                                       self.SONumScratchPoints, self.SODistToAnchors,
+                                       self.SOTip2HalfPointBuffer, self.SOFinalStrain)
+        self.SOBufferPoints = self.SOPlan.buffer_points
+        self.SOFinalStrainPoints = self.SOPlan.final_strain_points
+        self.SOValidMask = self.SOPlan.valid_mask
+        self.report_scratch_off_range()
     
         self.update_scratch_off_visualization()
 
-
+    def report_scratch_off_range(self):
+        invalid = np.flatnonzero(~self.SOValidMask)
+        self.StartSOButton.setEnabled(len(self.SOValidMask) > 0 and len(invalid) == 0)
+        if len(invalid) == 0:
+            return
+        # Consecutive indices are reported as ranges, e.g. 1-4, 9 (1-based)
+        groups = np.split(invalid + 1, np.flatnonzero(np.diff(invalid) > 1) + 1)
+        ranges = ', '.join(f"{g[0]}-{g[-1]}" if len(g) > 1 else f"{g[0]}" for g in groups)
+        message = f"Scratch points out of piezo range: {ranges} ({len(invalid)} of {len(self.SOValidMask)})"
+        logging.debug(message)
+        self.statusBar().showMessage(message)
 
     def update_scratch_off_visualization(self):
         if self.SOShowScratchLines == False:
+            self.Canvas.clear_layer('Scratch-Off Geometry')
             return
         elif self.SOShowScratchLines == True:
-            # Visualize the scratch-off setup points
-            points = [self.transform_coordinates_rl2image(point) for point in self.SOFinalStrainPoints]
-            BuffPoints = [self.transform_coordinates_rl2image(point) for point in self.SOBufferPoints]
-            points = points + BuffPoints
-            self.Pixmap.paintEvent(points, 'Scratch-Off Geometry')  # This assumes your paintEvent can handle this new type
-            self.Image.setPixmap(self.Pixmap)
+            if len(self.SOFinalStrainPoints) == 0:
+                self.Canvas.clear_layer('Scratch-Off Geometry')
+                return
+            # Visualize the scratch-off setup points, final strain points
+            # first and buffer points second, mapped in a single call
+            points = self.transform_coordinates_rl2image(
+                np.concatenate([self.SOFinalStrainPoints, self.SOBufferPoints]))
+            self.Canvas.set_layer('Scratch-Off Geometry', points, Highlight=~self.SOValidMask)
 
     def recalculate_transformation_matrix(self):
         if len(self.Points) < 3 or self.use_model_based_transformation:
@@ -934,18 +1389,48 @@ class MainWindow(PyWidgets.QMainWindow):
         self.calibration_matrix = estimate_transformation(transshifts, self.afm_positions)
         # print("Recalculated transformation matrix:", self.calibration_matrix)
 
-    def getPos(self, event):
-        x = event.pos().x()
-        y = event.pos().y()
+    def schedule_recompute(self, *Flags):
+        # Edits arriving within RecomputeDelay ms are coalesced into a single
+        # recompute and repaint on the event loop. Requests for work that is
+        # already pending are counted as skipped.
+        Pending = set(Flags) & self.DirtyFlags
+        if Pending:
+            self.SkippedRecomputes += 1
+        self.DirtyFlags.update(Flags)
+        self.RecomputeTimer.start(self.RecomputeDelay)
+
+    def run_scheduled_recompute(self):
+        Flags = self.DirtyFlags
+        self.DirtyFlags = set()
+        if 'transformation' in Flags:
+            self.recalculate_transformation_matrix()
+        if 'geometry' in Flags:
+            self.draw_geometry()
+        if 'scratch_off' in Flags:
+            self.initialize_scratch_off_points()
+        self.RecomputeCount += 1
+
+    def flush_recompute(self):
+        # Apply pending edits right away, e.g. before instructions are sent
+        if self.DirtyFlags:
+            self.RecomputeTimer.stop()
+            self.run_scheduled_recompute()
+
+    def getPos(self, x, y):
         self.Points.append([x, y])
         if self.PointCounter == 3:
             self.PointCounter = -1
             self.Points = list()
         self.PointCounter += 1
         self.ImageDescription.setText(self.ImageDescriptionPrompts[self.PointCounter])
-        self.recalculate_transformation_matrix()  # Recalculate transformation matrix
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('transformation', 'geometry', 'scratch_off')
+
+    def move_point(self, idx, x, y):
+        # A user point has been dragged to a new position
+        if idx >= len(self.Points):
+            return
+        self.Points[idx] = [x, y]
+        self.schedule_recompute('transformation', 'geometry', 'scratch_off')
 
     def onLithModeButtonClick(self, s):
         if not s:
@@ -966,76 +1451,83 @@ class MainWindow(PyWidgets.QMainWindow):
             return
         s = s.replace(',', '.')
         self.PaHStrainRate = float(s) * 1e-6
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('geometry', 'scratch_off')
 
     def set_pixel_size(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.PixelSize = float(s) * 1e-6
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('geometry', 'scratch_off')
 
     def set_magnification(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.Magnification = float(s)
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
-        
+        self.schedule_recompute('geometry', 'scratch_off')
+
     def set_grid_size(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.grid_size = int(s)  # Store the grid size
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+
+    def set_pyramid_registration(self, s):
+        self.use_pyramid_registration = bool(s)
+
+    def set_adaptive_calibration(self, s):
+        self.use_adaptive_calibration = bool(s)
+
+    def set_distortion_correction(self, s):
+        self.use_distortion_correction = bool(s)
+        if not self.use_model_based_transformation:
+            self.schedule_recompute('geometry', 'scratch_off')
+
+    def set_save_calibration_stack(self, s):
+        self.save_calibration_stack = bool(s)
+
+    def set_calibration_image_format(self, s):
+        self.calibration_image_format = s
+
+    def set_adaptive_tolerance(self, s):
+        if not s:
+            return
+        s = s.replace(',', '.')
+        self.adaptive_tolerance = float(s) * 1e-6
 
     def set_holding_time_calibration(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.holding_time_calibration = float(s)  # Store the holding time for calibration
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
-
 
     def set_final_strain(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.PaHFinalStrain = float(s) / 100
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('geometry', 'scratch_off')
 
     def set_tip_to_halfpoint_buffer(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.PaHTip2HalfPointBuffer = float(s) * 1e-6
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('geometry', 'scratch_off')
 
     def set_holding_time(self, s):
         if not s or s == '':
             self.set_holding_time('0')
             return
-        self.shifts = []  # Initialize shifts property
-        self.reference_image = None  # Initialize reference image property
         s = s.replace(',', '.')
         self.PaHHoldingTime = float(s)
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
 
     def set_positioning_velocity(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.PositioningVelocity = float(s) * 1e-6
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
 
     def set_record_video_nth_frame(self, s):
         if not s:
@@ -1053,61 +1545,54 @@ class MainWindow(PyWidgets.QMainWindow):
             return
         s = s.replace(',', '.')
         self.SOStrainRate = float(s) * 1e-6
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
 
     def set_so_final_strain(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.SOFinalStrain = float(s) / 100
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('scratch_off')
 
     def set_so_tip_to_string_buffer(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.SOTip2HalfPointBuffer = float(s) * 1e-6
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('scratch_off')
 
     def set_so_safety_distance_to_anchors(self, s):
         if not s:
             return
         
         # Calculate anchor points and scale based on pixel size and magnification
-        anchor1 = np.array(self.transform_coordinates_image2rl(self.Points[0]))
-        anchor2 = np.array(self.transform_coordinates_image2rl(self.Points[1]))
+        anchor1, anchor2 = self.transform_coordinates_image2rl(self.Points[0:2])
     
         # Compute the total distance between the anchors
         total_anchor_distance = np.linalg.norm(anchor2 - anchor1)
         
         s = s.replace(',', '.')
         self.SODistToAnchors = min(float(s) * 1e-6,total_anchor_distance/3);
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('scratch_off')
 
     def set_so_number_of_scratch_points(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.SONumScratchPoints = int(s)
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('scratch_off')
 
     def set_so_number_of_repeats(self, s):
         if not s:
             return
         s = s.replace(',', '.')
         self.SONumRepeats = int(s)
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+
+    def set_so_optimize_order(self, s):
+        self.SOOptimizeOrder = bool(s)
 
     def set_so_show_scratch_lines(self, s):
         self.SOShowScratchLines = bool(s)
-        self.draw_geometry()
-        self.initialize_scratch_off_points()
+        self.schedule_recompute('scratch_off')
 
     
     def switch_transformation(self, state):
@@ -1115,9 +1600,11 @@ class MainWindow(PyWidgets.QMainWindow):
             # Use model-based transformation
             self.use_model_based_transformation = True
         else:
-            # Use calibrated transformation if available
-            if self.calibration_matrix is not None:
+            # Use calibrated transformation if available, it is fitted once
+            # the tip has been clicked
+            if self.calibration_phasecorr_shifts:
                 self.use_model_based_transformation = False
+                self.recalculate_transformation_matrix()
             else:
                 PyWidgets.QMessageBox.warning(self, 'Error', 'Calibration data not available. Reverting to model-based transformation.')
                 self.TransformSwitch.setChecked(True)
@@ -1126,40 +1613,59 @@ class MainWindow(PyWidgets.QMainWindow):
         self.initialize_scratch_off_points()        
         
 
-    def transform_coordinates_image2rl(self, InPoint):
-        InPoint = np.array(InPoint)
+    def coordinate_transform(self):
+        # Rebuild the transform only if one of its inputs has changed
         if self.use_model_based_transformation:
-            self.calculate_transformation_constants()
-            if InPoint.size == 1:
-                OutPoint = InPoint * self.Im2RlScalingVector[0]
-                return OutPoint
-    
-            InPoint = InPoint - self.RlOriginInImage
-            OutPoint = InPoint * self.Im2RlScalingVector
+            Key = (True, self.PixelSize, self.Magnification, tuple(self.Points[2]), tuple(self.StartingTipPosition))
+        elif self.use_distortion_correction and self.distortion_model() is not None:
+            Key = (False, self.DistortionModelKey, tuple(self.Points[2]))
         else:
-            # Use calibrated transformation
-            OutPoint = transform_coordinates(InPoint, self.calibration_matrix)
-
-        return OutPoint[0:2]
+            Key = (False, np.asarray(self.calibration_matrix).tobytes())
+        if Key != self.CoordTransformKey:
+            if self.use_model_based_transformation:
+                self.calculate_transformation_constants()
+                self.CoordTransform = CoordinateTransform.model_based(
+                    self.PixelSize, self.Magnification, self.Points[2], self.StartingTipPosition)
+            elif len(Key) == 3:
+                self.CoordTransform = DistortionCorrectedTransform(self.DistortionModel, self.Points[2])
+            else:
+                self.CoordTransform = CoordinateTransform(self.calibration_matrix)
+            self.CoordTransformKey = Key
+        return self.CoordTransform
+
+    def distortion_model(self):
+        # The model only depends on the calibration itself, not on the tip
+        # position, so it is fitted once per calibration
+        Key = (np.asarray(self.calibration_phasecorr_shifts).tobytes(), np.asarray(self.afm_positions).tobytes())
+        if Key != self.DistortionModelKey:
+            self.DistortionModelKey = Key
+            try:
+                self.DistortionModel = DistortionModel(self.calibration_phasecorr_shifts, self.afm_positions)
+                if self.DistortionModel.kind == 'affine':
+                    Message = "Distortion correction: affine fit kept, a spline does not predict left out points better"
+                else:
+                    Message = (f"Distortion correction: {self.DistortionModel.kind}, max residual "
+                               f"{np.max(self.DistortionModel.residuals) * 1e6:.3f} um")
+                logging.info(Message)
+                self.statusBar().showMessage(Message)
+            except ValueError as e:
+                logging.error(f"No distortion correction, using the affine calibration: {e}")
+                self.DistortionModel = None
+        return self.DistortionModel
+
+    # Both transformations take a single point (2,) or an (N, 2) array
+    def transform_coordinates_image2rl(self, InPoint):
+        InPoint = np.asarray(InPoint, dtype=float)
+        if self.use_model_based_transformation and InPoint.size == 1:
+            # Scalar lengths are only scaled
+            return InPoint * self.PixelSize / self.Magnification
+        return self.coordinate_transform().image2rl(InPoint)
 
     def transform_coordinates_rl2image(self, InPoint):
-        InPoint = np.array(InPoint)
-        if self.use_model_based_transformation:
-            self.calculate_transformation_constants()
-            if InPoint.size == 1:
-                OutPoint = InPoint * self.Rl2ImScalingVector[0]
-                return OutPoint
-    
-            InPoint = InPoint - self.ImageOriginInRl
-            OutPoint = InPoint * self.Rl2ImScalingVector
-        else:
-            # Use calibrated transformation
-            # Apply inverse of calibration matrix for reverse transformation
-            InvMat = np.linalg.inv(np.array([self.calibration_matrix[0],
-                                             self.calibration_matrix[1],[0, 0, 1]]))
-            # print(InvMat)
-            OutPoint = transform_coordinates(InPoint, InvMat)
-        return OutPoint
+        InPoint = np.asarray(InPoint, dtype=float)
+        if self.use_model_based_transformation and InPoint.size == 1:
+            return InPoint * self.Magnification / self.PixelSize
+        return self.coordinate_transform().rl2image(InPoint)
 
 
     def calculate_transformation_constants(self):
@@ -1171,37 +1677,27 @@ class MainWindow(PyWidgets.QMainWindow):
     def draw_geometry(self):
         Bool = self.check_sufficient_information()
 
-        self.Pixmap = PaintPixmap(self.ImageFullFile)
-        self.Image.setPixmap(self.Pixmap)
-        self.Pixmap.paintEvent(self.Points, 'User Points')
-        self.Image.setPixmap(self.Pixmap)
+        self.Canvas.set_layer('User Points', self.Points)
 
         if not Bool:
+            # Nothing but the points can be drawn without all three of them
+            for PaintedObject in ['Accessible Area', 'Bowstring Geometry', 'Scratch-Off Geometry']:
+                self.Canvas.clear_layer(PaintedObject)
             return
 
         self.calculate_geometry()
         self.paint_experiment()
 
     def calculate_geometry(self):
-        self.Anchor1 = self.transform_coordinates_image2rl(np.array(self.Points[0]))
-        self.Anchor2 = self.transform_coordinates_image2rl(np.array(self.Points[1]))
-
-        self.PaHSegmentLength = np.linalg.norm(self.Anchor1 - self.Anchor2)
-        self.HalfPoint = (self.Anchor1 + self.Anchor2) / 2
-        self.SegmentDirection = (self.Anchor1 - self.Anchor2) / self.PaHSegmentLength
-        self.PerpendicularDirection = np.array([-self.SegmentDirection[1], self.SegmentDirection[0]])
-        self.PaHBufferPoint = self.HalfPoint - self.PerpendicularDirection * self.PaHTip2HalfPointBuffer
-        self.PaHBowDrawingDistance = self.PaHSegmentLength / 2 * np.sqrt((1 + self.PaHFinalStrain) ** 2 - 1)
-        self.PaHFinalStrainPoint = self.HalfPoint + self.PerpendicularDirection * self.PaHBowDrawingDistance
-        self.PaHTotalMovementTime = (self.PaHBowDrawingDistance + self.PaHTip2HalfPointBuffer) / self.PaHStrainRate
-
-        if all([abs(self.PaHBufferPoint[0]) < 5e-5, abs(self.PaHBufferPoint[1]) < 5e-5,
-                abs(self.PaHFinalStrainPoint[0]) < 5e-5, abs(self.PaHFinalStrainPoint[1]) < 5e-5]):
-            self.StartPaHButton.setEnabled(True)
-            self.StartPaHPCButton.setEnabled(True)
-        else:
-            self.StartPaHButton.setEnabled(False)
-            self.StartPaHPCButton.setEnabled(False)
+        self.Geometry = bowstring_geometry(*self.transform_coordinates_image2rl(self.Points[0:2]),
+                                           self.PaHStrainRate, self.PaHFinalStrain, self.PaHTip2HalfPointBuffer)
+        self.Anchor1, self.Anchor2 = self.Geometry.anchor1, self.Geometry.anchor2
+        self.HalfPoint = self.Geometry.half_point
+        self.PaHBufferPoint = self.Geometry.buffer_point
+        self.PaHFinalStrainPoint = self.Geometry.final_strain_point
+        self.PaHTotalMovementTime = self.Geometry.total_movement_time
+
+        self.enable_instruction_send_buttons(self.Geometry.in_range)
 
     def check_sufficient_information(self):
         valid_bow = len(self.Points) == 3 and all(
@@ -1211,116 +1707,278 @@ class MainWindow(PyWidgets.QMainWindow):
         return valid_bow and valid_scratch
 
     def paint_experiment(self):
-        self.Pixmap = PaintPixmap(self.ImageFullFile)
-        self.Image.setPixmap(self.Pixmap)
-
-        TopLeft = self.transform_coordinates_rl2image([self.LowerPiezoRange, self.UpperPiezoRange])
-        TopRight = self.transform_coordinates_rl2image([self.UpperPiezoRange, self.UpperPiezoRange])
-        BottomRight = self.transform_coordinates_rl2image([self.UpperPiezoRange, self.LowerPiezoRange])
-        BottomLeft = self.transform_coordinates_rl2image([self.LowerPiezoRange, self.LowerPiezoRange])
-        InPoints1 = [TopLeft, TopRight,  BottomRight, BottomLeft]
+        # TopLeft, TopRight, BottomRight, BottomLeft
+        InPoints1 = self.transform_coordinates_rl2image(accessible_area(self.LowerPiezoRange, self.UpperPiezoRange))
         # print(InPoints1)
-        # print(f"Window size: {np.linalg.norm(TopLeft - BottomLeft)}")
-        self.Pixmap.paintEvent(InPoints1, 'Accessible Area')
-        InPoints2 = [
-            self.transform_coordinates_rl2image(self.Anchor1),
-            self.transform_coordinates_rl2image(self.Anchor2),
-            self.transform_coordinates_rl2image(self.rl2im_im2rl(self.PaHFinalStrainPoint)),
-            self.transform_coordinates_rl2image(self.HalfPoint),
-            self.transform_coordinates_rl2image(self.PaHBufferPoint)
-        ]
-        self.Pixmap.paintEvent(InPoints2, 'Bowstring Geometry')
-        self.Pixmap.paintEvent(self.Points, 'User Points')
-        self.Image.setPixmap(self.Pixmap)
+        self.Canvas.set_layer('Accessible Area', InPoints1)
+        InPoints2 = self.transform_coordinates_rl2image([
+            self.Anchor1,
+            self.Anchor2,
+            self.rl2im_im2rl(self.PaHFinalStrainPoint),
+            self.HalfPoint,
+            self.PaHBufferPoint
+        ])
+        self.Canvas.set_layer('Bowstring Geometry', InPoints2)
+        self.Canvas.set_layer('User Points', self.Points)
 
     def enable_instruction_send_buttons(self, Bool):
         self.StartPaHButton.setEnabled(Bool)
         self.StartPaHPCButton.setEnabled(Bool)
+        self.AddToQueueButton.setEnabled(Bool)
+
+    def add_fibril_to_queue(self):
+        self.flush_recompute()
+        if self.Geometry is None or not self.Geometry.in_range:
+            return
+        self.FibrilQueue.append((np.array([self.Geometry.anchor1, self.Geometry.anchor2]),
+                                 np.array(self.Points[0:2], dtype=float)))
+        # Start over with the next fibril
+        self.PointCounter = 0
+        self.Points = list()
+        self.Geometry = None
+        self.ImageDescription.setText(self.ImageDescriptionPrompts[self.PointCounter])
+        self.enable_instruction_send_buttons(False)
+        for PaintedObject in ['User Points', 'Bowstring Geometry', 'Scratch-Off Geometry']:
+            self.Canvas.clear_layer(PaintedObject)
+        self.update_queue_label()
+
+    def clear_fibril_queue(self):
+        self.FibrilQueue = []
+        self.update_queue_label()
+
+    def update_queue_label(self):
+        self.QueueLabel.setText(f"{len(self.FibrilQueue)} fibrils queued")
+        self.StartQueueButton.setEnabled(len(self.FibrilQueue) > 0)
+        if self.FibrilQueue:
+            self.Canvas.set_layer('Fibril Queue', np.concatenate([ImageAnchors for _, ImageAnchors in self.FibrilQueue]))
+        else:
+            self.Canvas.clear_layer('Fibril Queue')
+
+    def send_instructions_pull_and_hold_queue(self, event):
+        self.flush_recompute()
+        if not self.FibrilQueue:
+            return
+        # All queued fibrils use the current pull and hold settings
+        Geometries = [bowstring_geometry(*Anchors, self.PaHStrainRate, self.PaHFinalStrain, self.PaHTip2HalfPointBuffer)
+                      for Anchors, _ in self.FibrilQueue]
+        OutOfRange = [str(idx + 1) for idx, G in enumerate(Geometries) if not G.in_range]
+        if OutOfRange:
+            self.statusBar().showMessage(f"Queued fibrils out of piezo range: {', '.join(OutOfRange)}")
+            return
+
+        # Each experiment is entered at its buffer point and left at its final
+        # strain point, the tip only returns to the start after the last one
+        Entries = [G.buffer_point for G in Geometries]
+        Exits = [G.final_strain_point for G in Geometries]
+        Order = order_experiments(self.StartingTipPosition, Entries, Exits)
+        Travel = route_length(self.StartingTipPosition, Entries, Exits, Order)
+        Separate = sum(route_length(self.StartingTipPosition, [Entry], [Exit]) for Entry, Exit in zip(Entries, Exits))
+        message = (f"Running {len(Geometries)} fibrils in the order {', '.join(str(idx + 1) for idx in Order)}, "
+                   f"{(Separate - Travel) / self.PositioningVelocity:.1f} s of travel saved")
+        logging.info(message)
+        self.statusBar().showMessage(message)
+
+        Settings = ['PullAndHoldQueue', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)]
+        # The points are generated while they are sent, so everything they
+        # use is copied now
+        Velocity, StrainRate, HoldingTime = self.PositioningVelocity, self.PaHStrainRate, self.PaHHoldingTime
+        Start = tuple(self.StartingTipPosition)
+
+        def queue_points():
+            for idx in Order:
+                G = Geometries[idx]
+                yield [G.buffer_point[0], G.buffer_point[1], Velocity, 0, 'Retracted']
+                yield [G.half_point[0], G.half_point[1], StrainRate, 0, 'Approached']
+                yield [G.final_strain_point[0], G.final_strain_point[1], StrainRate, HoldingTime, 'Approached']
+            yield [Start[0], Start[1], Velocity, 0, 'Retracted']
+
+        self.construct_and_send_instructions(Settings, queue_points(), 3 * len(Order) + 1)
 
     def send_instructions_pull_and_hold(self, event):
+        self.flush_recompute()
         self.log_pull_and_hold_info()
         
-        InList = [['PullAndHold', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)],
-                  [str(self.PaHBufferPoint[0]), str(self.PaHBufferPoint[1]), str(self.PositioningVelocity), '0', 'Retracted'],
-                  [str(self.HalfPoint[0]), str(self.HalfPoint[1]), str(self.PaHStrainRate), '0', 'Approached'],
-                  [str(self.PaHFinalStrainPoint[0]), str(self.PaHFinalStrainPoint[1]), str(self.PaHStrainRate),
-                   str(self.PaHHoldingTime), 'Approached'],
-                  [str(self.StartingTipPosition[0]), str(self.StartingTipPosition[1]), str(self.PositioningVelocity), '0',
+        Settings = ['PullAndHold', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)]
+        Points = [[self.PaHBufferPoint[0], self.PaHBufferPoint[1], self.PositioningVelocity, 0, 'Retracted'],
+                  [self.HalfPoint[0], self.HalfPoint[1], self.PaHStrainRate, 0, 'Approached'],
+                  [self.PaHFinalStrainPoint[0], self.PaHFinalStrainPoint[1], self.PaHStrainRate,
+                   self.PaHHoldingTime, 'Approached'],
+                  [self.StartingTipPosition[0], self.StartingTipPosition[1], self.PositioningVelocity, 0,
                    'Retracted'],
                   ]
 
-        Instructions = self.construct_and_send_instructions(InList)
+        self.construct_and_send_instructions(Settings, Points)
 
     def send_instructions_pull_and_hold_position_check(self, event):
-        PositionCheckHoldingTime = '1'
+        self.flush_recompute()
+        PositionCheckHoldingTime = 1
 
-        InList = [['PullAndHoldPositionCheck', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)],
-                  [str(self.Anchor1[0]), str(self.Anchor1[1]), str(self.PositioningVelocity), PositionCheckHoldingTime, 'Retracted'],
-                  [str(self.Anchor2[0]), str(self.Anchor2[1]), str(self.PositioningVelocity), PositionCheckHoldingTime, 'Retracted'],
-                  [str(self.PaHBufferPoint[0]), str(self.PaHBufferPoint[1]), str(self.PositioningVelocity),
+        Settings = ['PullAndHoldPositionCheck', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)]
+        Points = [[self.Anchor1[0], self.Anchor1[1], self.PositioningVelocity, PositionCheckHoldingTime, 'Retracted'],
+                  [self.Anchor2[0], self.Anchor2[1], self.PositioningVelocity, PositionCheckHoldingTime, 'Retracted'],
+                  [self.PaHBufferPoint[0], self.PaHBufferPoint[1], self.PositioningVelocity,
                    PositionCheckHoldingTime, 'Retracted'],
-                  [str(self.HalfPoint[0]), str(self.HalfPoint[1]), str(self.PositioningVelocity), PositionCheckHoldingTime,
+                  [self.HalfPoint[0], self.HalfPoint[1], self.PositioningVelocity, PositionCheckHoldingTime,
                    'Retracted'],
-                  [str(self.PaHFinalStrainPoint[0]), str(self.PaHFinalStrainPoint[1]), str(self.PositioningVelocity),
+                  [self.PaHFinalStrainPoint[0], self.PaHFinalStrainPoint[1], self.PositioningVelocity,
                    PositionCheckHoldingTime, 'Retracted'],
-                  [str(self.StartingTipPosition[0]), str(self.StartingTipPosition[1]), str(self.PositioningVelocity),
+                  [self.StartingTipPosition[0], self.StartingTipPosition[1], self.PositioningVelocity,
                    PositionCheckHoldingTime, 'Retracted'],
                   ]
 
-        Instructions = self.construct_and_send_instructions(InList)
+        self.construct_and_send_instructions(Settings, Points)
 
     def send_instructions_scratch_off(self, event):
-        SOHoldingTime = '0'
-    
-        InList = [['Scratch Off', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)]]
-    
-        for i in range(len(self.SOFinalStrainPoints)):
-            InList.append(
-                [str(self.SOBufferPoints[i][0]), str(self.SOBufferPoints[i][1]), str(self.PositioningVelocity), SOHoldingTime,
-                 'Retracted'])
-            InList.append(
-                [str(self.SOFinalStrainPoints[i][0]), str(self.SOFinalStrainPoints[i][1]), str(self.SOStrainRate), SOHoldingTime,
-                 'Approached'])
+        self.flush_recompute()
+        SOHoldingTime = 0
     
-        InList.append([str(self.StartingTipPosition[0]), str(self.StartingTipPosition[1]), str(self.PositioningVelocity), SOHoldingTime,
-                       'Retracted'])
-    
-        Instructions = self.construct_and_send_instructions(InList)
-
-
-    def construct_and_send_instructions(self, InList):
-        Instructions = [self.InstructionStartString]
-
-        # Clip all numbers outside of piezorange
-        First = InList.pop(0)
-        for S in InList:
-            S[0] = str(np.clip(float(S[0]), self.LowerPiezoRange, self.UpperPiezoRange))
-            S[1] = str(np.clip(float(S[1]), self.LowerPiezoRange, self.UpperPiezoRange))
-
-        InList.insert(0, First)
-
-        # Join them together
-        for S in InList:
-            InstructionLine = ';'.join(S)
-            Instructions.append(InstructionLine)
-
-        Instructions.append(self.InstructionEndString)
-
-        sys.stdout.flush()
-        for S in Instructions:
-            sys.stdout.write(S + '\n')
+        # Naive order: every pass along the fibril in index order
+        NaiveOrder = np.tile(np.arange(len(self.SOFinalStrainPoints)), max(self.SONumRepeats, 0))
+        if self.SOOptimizeOrder:
+            Order = scratch_off_order(self.SOBufferPoints, self.SOFinalStrainPoints, self.StartingTipPosition,
+                                      self.SONumRepeats)
+            self.report_scratch_off_order(Order, NaiveOrder)
+        else:
+            Order = NaiveOrder
+
+        Settings = ['Scratch Off', str(self.RecordRealTimeScan), str(self.RecordVideo), str(self.RecordVideoNthFrame)]
+        # The points are generated while they are sent, so everything they
+        # use is copied now
+        BufferPoints = np.array(self.SOBufferPoints, dtype=float)
+        FinalStrainPoints = np.array(self.SOFinalStrainPoints, dtype=float)
+        Velocity, StrainRate = self.PositioningVelocity, self.SOStrainRate
+        Start = tuple(self.StartingTipPosition)
+
+        def scratch_off_points():
+            for i in Order:
+                yield [BufferPoints[i][0], BufferPoints[i][1], Velocity, SOHoldingTime, 'Retracted']
+                yield [FinalStrainPoints[i][0], FinalStrainPoints[i][1], StrainRate, SOHoldingTime, 'Approached']
+            yield [Start[0], Start[1], Velocity, SOHoldingTime, 'Retracted']
+
+        self.construct_and_send_instructions(Settings, scratch_off_points(), 2 * len(Order) + 1)
+
+
+    def report_scratch_off_order(self, Order, NaiveOrder):
+        # Retracted travel between the scratch lines and back to the start,
+        # the scratching itself takes the same time in any order
+        Travel = route_length(self.StartingTipPosition, self.SOBufferPoints, self.SOFinalStrainPoints, Order)
+        NaiveTravel = route_length(self.StartingTipPosition, self.SOBufferPoints, self.SOFinalStrainPoints, NaiveOrder)
+        # Every line needs its own approach, only lines of zero length are
+        # skipped
+        Skipped = len(NaiveOrder) - len(Order)
+        message = (f"Scratch order: {len(Order)} approaches, no transitions can be merged"
+                   + (f" ({Skipped} lines of zero length skipped)" if Skipped else "")
+                   + f", {(NaiveTravel - Travel) / self.PositioningVelocity:.1f} s of retracted travel saved")
+        logging.info(message)
+        self.statusBar().showMessage(message)
+
+    def construct_and_send_instructions(self, Settings, Points, NumPoints=None):
+        # Settings holds the mode and its options, every point x, y,
+        # velocity, holding time and the tip state. With NumPoints given,
+        # Points may be a generator, it is only read while the block is
+        # written. Returns the id of the block, None if the instrument is
+        # still busy with the previous program.
+        if self.RunningProgram is not None:
+            self.statusBar().showMessage("The instrument is still executing the previous program")
+            return None
+        if NumPoints is None:
+            Points = list(Points)
+            NumPoints = len(Points)
+
+        # Clip all positions outside of piezorange
+        Lower, Upper = self.LowerPiezoRange, self.UpperPiezoRange
+        Points = ([min(max(float(P[0]), Lower), Upper), min(max(float(P[1]), Lower), Upper)] + list(P[2:])
+                  for P in Points)
+
+        # The points are encoded and written on the writer thread while the
+        # instrument already executes the first ones. The settings are
+        # checked with the header, so faulty settings still raise here.
+        Block = new_block_id()
+        Lines = iter_block(Settings, Points, num_points=NumPoints, block=Block)
+        Header = next(Lines)
+
+        # Without a return channel there is no way to tell when the
+        # instrument is done, so nothing is blocked
+        if self.InstrumentChannel.connected:
+            self.RunningProgram = {'block': Block, 'mode': Settings[0], 'points': NumPoints}
+        instruction_writer.write_block(itertools.chain([Header], Lines), self.InstructionChunkSize,
+                                       lambda message: self.instruction_write_failed.emit(Block, message))
+        return Block
+
+    def on_instruction_write_failed(self, block, message):
+        logging.error(f"Instructions could not be sent completely: {message}")
+        self.statusBar().showMessage(f"Instructions could not be sent: {message}")
+        if not self.is_running_program(block):
+            return
+        mode = self.RunningProgram['mode']
+        self.end_running_program()
+        if mode == 'Calibration' and self.calibration_watcher is not None:
+            self.on_calibration_failed('instructions could not be sent')
 
-        # freeze the main window so no new instructions can be sent
-        # ModalDlg = QDialog(self)
-        # ModalDlg.setWindowTitle('Executing instructions...')
-        # ModalDlg.setModal(True)
-        # ModalDlg.show()
+    def is_running_program(self, block):
+        return self.RunningProgram is not None and self.RunningProgram['block'] == block
 
-        sys.stdout.flush()
+    def end_running_program(self):
+        self.RunningProgram = None
+        self.hide_progress_when_idle()
 
-        # ModalDlg.reject()
+    def on_program_started(self, block, num_points):
+        if not self.is_running_program(block):
+            return
+        self.statusBar().showMessage(f"{self.RunningProgram['mode']}: executing {num_points} points")
 
-        return Instructions
+    def on_program_point_done(self, block, idx, elapsed):
+        if not self.is_running_program(block):
+            return
+        if self.RunningProgram['mode'] == 'Calibration':
+            # The snapshot of this point has been saved. Nothing but the
+            # snapshots is left to wait for, so the next round of an adaptive
+            # calibration may be sent as soon as the last one is in.
+            if idx + 1 >= self.RunningProgram['points']:
+                self.end_running_program()
+            if self.calibration_watcher is not None:
+                self.calibration_watcher.image_written(idx)
+            return
+        # The calibration shows its own progress, the instrument can't be
+        # cancelled from here
+        self.ProgressBar.setMaximum(self.RunningProgram['points'])
+        self.ProgressBar.setValue(idx + 1)
+        self.ProgressBar.show()
+        self.statusBar().showMessage(f"{self.RunningProgram['mode']}: point {idx + 1}/{self.RunningProgram['points']} "
+                                     f"reached after {elapsed:.1f} s")
+
+    def on_program_point_failed(self, block, idx, message):
+        if not self.is_running_program(block):
+            return
+        logging.error(f"{self.RunningProgram['mode']}: point {idx + 1} failed on the instrument: {message}")
+        self.statusBar().showMessage(f"Point {idx + 1} failed: {message}")
+        if self.RunningProgram['mode'] == 'Calibration' and self.calibration_watcher is not None:
+            # The snapshot of this point is missing, the round can't complete
+            self.on_calibration_failed(f"point {idx + 1} failed on the instrument")
+
+    def on_program_finished(self, block, elapsed):
+        if not self.is_running_program(block):
+            return
+        mode = self.RunningProgram['mode']
+        self.end_running_program()
+        logging.info(f"{mode} finished after {elapsed:.1f} s")
+        self.statusBar().showMessage(f"{mode} finished after {elapsed:.1f} s")
+
+    def on_program_rejected(self, block, message):
+        # Blocks damaged before their header was read have no id
+        if self.RunningProgram is None or (block and not self.is_running_program(block)):
+            return
+        mode = self.RunningProgram['mode']
+        self.end_running_program()
+        logging.error(f"The instrument rejected the {mode} instructions: {message}")
+        self.statusBar().showMessage(f"{mode} instructions rejected: {message}")
+        if mode == 'Calibration' and self.calibration_watcher is not None:
+            self.on_calibration_failed('instructions rejected')
+
+    def on_instrument_disconnected(self):
+        if self.RunningProgram is not None:
+            self.statusBar().showMessage("Lost the connection to the instrument script")
+            self.end_running_program()
     
     def im2rl_rl2im(self,InPoint):
         OutPoint = self.transform_coordinates_image2rl(InPoint)
@@ -1361,8 +2019,8 @@ class MainWindow(PyWidgets.QMainWindow):
         log_content.append("\nDistances (pixel world):")
         anchor1_pixel = np.array(self.Points[0])
         anchor2_pixel = np.array(self.Points[1])
-        final_strain_pixel = np.array(self.transform_coordinates_rl2image(self.PaHFinalStrainPoint))
-        mid_point_pixel = np.array(self.transform_coordinates_rl2image(self.HalfPoint))
+        mid_point_pixel, buffer_pixel, final_strain_pixel = self.transform_coordinates_rl2image(
+            [self.HalfPoint, self.PaHBufferPoint, self.PaHFinalStrainPoint])
     
         log_content.append(f"Anchor 1 to Anchor 2: {np.linalg.norm(anchor1_pixel - anchor2_pixel)}")
         log_content.append(f"Anchor to Final Strain Point: {np.linalg.norm(anchor1_pixel - final_strain_pixel)}")
@@ -1378,9 +2036,9 @@ class MainWindow(PyWidgets.QMainWindow):
         log_content.append("\nAbsolute positions (pixel world):")
         log_content.append(f"Anchor 1: {self.Points[0]}")
         log_content.append(f"Anchor 2: {self.Points[1]}")
-        log_content.append(f"Half Point: {self.transform_coordinates_rl2image(self.HalfPoint)}")
-        log_content.append(f"Buffer Point: {self.transform_coordinates_rl2image(self.PaHBufferPoint)}")
-        log_content.append(f"Final Strain Point: {self.transform_coordinates_rl2image(self.PaHFinalStrainPoint)}")
+        log_content.append(f"Half Point: {mid_point_pixel}")
+        log_content.append(f"Buffer Point: {buffer_pixel}")
+        log_content.append(f"Final Strain Point: {final_strain_pixel}")
 
     
         # Write log to file
@@ -1390,13 +2048,6 @@ class MainWindow(PyWidgets.QMainWindow):
         
         logging.info(f"Pull and Hold experiment info logged to {log_file_name}")
 
-    
-    def numerical_sort(self,value):
-        numbers = re.findall(r'\d+', value)
-        if numbers:
-            return int(numbers[-1])
-        return 0
-
 def main():
     app = PyWidgets.QApplication(sys.argv)
     ex = MainWindow()
@@ -10,29 +10,9 @@ import sys
 import time
 import subprocess
 import shlex
+from instruction_protocol import InstructionParser, ProtocolError
 
-def parse_and_execute_instructions(InList):
-    
-    SplitList = []
-    for S in InList:
-        SplitList.append(S.split(';'))
-    
-    print(InList)
-    print(SplitList)
-    
-    StartStringCounter = 0
-    EndStringCounter = 0
-    for S in SplitList:
-        if S[0]=='InstructionStart':
-            StartStringCounter += 1
-        elif S[0]=='InstructionEnd':
-            EndStringCounter +=1
-    if not (StartStringCounter==1 and EndStringCounter==1):
-            print('Error: Instructions are faulty!')
-            return
-    SplitList.pop(0)
-    SplitList.pop(-1)
-    ModeSettings = SplitList.pop(0)
+def execute_instructions(ModeSettings, Points):
     print(ModeSettings)
     Mode = ModeSettings[0]
     if ModeSettings[1]=='True':
@@ -50,10 +30,6 @@ def parse_and_execute_instructions(InList):
         print('Error: Instructions are faulty!')
         return
     RecordVideoNthFrame = ModeSettings[3]
-    Points = []
-    for S in SplitList:
-        P = [float(S[0]) , float(S[1]) , float(S[2]) , float(S[3]) , S[4]]
-        Points.append(P)
     
     if Mode=='PullAndHold':
         execute_instruction_list(Points,Mode,RecordRealTimeScan,RecordVideo,RecordVideoNthFrame)
@@ -81,19 +57,17 @@ cmd = SplitCommand
 
 
 with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1,universal_newlines=True) as p:
-    Instructions=['Waiting']
+    Parser = InstructionParser()
     for line in sys.stdin:
         print(line)
     for line in p.stdout:
-        if line=='InstructionStart\n':
-            Instructions = ['InstructionStart']
-        elif line=='InstructionEnd\n' and Instructions[0]=='InstructionStart':
-            Instructions.append(line[0:-1])
-            BlockNewInstructions = True
-            parse_and_execute_instructions(Instructions)
-            Instructions = ['Waiting']
-        elif Instructions[0]=='Waiting':
-            print('Waiting for instructions...')
+        try:
+            Block = Parser.feed(line)
+        except ProtocolError as e:
+            print('Error: Instructions are faulty! %s' % e)
+            continue
+        if Block is None:
+            if not Parser.in_block:
+                print('Waiting for instructions...')
             continue
-        else:
-            Instructions.append(line[0:-1])
+        execute_instructions(*Block)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Runs heavy work, e.g. decoding and correlating calibration images, on a
+QThreadPool. Results, errors and progress are delivered as signals, so the
+connected slots run on the GUI thread.
+"""
+
+import logging
+import traceback
+import PyQt5.QtCore as PyCore
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class TaskSignals(PyCore.QObject):
+    # Return value of the function, not emitted for cancelled tasks
+    result = PyCore.pyqtSignal(object)
+    # Formatted traceback if the function raised
+    error = PyCore.pyqtSignal(str)
+    # Done and total work items as reported by the function
+    progress = PyCore.pyqtSignal(int, int)
+    # Always emitted last, also after errors and cancellation
+    finished = PyCore.pyqtSignal()
+
+
+class BackgroundTask(PyCore.QRunnable):
+    # Calls function(*args, **kwargs) on a pool thread. With pass_task=True
+    # the function also gets this task as keyword 'task', to report progress
+    # and to stop early once it has been cancelled.
+    def __init__(self, function, *args, pass_task=False, **kwargs):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = dict(kwargs, task=self) if pass_task else kwargs
+        self.signals = TaskSignals()
+        self.cancelled = False
+        # The caller keeps a reference for cancelling, so Qt must not delete
+        # the runnable behind its back
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise TaskCancelled()
+
+    def report_progress(self, done, total):
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            if self.cancelled:
+                return
+            result = self.function(*self.args, **self.kwargs)
+            if not self.cancelled:
+                self.signals.result.emit(result)
+        except TaskCancelled:
+            pass
+        except Exception:
+            if self.cancelled:
+                # Whatever the function used may be gone already
+                return
+            message = traceback.format_exc()
+            logging.error(f"Background task {getattr(self.function, '__name__', self.function)} failed:\n{message}")
+            self.signals.error.emit(message)
+        finally:
+            self.signals.finished.emit()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic benchmark for the coordinate transformation calibration.
+
+Calibration snapshots are synthesized from a source image by shifting it
+according to a known stage-to-image affine transformation and adding noise.
+The images are then run through the same stages as a real calibration
+(load_images -> preprocess_image -> phase correlation -> estimate_transformation)
+and the wall time, memory and the error of the recovered matrix are reported.
+The pyramid registration around the cantilever tip runs on the same snapshots
+and the benchmark fails if it is less accurate than the full frame correlation.
+
+Run it like this: python benchmark_calibration.py
+            e.g.: python benchmark_calibration.py --grid-sizes 5 10 --scales 1 --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import cv2
+from calibration import load_images, preprocess_image, PhaseCorrelator, PyramidPhaseCorrelator, estimate_transformation, transform_coordinates, DistortionModel, CoordinateTransform
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PROGRAM_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCES = [os.path.join(PROGRAM_PATH, 'TestImage.jpg'), os.path.join(PROGRAM_PATH, 'BSFibril-14.tif')]
+
+# Nominal optics of the widget: 10x magnification, 4.65 um camera pixels
+PIXELS_PER_METER = 10 / 4.65e-6
+PIEZO_RANGE = 4.999999e-5
+STARTING_TIP_POSITION = np.array([4.9e-5, 4.9e-5])
+# Cantilever tip in the bundled source images, as it would be clicked
+SOURCE_TIPS = {'TestImage.jpg': (642, 551), 'BSFibril-14.tif': (459, 281)}
+# Margin by which the pyramid registration may miss the full frame accuracy
+PYRAMID_TOLERANCE_PX = 0.05
+
+
+def stage_to_image_matrix(scale, rotation_deg=0.5, anisotropy=0.02):
+    # Linear part of a slightly rotated, anisotropic stage-to-image mapping
+    # with the image y axis pointing down
+    theta = np.deg2rad(rotation_deg)
+    rotation = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    return scale * PIXELS_PER_METER * rotation.dot(np.diag([1 + anisotropy, -1]))
+
+def true_shifts_at(afm_positions, stage_to_image, distortion, radius):
+    # Radial (barrel for distortion < 0) objective distortion of the ideal
+    # affine shifts, relative to the image radius
+    shifts = (np.asarray(afm_positions) - STARTING_TIP_POSITION).dot(stage_to_image.T)
+    r2 = np.sum(shifts ** 2, axis=1, keepdims=True) / radius ** 2
+    return shifts * (1 + distortion * r2)
+
+def synthesize_calibration(source, folder, grid_size, scale, noise, distortion=0.0, jpeg_quality=95, seed=0):
+    rng = np.random.default_rng(seed)
+    reference = cv2.resize(source, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    height, width = reference.shape[:2]
+    stage_to_image = stage_to_image_matrix(scale)
+
+    positions = np.linspace(-PIEZO_RANGE, PIEZO_RANGE, grid_size)
+    afm_positions = [(x, y) for x in positions for y in positions]
+    true_shifts = true_shifts_at(afm_positions, stage_to_image, distortion, np.hypot(width, height) / 2)
+    image_paths = []
+    for idx, shift in enumerate(true_shifts):
+        image = cv2.warpAffine(reference, np.float32([[1, 0, shift[0]], [0, 1, shift[1]]]), (width, height),
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        if noise > 0:
+            image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+        path = os.path.join(folder, f"calibration_image_{idx}.jpg")
+        cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        image_paths.append(path)
+
+    return reference, afm_positions, true_shifts, image_paths, stage_to_image
+
+def peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return usage / 1024 ** 2 if sys.platform == 'darwin' else usage / 1024
+
+def run_stage(timings, memory, name, function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    timings[name] = time.perf_counter() - start
+    memory[name] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return result
+
+def benchmark_case(source_path, grid_size, scale, noise, distortion=0.0):
+    source = cv2.imread(source_path, cv2.IMREAD_GRAYSCALE)
+    folder = tempfile.mkdtemp()
+    try:
+        reference, afm_positions, true_shifts, image_paths, stage_to_image = synthesize_calibration(
+            source, folder, grid_size, scale, noise, distortion)
+        timings = {}
+        memory = {}
+
+        images = run_stage(timings, memory, 'load', load_images, image_paths, True)
+        masks = run_stage(timings, memory, 'preprocess', lambda: [preprocess_image(image) for image in images])
+
+        def correlate():
+            correlator = PhaseCorrelator(preprocess_image(reference), preprocess=False)
+            return correlator.correlate_stack(masks)
+        shifts = np.array(run_stage(timings, memory, 'correlate', correlate))
+
+        # The widget predicts the shifts from the nominal optics, without the
+        # rotation and anisotropy of the synthetic stage
+        nominal = scale * PIXELS_PER_METER * np.array([1, -1])
+        expected_shifts = [tuple((np.array(p) - STARTING_TIP_POSITION) * nominal) for p in afm_positions]
+        tip_in_source = SOURCE_TIPS.get(os.path.basename(source_path))
+        anchor = None if tip_in_source is None else (tip_in_source[0] * scale, tip_in_source[1] * scale)
+        pyramid = PyramidPhaseCorrelator(reference, anchor=anchor)
+        pyramid_shifts = np.array(run_stage(timings, memory, 'pyramid', pyramid.correlate_stack, images, expected_shifts))
+
+        # Same offset as in the widget: shifts are taken relative to the tip
+        tip = np.array([reference.shape[1] / 2, reference.shape[0] / 2])
+        matrix = run_stage(timings, memory, 'estimate', estimate_transformation, shifts + tip, afm_positions)
+        model = None
+        if len(shifts) >= 6:
+            model = run_stage(timings, memory, 'distortion', DistortionModel, shifts, afm_positions)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    # Exact image-to-stage mapping for comparison
+    image_to_stage = np.linalg.inv(stage_to_image)
+    true_matrix = np.hstack([image_to_stage, (STARTING_TIP_POSITION - image_to_stage.dot(tip))[:, np.newaxis]])
+    test_points = true_shifts + tip
+    position_error = [np.linalg.norm(transform_coordinates(p, matrix) - transform_coordinates(p, true_matrix))
+                      for p in test_points]
+
+    # Accuracy between the grid points, where distortion is not measured
+    lattice = np.linspace(-PIEZO_RANGE, PIEZO_RANGE, 21)
+    dense_positions = np.array([(x, y) for x in lattice for y in lattice])
+    dense_shifts = true_shifts_at(dense_positions, stage_to_image, distortion,
+                                  np.hypot(reference.shape[1], reference.shape[0]) / 2)
+    affine_error = np.linalg.norm(CoordinateTransform(matrix).image2rl(dense_shifts + tip) - dense_positions, axis=1)
+    if model is not None:
+        model_error = np.linalg.norm(model.shift2rl(dense_shifts) - dense_positions, axis=1)
+
+    return {
+        'source': os.path.basename(source_path),
+        'image_size': [int(reference.shape[1]), int(reference.shape[0])],
+        'grid_size': grid_size,
+        'scale': scale,
+        'noise': noise,
+        'distortion': distortion,
+        'time_s': timings,
+        'total_time_s': sum(timings.values()),
+        'per_image_ms': 1e3 * sum(timings.values()) / len(afm_positions),
+        'traced_peak_mb': memory,
+        'peak_rss_mb': peak_rss_mb(),
+        'max_shift_error_px': float(np.max(np.linalg.norm(shifts - true_shifts, axis=1))),
+        'pyramid_full_frame': pyramid.uses_full_frame,
+        'max_shift_error_pyramid_px': float(np.max(np.linalg.norm(pyramid_shifts - true_shifts, axis=1))),
+        'max_position_error_um': 1e6 * float(np.max(position_error)),
+        'matrix_relative_error': float(np.linalg.norm(matrix[:, :2] - image_to_stage) / np.linalg.norm(image_to_stage)),
+        'max_offgrid_error_affine_um': 1e6 * float(np.max(affine_error)),
+        'distortion_model': None if model is None else model.kind,
+        'max_offgrid_error_distortion_um': None if model is None else 1e6 * float(np.max(model_error)),
+    }
+
+def print_result(result):
+    stages = ' '.join(f"{name}={1e3 * t:8.1f}ms" for name, t in result['time_s'].items())
+    print(f"{result['source']:>16} {result['image_size'][0]:>5}x{result['image_size'][1]:<5} "
+          f"grid={result['grid_size']:>2} noise={result['noise']:>4} | {stages} | "
+          f"{result['per_image_ms']:7.1f}ms/img | mem={max(result['traced_peak_mb'].values()):7.1f}MB "
+          f"rss={result['peak_rss_mb']:7.1f}MB | shift err={result['max_shift_error_px']:.3f}px "
+          f"pyramid={result['max_shift_error_pyramid_px']:.3f}px{' (full frame)' if result['pyramid_full_frame'] else ''} "
+          f"pos err={result['max_position_error_um']:.4f}um | off-grid affine={result['max_offgrid_error_affine_um']:.4f}um"
+          + ("" if result['max_offgrid_error_distortion_um'] is None
+             else f" model={result['max_offgrid_error_distortion_um']:.4f}um ({result['distortion_model']})"))
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic calibration speed and accuracy benchmark')
+    parser.add_argument('--sources', nargs='+', default=DEFAULT_SOURCES, help='source images to synthesize snapshots from')
+    parser.add_argument('--grid-sizes', nargs='+', type=int, default=[3, 5, 10])
+    parser.add_argument('--scales', nargs='+', type=float, default=[0.5, 1.0, 2.0], help='resolution relative to the source image')
+    parser.add_argument('--noise', type=float, default=5.0, help='standard deviation of the added gaussian noise')
+    parser.add_argument('--distortion', type=float, default=0.0,
+                        help='radial distortion of the shifts at the image corners, e.g. -0.02 for 2%% barrel distortion')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for source_path in args.sources:
+        for scale in args.scales:
+            for grid_size in args.grid_sizes:
+                result = benchmark_case(source_path, grid_size, scale, args.noise, args.distortion)
+                print_result(result)
+                results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    # The pyramid registration replaces the full frame correlation, it must
+    # not lose accuracy
+    worse = [r for r in results if r['max_shift_error_pyramid_px'] > r['max_shift_error_px'] + PYRAMID_TOLERANCE_PX]
+    for r in worse:
+        print(f"FAIL: pyramid registration less accurate than full frame for {r['source']} grid={r['grid_size']} "
+              f"scale={r['scale']}: {r['max_shift_error_pyramid_px']:.3f}px > {r['max_shift_error_px']:.3f}px")
+    sys.exit(1 if worse else 0)
+
+if __name__ == '__main__':
+    main()
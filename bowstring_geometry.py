@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Geometry of pull-and-hold and scratch-off experiments.
+
+Only depends on NumPy, so experiments can be planned in scripts and
+benchmarks without importing Qt, OpenCV or matplotlib. All positions are
+real-world (piezo) coordinates in metres, the results are immutable.
+"""
+
+from dataclasses import dataclass
+import numpy as np
+
+
+# Half width of the piezo range, positions have to stay strictly inside
+PIEZO_LIMIT = 5e-5
+
+
+def _frozen(values):
+    values = np.array(values, dtype=float)
+    values.setflags(write=False)
+    return values
+
+def in_piezo_range(points, limit=PIEZO_LIMIT):
+    # Per point for (N, 2) arrays, a single bool for one (2,) point
+    return np.all(np.abs(np.asarray(points)) < limit, axis=-1)
+
+def accessible_area(lower, upper):
+    # TopLeft, TopRight, BottomRight, BottomLeft
+    return np.array([[lower, upper], [upper, upper], [upper, lower], [lower, lower]], dtype=float)
+
+
+class CoordinateTransform:
+    # Affine mapping between image pixels and real-world (piezo) coordinates
+    # with the forward and inverse 3x3 matrices computed once. Both methods
+    # map a single point (2,) or an (N, 2) array in one call.
+    def __init__(self, image2rl_matrix):
+        matrix = np.asarray(image2rl_matrix, dtype=float)
+        if matrix.shape == (2, 3):
+            matrix = np.vstack([matrix, [0, 0, 1]])
+        self.forward = matrix
+        self.inverse = np.linalg.inv(matrix)
+
+    @classmethod
+    def model_based(cls, pixel_size, magnification, tip_in_image, tip_in_rl):
+        # rl = (image - origin) * scaling, with the y axis flipped and the
+        # origin chosen so the tip maps onto its known piezo position
+        scaling = np.array([1, -1]) * pixel_size / magnification
+        origin = np.asarray(tip_in_image, dtype=float) - np.asarray(tip_in_rl, dtype=float) / scaling
+        return cls([[scaling[0], 0, -origin[0] * scaling[0]],
+                    [0, scaling[1], -origin[1] * scaling[1]]])
+
+    @staticmethod
+    def _apply(matrix, points):
+        points = np.asarray(points, dtype=float)
+        return points.dot(matrix[:2, :2].T) + matrix[:2, 2]
+
+    def image2rl(self, points):
+        return self._apply(self.forward, points)
+
+    def rl2image(self, points):
+        return self._apply(self.inverse, points)
+
+
+@dataclass(frozen=True)
+class BowstringGeometry:
+    anchor1: np.ndarray
+    anchor2: np.ndarray
+    half_point: np.ndarray
+    segment_length: float
+    segment_direction: np.ndarray
+    perpendicular_direction: np.ndarray
+    buffer_point: np.ndarray
+    bow_drawing_distance: float
+    final_strain_point: np.ndarray
+    total_movement_time: float
+
+    @property
+    def in_range(self):
+        return bool(in_piezo_range(self.buffer_point) and in_piezo_range(self.final_strain_point))
+
+def bowstring_geometry(anchor1, anchor2, strain_rate, final_strain, tip_to_half_point_buffer):
+    # The tip approaches next to the middle of the fibril and pulls it
+    # perpendicular to the anchors until the final strain is reached
+    anchor1 = np.asarray(anchor1, dtype=float)
+    anchor2 = np.asarray(anchor2, dtype=float)
+    segment_length = np.linalg.norm(anchor1 - anchor2)
+    half_point = (anchor1 + anchor2) / 2
+    segment_direction = (anchor1 - anchor2) / segment_length
+    perpendicular_direction = np.array([-segment_direction[1], segment_direction[0]])
+    bow_drawing_distance = segment_length / 2 * np.sqrt((1 + final_strain) ** 2 - 1)
+    return BowstringGeometry(
+        anchor1=_frozen(anchor1),
+        anchor2=_frozen(anchor2),
+        half_point=_frozen(half_point),
+        segment_length=float(segment_length),
+        segment_direction=_frozen(segment_direction),
+        perpendicular_direction=_frozen(perpendicular_direction),
+        buffer_point=_frozen(half_point - perpendicular_direction * tip_to_half_point_buffer),
+        bow_drawing_distance=float(bow_drawing_distance),
+        final_strain_point=_frozen(half_point + perpendicular_direction * bow_drawing_distance),
+        total_movement_time=float((bow_drawing_distance + tip_to_half_point_buffer) / strain_rate))
+
+
+@dataclass(frozen=True)
+class ScratchOffPlan:
+    # One scratch line per row, from the buffer point to the final strain point
+    buffer_points: np.ndarray
+    final_strain_points: np.ndarray
+    valid_mask: np.ndarray
+
+    def __len__(self):
+        return len(self.valid_mask)
+
+    @property
+    def in_range(self):
+        return len(self.valid_mask) > 0 and bool(np.all(self.valid_mask))
+
+    @property
+    def invalid_indices(self):
+        return np.flatnonzero(~self.valid_mask)
+
+def scratch_off_plan(anchor1, anchor2, num_points, dist_to_anchors, tip_to_string_buffer, final_strain):
+    anchor1 = np.asarray(anchor1, dtype=float)
+    direction = np.asarray(anchor2, dtype=float) - anchor1
+    total_anchor_distance = np.linalg.norm(direction)
+
+    # Scratch points are spread evenly between the safety distances to both
+    # anchors. Position of each point along the base line as a fraction of
+    # the anchor distance
+    effective_length = total_anchor_distance - 2 * dist_to_anchors
+    t = np.arange(1, max(num_points, 0) + 1) / (num_points + 1)
+    fraction = (dist_to_anchors + t * effective_length) / total_anchor_distance
+    scratch_points = anchor1 + fraction[:, np.newaxis] * direction
+    orthogonal_direction = np.array([-direction[1], direction[0]]) / total_anchor_distance
+
+    # The final strain height falls off linearly from the mid point
+    # towards the anchors
+    distance_to_mid = np.abs(fraction - 0.5) * total_anchor_distance
+    final_strain_height = ((1 - distance_to_mid * 2 / total_anchor_distance) * total_anchor_distance / 2
+                           * np.sqrt((1 + final_strain) ** 2 - 1))
+
+    buffer_points = scratch_points + tip_to_string_buffer * orthogonal_direction
+    final_strain_points = scratch_points - final_strain_height[:, np.newaxis] * orthogonal_direction
+    # Both points of a scratch line have to be within the piezo range
+    valid_mask = in_piezo_range(buffer_points) & in_piezo_range(final_strain_points)
+    valid_mask.setflags(write=False)
+    return ScratchOffPlan(_frozen(buffer_points.reshape(-1, 2)), _frozen(final_strain_points.reshape(-1, 2)), valid_mask)
+
+
+def _route_cost(order, start_cost, travel, end_cost):
+    return start_cost[order[0]] + travel[order[:-1], order[1:]].sum() + end_cost[order[-1]]
+
+def order_experiments(start, entries, exits, end=None):
+    # Order in which to run a queue of experiments so that the stage travels
+    # as little as possible. Each experiment is entered at its entry point
+    # and left at its exit point, e.g. the buffer and final strain point of
+    # a bowstring, so the travel costs are asymmetric. A nearest neighbour
+    # tour is improved with 2-opt moves until none of them shortens it.
+    entries = np.asarray(entries, dtype=float).reshape(-1, 2)
+    exits = np.asarray(exits, dtype=float).reshape(-1, 2)
+    start = np.asarray(start, dtype=float)
+    end = start if end is None else np.asarray(end, dtype=float)
+    n = len(entries)
+    if n < 2:
+        return np.arange(n)
+
+    start_cost = np.linalg.norm(entries - start, axis=1)
+    travel = np.linalg.norm(exits[:, np.newaxis] - entries[np.newaxis], axis=2)
+    end_cost = np.linalg.norm(exits - end, axis=1)
+
+    order = [int(np.argmin(start_cost))]
+    remaining = set(range(n)) - {order[0]}
+    while remaining:
+        candidates = np.array(sorted(remaining))
+        order.append(int(candidates[np.argmin(travel[order[-1], candidates])]))
+        remaining.discard(order[-1])
+    order = np.array(order)
+
+    best = _route_cost(order, start_cost, travel, end_cost)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                candidate = np.concatenate([order[:i], order[i:j + 1][::-1], order[j + 1:]])
+                cost = _route_cost(candidate, start_cost, travel, end_cost)
+                if cost < best - 1e-12:
+                    order, best, improved = candidate, cost, True
+    return order
+
+def route_length(start, entries, exits, order=None, end=None):
+    # Stage travel between the experiments, from the start through all of
+    # them in the given order and back to the end position
+    entries = np.asarray(entries, dtype=float).reshape(-1, 2)
+    exits = np.asarray(exits, dtype=float).reshape(-1, 2)
+    if len(entries) == 0:
+        return 0.0
+    start = np.asarray(start, dtype=float)
+    end = start if end is None else np.asarray(end, dtype=float)
+    order = np.arange(len(entries)) if order is None else np.asarray(order)
+    path = np.vstack([start, np.column_stack([entries[order], exits[order]]).reshape(-1, 2), end])
+    # Travel inside an experiment is the same for every order
+    return float(np.sum(np.linalg.norm(path[1::2] - path[0::2], axis=1)))
+
+def scratch_off_order(buffer_points, final_strain_points, start, repeats=1, serpentine=True):
+    # Order in which to scratch the lines of a scratch-off plan, repeated
+    # passes included. Every line keeps its direction and needs its own
+    # approach, the tip always has to be retracted to get back across the
+    # fibril, so no transitions can be merged. Only the retracted travel
+    # between the lines can be saved: passes along the fibril in either
+    # direction, alternating if serpentine, are compared with index order
+    # by their route length from and back to start and the shortest is
+    # used. Lines of zero length would only cost an approach and are left
+    # out.
+    buffer_points = np.asarray(buffer_points, dtype=float).reshape(-1, 2)
+    final_strain_points = np.asarray(final_strain_points, dtype=float).reshape(-1, 2)
+    forward = np.flatnonzero(np.linalg.norm(final_strain_points - buffer_points, axis=1) > 0)
+    if len(forward) == 0 or repeats < 1:
+        return np.zeros(0, dtype=int)
+    candidates = []
+    for first in (forward, forward[::-1]):
+        candidates.append(np.tile(first, repeats))
+        if serpentine:
+            candidates.append(np.concatenate([first[::-1] if r % 2 else first for r in range(repeats)]))
+    # Index order comes first and is kept on ties
+    return min(candidates, key=lambda order: route_length(start, buffer_points, final_strain_points, order))
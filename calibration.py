@@ -1,80 +1,731 @@
 import numpy as np
 import cv2
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PyQt5.QtGui import QImage
+from bowstring_geometry import CoordinateTransform
 
 
-def qimage_to_cv2(qimage):
-    qimage = qimage.convertToFormat(QImage.Format_RGB32)
+class _QImageArrayInterface:
+    # Exposes the pixel buffer of a QImage to numpy without copying. The
+    # array keeps this object, and with it the QImage, alive.
+    def __init__(self, qimage, shape, strides):
+        self.qimage = qimage
+        self.__array_interface__ = {
+            'shape': shape,
+            'strides': strides,
+            'typestr': '|u1',
+            'data': (int(qimage.constBits()), True),
+            'version': 3,
+        }
+
+def qimage_to_cv2(qimage, grayscale=False):
     width = qimage.width()
     height = qimage.height()
-    ptr = qimage.bits()
-    ptr.setsize(qimage.byteCount())
-    arr = np.array(ptr).reshape(height, width, 4)
+    if grayscale:
+        # Single channel 8 bit view straight on the QImage buffer
+        if qimage.format() != QImage.Format_Grayscale8:
+            qimage = qimage.convertToFormat(QImage.Format_Grayscale8)
+        return np.asarray(_QImageArrayInterface(qimage, (height, width), (qimage.bytesPerLine(), 1)))
+    if qimage.format() != QImage.Format_RGB32:
+        qimage = qimage.convertToFormat(QImage.Format_RGB32)
+    arr = np.asarray(_QImageArrayInterface(qimage, (height, width, 4), (qimage.bytesPerLine(), 4, 1)))
     return cv2.cvtColor(arr, cv2.COLOR_BGRA2BGR)
 
-def load_images(image_paths):
+def load_image(path, grayscale=False):
+    # Decode with OpenCV first. Grayscale frames are decoded to a single
+    # channel directly and 16 bit TIFFs keep their depth. QImage is only used
+    # as a fallback for paths or formats OpenCV cannot handle.
+    flags = cv2.IMREAD_ANYDEPTH | (cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+    image = cv2.imread(path, flags)
+    if image is None and os.path.isfile(path):
+        # cv2.imread does not accept non-ASCII paths on Windows
+        image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), flags)
+    if image is not None:
+        return image
+    qimage = QImage(path)
+    if qimage.isNull():
+        return None
+    return qimage_to_cv2(qimage, grayscale)
+
+def load_images(image_paths, grayscale=False):
     images = []
     for path in image_paths:
         logging.debug(f"Loading image from path: {path}")
-        image = qimage_to_cv2(QImage(path))
+        image = load_image(path, grayscale)
         if image is not None:
             images.append(image)
             logging.debug(f"Loaded image from path: {path}")
         else:
             logging.error(f"Failed to load image from path: {path}")
-        print(image.dtype,image.shape)
     return images
 
-def preprocess_image(image):
-    # Convert to grayscale
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # gray_image = image
-    
-    # Step 1: Negate the image
-    negated_image = cv2.bitwise_not(gray_image)
-    
-    # Step 2: Apply binary thresholding
-    _, binary_image = cv2.threshold(negated_image, 200, 255, cv2.THRESH_BINARY)
-    
-    # Step 3: Remove small objects using morphological operations
-    kernel = np.ones((5, 5), np.uint8)
-    opened_image = cv2.morphologyEx(binary_image, cv2.MORPH_OPEN, kernel)
-    
-    # Step 4: Find the largest connected component
-    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(opened_image, connectivity=8)
-    largest_label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])  # Ignore the background
-    
-    mask = np.zeros_like(labels, dtype=np.uint8)
-    mask[labels == largest_label] = 255
-    
-    # Step 5: Return the cleaned-up binary image
-    cleaned_image = cv2.bitwise_and(binary_image, binary_image, mask=mask)
-    
-    return cleaned_image
+def opening_kernel(kernel_size):
+    # Structuring elements are cached, they never change for a given size
+    kernel = _OPENING_KERNELS.get(kernel_size)
+    if kernel is None:
+        kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        _OPENING_KERNELS[kernel_size] = kernel
+    return kernel
+
+_OPENING_KERNELS = {}
+
+class CantileverMaskExtractor:
+    # Isolates the cantilever as the largest dark object in the frame. All
+    # intermediate images live in buffers that are reused as long as the
+    # frame size does not change, so a calibration stack is processed
+    # without per-step allocations. Not thread safe, use one per thread.
+    def __init__(self, threshold=200, kernel_size=5):
+        self.threshold = threshold
+        self.kernel = opening_kernel(kernel_size)
+        self._shape = None
+
+    def _allocate(self, shape):
+        self._shape = shape
+        self._gray = np.empty(shape, np.uint8)
+        self._binary = np.empty(shape, np.uint8)
+        self._opened = np.empty(shape, np.uint8)
+        self._labels = np.empty(shape, np.int32)
+        self._mask = np.empty(shape, np.uint8)
+
+    def _to_gray(self, image):
+        # Convert to grayscale unless the image was loaded as a single channel
+        if image.ndim == 3:
+            code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+            image = cv2.cvtColor(image, code, dst=self._gray if image.dtype == np.uint8 else None)
+        # The threshold works on 8 bit intensities
+        if image.dtype != np.uint8:
+            image = cv2.convertScaleAbs(image, self._gray, alpha=255 / np.iinfo(image.dtype).max)
+        return image
+
+    def __call__(self, image, out=None):
+        shape = image.shape[:2]
+        if shape != self._shape:
+            self._allocate(shape)
+        if out is None:
+            out = np.empty(shape, np.uint8)
+        gray_image = self._to_gray(image)
+
+        # Step 1+2: Negate and threshold in one pass,
+        # 255 - g > t  <=>  g <= 254 - t
+        cv2.threshold(gray_image, 254 - self.threshold, 255, cv2.THRESH_BINARY_INV, dst=self._binary)
+
+        # Step 3: Remove small objects using morphological operations
+        cv2.morphologyEx(self._binary, cv2.MORPH_OPEN, self.kernel, dst=self._opened)
+
+        # Step 4: Find the largest connected component
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(self._opened, labels=self._labels, connectivity=8)
+        out[...] = 0
+        if num_labels < 2:
+            # Nothing dark enough in the frame
+            return out
+        largest_label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])  # Ignore the background
+
+        # Step 5: Keep the thresholded pixels of that component. Only its
+        # bounding box has to be compared against the label image.
+        x, y, w, h = stats[largest_label, :4]
+        box = (slice(y, y + h), slice(x, x + w))
+        cv2.compare(labels[box], int(largest_label), cv2.CMP_EQ, dst=self._mask[box])
+        cv2.bitwise_and(self._binary[box], self._binary[box], dst=out[box], mask=self._mask[box])
+        return out
+
+_extractors = threading.local()
+
+def preprocess_image(image, threshold=200, kernel_size=5, out=None):
+    # Returns the cleaned-up binary cantilever mask. The work buffers are
+    # kept per thread and parameter set, the result is a new array unless
+    # out is given.
+    extractors = getattr(_extractors, 'by_parameters', None)
+    if extractors is None:
+        extractors = _extractors.by_parameters = {}
+    extractor = extractors.get((threshold, kernel_size))
+    if extractor is None:
+        extractor = extractors[(threshold, kernel_size)] = CantileverMaskExtractor(threshold, kernel_size)
+    return extractor(image, out)
+
+def _to_gray(image):
+    # Single channel view for the registration windows
+    if image.ndim == 3:
+        code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(image, code)
+    return image
+
+class _DFTWorkspace:
+    # Preallocated buffers for one correlation. Spectra are kept in OpenCV's
+    # packed CCS layout (real DFT), which needs half the memory and work of
+    # a full complex spectrum.
+    def __init__(self, dft_shape):
+        self.mask = None
+        self.padded = np.zeros(dft_shape, np.float32)
+        self.spectrum = np.empty(dft_shape, np.float32)
+        self.cross_power = np.empty(dft_shape, np.float32)
+        self.magnitude = np.empty(dft_shape, np.float32)
+        self.response = np.empty(dft_shape, np.float32)
+
+class PhaseCorrelator:
+    # Reusable phase correlation engine for a fixed reference image.
+    # The reference is preprocessed and transformed once, both images are
+    # zero-padded to an optimal DFT size and the FFT workspace is kept
+    # between calls, so correlating a whole calibration stack only costs
+    # one forward and one inverse DFT per target image.
+    # With preprocess=False the images are expected to be cantilever masks
+    # (or any single channel frame) already and are correlated as they are.
+    def __init__(self, reference_image, centroid_window=5, preprocess=True):
+        self.preprocess = preprocess
+        reference = self._prepare(reference_image)
+        self.image_shape = reference.shape[:2]
+        self.centroid_window = centroid_window
+        self.dft_shape = (cv2.getOptimalDFTSize(self.image_shape[0]),
+                          cv2.getOptimalDFTSize(self.image_shape[1]))
+        # Every thread gets its own workspace, the reference spectrum is
+        # shared read-only. This makes one correlator usable from a pool.
+        self._local = threading.local()
+
+        # Transform the reference once and keep its spectrum
+        workspace = self._workspace()
+        self._load_padded(workspace, reference)
+        self.reference_spectrum = cv2.dft(workspace.padded)
+
+    def _prepare(self, image, workspace=None):
+        if not self.preprocess:
+            return image
+        if workspace is None:
+            return preprocess_image(image)
+        # Reuse the mask buffer of this thread's workspace
+        if workspace.mask is None or workspace.mask.shape != image.shape[:2]:
+            workspace.mask = np.empty(image.shape[:2], np.uint8)
+        return preprocess_image(image, out=workspace.mask)
+
+    def _workspace(self):
+        workspace = getattr(self._local, 'workspace', None)
+        if workspace is None:
+            workspace = _DFTWorkspace(self.dft_shape)
+            self._local.workspace = workspace
+        return workspace
+
+    def _load_padded(self, workspace, preprocessed):
+        rows, cols = preprocessed.shape[:2]
+        if rows > self.dft_shape[0] or cols > self.dft_shape[1]:
+            raise ValueError(f"Image of shape {preprocessed.shape} does not fit the reference DFT size {self.dft_shape}")
+        # Only the image region has to be rewritten, the padding stays zero
+        # unless a smaller image was loaded before.
+        workspace.padded[rows:, :] = 0
+        workspace.padded[:rows, cols:] = 0
+        workspace.padded[:rows, :cols] = preprocessed
+
+    def correlate(self, image, expected_shift=None):
+        # expected_shift is only used by PyramidPhaseCorrelator, it is
+        # accepted here so both correlators can be used interchangeably.
+        workspace = self._workspace()
+        self._load_padded(workspace, self._prepare(image, workspace))
+        cv2.dft(workspace.padded, workspace.spectrum)
+
+        # Normalized cross power spectrum R = P / |P| with P = F1 * conj(F2).
+        # |P| is obtained as sqrt(P * conj(P)), which stays in CCS layout.
+        cv2.mulSpectrums(self.reference_spectrum, workspace.spectrum, 0, workspace.cross_power, conjB=True)
+        cv2.mulSpectrums(workspace.cross_power, workspace.cross_power, 0, workspace.magnitude, conjB=True)
+        cv2.sqrt(workspace.magnitude, workspace.magnitude)
+        workspace.magnitude += np.finfo(np.float32).eps
+        cv2.divSpectrums(workspace.cross_power, workspace.magnitude, 0, workspace.response)
+        cv2.idft(workspace.response, workspace.response, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+        return self._locate_peak(workspace.response)
+
+    def keep_as_reference(self):
+        # Makes the image of the last correlate call of this thread the new
+        # reference, for tracking a sequence. Its spectrum is still in the
+        # workspace, so the buffers are only swapped. The reference is
+        # shared, only use this while a single thread correlates.
+        workspace = self._workspace()
+        self.reference_spectrum, workspace.spectrum = workspace.spectrum, self.reference_spectrum
+
+    def correlate_stack(self, images, expected_shifts=None):
+        # images can be a list of frames or an (N, H, W[, C]) array
+        return [self.correlate(image) for image in images]
+
+    def _locate_peak(self, response):
+        rows, cols = response.shape
+        _, _, _, (peak_x, peak_y) = cv2.minMaxLoc(response)
+
+        # Weighted centroid around the peak for sub-pixel accuracy. The
+        # response is not fft-shifted, so the window wraps around the edges.
+        half = self.centroid_window // 2
+        y_idx = np.arange(peak_y - half, peak_y + half + 1)
+        x_idx = np.arange(peak_x - half, peak_x + half + 1)
+        window = response[np.ix_(y_idx % rows, x_idx % cols)]
+        total = window.sum()
+        if total > 0:
+            centroid_y = np.dot(window.sum(axis=1), y_idx) / total
+            centroid_x = np.dot(window.sum(axis=0), x_idx) / total
+        else:
+            centroid_y, centroid_x = peak_y, peak_x
+
+        # A correlation peak at p means the target is shifted by -p
+        shift_x = -centroid_x
+        shift_y = -centroid_y
+        if shift_x < -cols / 2:
+            shift_x += cols
+        elif shift_x >= cols / 2:
+            shift_x -= cols
+        if shift_y < -rows / 2:
+            shift_y += rows
+        elif shift_y >= rows / 2:
+            shift_y -= rows
+
+        return (float(shift_x), float(shift_y))
+
+class PyramidPhaseCorrelator:
+    # Coarse-to-fine registration. The shift is first estimated on a
+    # downsampled pyramid level of the whole frame and then refined on a small
+    # window around the cantilever tip: to the nearest pixels by phase
+    # correlation of the cantilever masks in the window, below that by an ECC
+    # fit of the grey levels along the cantilever outline. Only the pyramid
+    # level and the windows are preprocessed, never the full frame, and the
+    # window keeps debris elsewhere in the field out of the fine estimate.
+    # anchor is the tip position in the reference image (x, y). The full
+    # frame correlator is used instead without an anchor, if the frame is
+    # smaller than the window, if the window does not constrain the shift in
+    # both directions or if the coarse estimate is off from the expected
+    # shift.
+    MIN_CONDITION = 0.1  # smaller to larger eigenvalue of the structure tensor
+    ECC_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+
+    def __init__(self, reference_image, anchor=None, levels=2, roi_size=128, max_deviation=None, outline_width=25):
+        reference = _to_gray(reference_image)
+        self.image_shape = reference.shape[:2]
+        self.levels = levels
+        self.roi_size = roi_size
+        # Coarse estimates further than this from an expected shift are
+        # considered unreliable and the full frame correlator is used instead
+        self.max_deviation = roi_size / 4 if max_deviation is None else max_deviation
+        self.full = PhaseCorrelator(reference_image)
+        self.anchor = None if anchor is None else (float(anchor[0]), float(anchor[1]))
+        if self.anchor is None or min(self.image_shape) < roi_size:
+            logging.debug("No tip position or the frame is smaller than the registration window, using full frame correlation")
+            self.anchor = None
+            return
+
+        coarse_mask = self._coarse_mask(reference)
+        self.coarse = PhaseCorrelator(coarse_mask, preprocess=False)
+        condition = self._condition(coarse_mask, self.anchor)
+        if condition < self.MIN_CONDITION:
+            logging.debug(f"Registration window at {self.anchor} does not constrain the shift in both directions "
+                          f"(condition {condition:.3f}), using full frame correlation")
+            self.anchor = None
+            return
+
+        # The window cuts through the cantilever, a Hann taper keeps these
+        # artificial edges out of the phase correlation
+        self._taper = cv2.createHanningWindow((self.roi_size, self.roi_size), cv2.CV_32F)
+        self._outline_kernel = np.ones((outline_width, outline_width), np.uint8)
+        # Reference windows are prepared once per window position. Away
+        # from the image border there is only one, near the border a few.
+        self._reference = reference
+        self._windows = {}
+
+    @property
+    def uses_full_frame(self):
+        return self.anchor is None
+
+    def _coarse_mask(self, image):
+        for _ in range(self.levels):
+            image = cv2.pyrDown(image)
+        # The opening kernel shrinks with the image
+        return preprocess_image(image, kernel_size=3)
+
+    def _condition(self, coarse_mask, anchor):
+        # Smaller eigenvalue of the structure tensor of the cantilever outline
+        # in the window relative to the larger one. It is small where the
+        # outline only runs in one direction, e.g. along the sides of the
+        # cantilever, and the shift along it is not determined.
+        scale = 2 ** self.levels
+        half = max(self.roi_size // scale // 2, 1)
+        x = int(anchor[0] / scale)
+        y = int(anchor[1] / scale)
+        window = coarse_mask[max(y - half, 0):y + half, max(x - half, 0):x + half]
+        if window.size == 0:
+            return 0.0
+        blurred = cv2.GaussianBlur(window.astype(np.float32) / 255, (0, 0), 1.0)
+        gx = cv2.Sobel(blurred, cv2.CV_32F, 1, 0)
+        gy = cv2.Sobel(blurred, cv2.CV_32F, 0, 1)
+        tensor = np.array([[np.sum(gx * gx), np.sum(gx * gy)], [np.sum(gx * gy), np.sum(gy * gy)]])
+        smaller, larger = np.linalg.eigvalsh(tensor)
+        return float(smaller / larger) if larger > 0 else 0.0
+
+    def _window_origins(self, guess):
+        # Top left corners of the reference window around the anchor and of
+        # the target window displaced by the guessed shift. Both have to stay
+        # inside the image, so near the border the pair moves inwards.
+        rows, cols = self.image_shape
+        dx = int(round(guess[0]))
+        dy = int(round(guess[1]))
+        x0 = int(round(self.anchor[0] - self.roi_size / 2))
+        y0 = int(round(self.anchor[1] - self.roi_size / 2))
+        x0 = max(min(x0, cols - self.roi_size, cols - self.roi_size - dx), 0, -dx)
+        y0 = max(min(y0, rows - self.roi_size, rows - self.roi_size - dy), 0, -dy)
+        return (x0, y0), (x0 + dx, y0 + dy)
+
+    def _crop(self, image, origin):
+        x0, y0 = origin
+        return image[y0:y0 + self.roi_size, x0:x0 + self.roi_size]
+
+    def _prepare_window(self, window):
+        # Cantilever mask of the window, tapered for the phase correlation,
+        # and the grey levels for the ECC fit
+        mask = preprocess_image(window)
+        return cv2.multiply(mask, self._taper[:mask.shape[0], :mask.shape[1]], dtype=cv2.CV_32F), window.astype(np.float32)
+
+    def _reference_window(self, origin):
+        prepared = self._windows.get(origin)
+        if prepared is None:
+            tapered, grey = self._prepare_window(self._crop(self._reference, origin))
+            prepared = (PhaseCorrelator(tapered, preprocess=False), grey)
+            self._windows[origin] = prepared
+        return prepared
+
+    def correlate(self, image, expected_shift=None):
+        if self.uses_full_frame:
+            return self.full.correlate(image)
+        target = _to_gray(image)
+
+        # Step 1: Coarse shift on the pyramid level
+        scale = 2 ** self.levels
+        coarse_x, coarse_y = self.coarse.correlate(self._coarse_mask(target))
+        guess = (coarse_x * scale, coarse_y * scale)
+        if expected_shift is not None:
+            deviation = np.hypot(guess[0] - expected_shift[0], guess[1] - expected_shift[1])
+            if deviation > self.max_deviation:
+                logging.debug(f"Coarse shift {guess} deviates {deviation:.1f} px from the expected shift {expected_shift}, "
+                              f"using full frame correlation")
+                return self.full.correlate(image)
+
+        # Step 2: Nearest pixels from the cantilever masks in the window
+        # around the tip
+        reference_origin, target_origin = self._window_origins(guess)
+        correlator, reference_grey = self._reference_window(reference_origin)
+        tapered, target_grey = self._prepare_window(self._crop(target, target_origin))
+        fine_x, fine_y = correlator.correlate(tapered)
+        guess = (target_origin[0] - reference_origin[0] + fine_x, target_origin[1] - reference_origin[1] + fine_y)
+
+        # Step 3: Sub-pixel shift from the grey levels along the outline. The
+        # windows are re-aligned on the refined shift first, so the fit only
+        # has to bridge the residual.
+        reference_origin, target_origin = self._window_origins(guess)
+        correlator, reference_grey = self._reference_window(reference_origin)
+        target_window = self._crop(target, target_origin)
+        offset = (target_origin[0] - reference_origin[0], target_origin[1] - reference_origin[1])
+        outline = cv2.dilate(preprocess_image(target_window), self._outline_kernel)
+        warp = np.float32([[1, 0, guess[0] - offset[0]], [0, 1, guess[1] - offset[1]]])
+        try:
+            _, warp = cv2.findTransformECC(reference_grey, target_window.astype(np.float32), warp,
+                                           cv2.MOTION_TRANSLATION, self.ECC_CRITERIA, outline, 1)
+        except cv2.error as e:
+            logging.debug(f"Sub-pixel refinement did not converge, keeping {guess}: {e}")
+            return guess
+        return (float(offset[0] + warp[0, 2]), float(offset[1] + warp[1, 2]))
+
+    def correlate_stack(self, images, expected_shifts=None):
+        if expected_shifts is None:
+            expected_shifts = [None] * len(images)
+        return [self.correlate(image, expected) for image, expected in zip(images, expected_shifts)]
+
+def load_grayscale_image(path):
+    return load_image(path, grayscale=True)
+
+def correlate_image(correlator, item, loader=load_grayscale_image, expected_shift=None):
+    # item may be a file path (decoded with loader) or an already loaded frame.
+    # The correlators only look at intensities, so files are decoded to a
+    # single channel by default. Returns None if the image cannot be loaded.
+    image = loader(item) if isinstance(item, str) else item
+    if image is None:
+        logging.error(f"Failed to load image: {item}")
+        return None
+    return correlator.correlate(image, expected_shift)
+
+def correlate_images_parallel(correlator, images, max_workers=None, loader=load_grayscale_image, expected_shifts=None,
+                              progress=None, cancelled=None):
+    # Decode, preprocess and correlate calibration images in a thread pool.
+    # OpenCV releases the GIL during decoding and the DFTs, so threads scale
+    # across cores without pickling full frames to worker processes.
+    # Results are returned in input order; frames that fail to load yield None.
+    # progress(done, total) is called after every image, once cancelled()
+    # returns True the remaining images are skipped and yield None as well.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if expected_shifts is None:
+        expected_shifts = [None] * len(images)
+
+    def correlate(item, expected):
+        if cancelled is not None and cancelled():
+            return None
+        return correlate_image(correlator, item, loader, expected)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(correlate, item, expected) for item, expected in zip(images, expected_shifts)]
+        if progress is not None:
+            for done, _ in enumerate(as_completed(futures), 1):
+                progress(done, len(futures))
+        return [future.result() for future in futures]
 
 def phase_correlation(image1, image2):
-    # Preprocess images to isolate the cantilever
-    image1_preprocessed = preprocess_image(image1)
-    image2_preprocessed = preprocess_image(image2)
-    
-    # Since preprocess_image already returns grayscale images, no need for additional conversion
-    image1_gray = image1_preprocessed
-    image2_gray = image2_preprocessed
-
-    # Compute the phase correlation
-    shift, response = cv2.phaseCorrelate(np.float32(image1_gray), np.float32(image2_gray))
-    
-    # Possibly switch the indexing of the shifts
-    shift = (shift[0], shift[1])
-    
-    return shift
+    # Single pair convenience wrapper. For many images against the same
+    # reference, create one PhaseCorrelator and use correlate_stack instead.
+    return PhaseCorrelator(image1).correlate(image2)
 
 def estimate_transformation(points_image, points_afm):
     transformation_matrix, inliers = cv2.estimateAffine2D(np.array(points_image), np.array(points_afm))
     return transformation_matrix
 
+class AdaptiveCalibrationPlanner:
+    # Picks calibration points from the full grid lattice incrementally. It
+    # starts with the corners and the centre, refits the affine transformation
+    # after every round and only asks for more points while the fit residual
+    # or the change of the fit between rounds is above the tolerance (in the
+    # units of the stage positions).
+    def __init__(self, x_positions, y_positions, tolerance, batch_size=4, min_points=5):
+        self.candidates = [(x, y) for x in x_positions for y in y_positions]
+        self.tolerance = tolerance
+        self.batch_size = batch_size
+        self.min_points = min_points
+        self.positions = []
+        self.shifts = []
+        self.matrix = None
+        self.residuals = None
+        self.fit_change = np.inf
+        self.rounds = 0
+
+    def initial_points(self):
+        candidates = np.array(self.candidates)
+        lower = candidates.min(axis=0)
+        upper = candidates.max(axis=0)
+        targets = [(lower[0], lower[1]), (lower[0], upper[1]), (upper[0], lower[1]), (upper[0], upper[1]),
+                   ((lower[0] + upper[0]) / 2, (lower[1] + upper[1]) / 2)]
+        points = []
+        for target in targets:
+            nearest = self.candidates[int(np.argmin(np.linalg.norm(candidates - target, axis=1)))]
+            if nearest not in points:
+                points.append(nearest)
+        return points
+
+    def remaining(self):
+        return [c for c in self.candidates if c not in self.positions]
+
+    def add_results(self, positions, shifts):
+        self.positions.extend(tuple(p) for p in positions)
+        self.shifts.extend(tuple(s) for s in shifts)
+        self.rounds += 1
+        if len(self.positions) < 3:
+            return
+
+        previous_matrix = self.matrix
+        self.matrix = estimate_transformation(self.shifts, self.positions)
+        if self.matrix is None:
+            return
+        fitted = CoordinateTransform(self.matrix)
+        self.residuals = np.linalg.norm(fitted.image2rl(self.shifts) - np.array(self.positions), axis=1)
+
+        # How far the new fit moves the predictions of the previous one,
+        # evaluated over the whole lattice
+        if previous_matrix is not None:
+            lattice = np.array(self.candidates)
+            predicted_shifts = CoordinateTransform(previous_matrix).rl2image(lattice)
+            self.fit_change = np.max(np.linalg.norm(fitted.image2rl(predicted_shifts) - lattice, axis=1))
+
+    @property
+    def converged(self):
+        return (self.residuals is not None and len(self.positions) >= self.min_points
+                and np.max(self.residuals) <= self.tolerance and self.fit_change <= self.tolerance)
+
+    @property
+    def exhausted(self):
+        return len(self.remaining()) == 0
+
+    def next_points(self):
+        # Greedy farthest point selection. The distance to the nearest
+        # measured point is weighted up where that point fits badly, so new
+        # points go where the fit is least certain.
+        remaining = self.remaining()
+        if not remaining:
+            return []
+        chosen = []
+        sampled = np.array(self.positions)
+        weights = np.ones(len(sampled))
+        if self.residuals is not None:
+            weights = 1 + self.residuals / self.tolerance
+        candidates = np.array(remaining)
+        for _ in range(min(self.batch_size, len(remaining))):
+            distances = np.linalg.norm(candidates[:, np.newaxis, :] - sampled[np.newaxis, :, :], axis=2)
+            nearest = np.argmin(distances, axis=1)
+            scores = distances[np.arange(len(candidates)), nearest] * weights[nearest]
+            for point in chosen:
+                scores[np.all(candidates == point, axis=1)] = -1
+            best = int(np.argmax(scores))
+            chosen.append(tuple(candidates[best]))
+            # The chosen point counts as sampled (with unit weight) from now on
+            sampled = np.vstack([sampled, candidates[best]])
+            weights = np.append(weights, 1)
+        return chosen
+
 def transform_coordinates(coord, transformation_matrix):
     coord = np.array([coord[0], coord[1], 1])
     transformed_coord = np.dot(transformation_matrix, coord)
     return transformed_coord[:2]
+
+def _tps_kernel(r):
+    # U(r) = r^2 log r, with U(0) = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r > 0, r * r * np.log(r), 0.0)
+
+class ThinPlateSpline:
+    # Smoothing thin-plate spline from 2D points to vector values. The points
+    # are normalised to a unit box so the system stays well conditioned for
+    # piezo coordinates in metres as well as for pixels. Without an explicit
+    # smoothing the one with the smallest leave-one-out error is used, so
+    # noise in the values is not mistaken for distortion. A plain affine fit
+    # competes in the same selection and is kept unless a spline beats it
+    # clearly, smoothing is inf in that case. With few points the error
+    # estimate is noisy itself, and on undistorted grids a spline can come
+    # out slightly ahead by chance.
+    SMOOTHING_CANDIDATES = np.logspace(-4, 3, 15)
+    # Fraction of the affine leave-one-out error a spline has to stay below
+    AFFINE_MARGIN = 0.5
+
+    def __init__(self, points, values, smoothing=None):
+        points = np.asarray(points, dtype=float)
+        values = np.asarray(values, dtype=float)
+        self.center = points.mean(axis=0)
+        self.scale = np.ptp(points, axis=0).max() or 1.0
+        self.nodes = (points - self.center) / self.scale
+
+        n = len(self.nodes)
+        system = np.zeros((n + 3, n + 3))
+        system[:n, :n] = _tps_kernel(np.linalg.norm(self.nodes[:, np.newaxis] - self.nodes[np.newaxis], axis=2))
+        system[:n, n] = 1
+        system[:n, n + 1:] = self.nodes
+        system[n:, :n] = system[:n, n:].T
+
+        best = None
+        if smoothing is None:
+            # Infinite smoothing leaves only the affine part
+            design = system[:n, n:]
+            inverse = np.linalg.pinv(design)
+            hat = design.dot(inverse)
+            leave_one_out = (values - hat.dot(values)) / np.maximum(1 - np.diag(hat), 1e-9)[:, np.newaxis]
+            best = (self.AFFINE_MARGIN * np.sum(leave_one_out ** 2), np.inf, np.vstack([np.zeros((n, values.shape[1])), inverse.dot(values)]))
+        for candidate in ([smoothing] if smoothing is not None else self.SMOOTHING_CANDIDATES):
+            smoothed = system.copy()
+            smoothed[:n, :n] += candidate * np.eye(n)
+            # Columns of the inverse that act on the values; the fitted
+            # values at the nodes are hat.dot(values)
+            inverse = np.linalg.pinv(smoothed)[:, :n]
+            hat = system[:n].dot(inverse)
+            leave_one_out = (values - hat.dot(values)) / np.maximum(1 - np.diag(hat), 1e-9)[:, np.newaxis]
+            error = np.sum(leave_one_out ** 2)
+            if best is None or error < best[0]:
+                best = (error, candidate, inverse.dot(values))
+        _, self.smoothing, solution = best
+        self.weights = solution[:n]
+        self.affine = solution[n:]
+
+    @property
+    def is_affine(self):
+        return np.isinf(self.smoothing)
+
+    def __call__(self, points):
+        points = (np.asarray(points, dtype=float) - self.center) / self.scale
+        kernel = _tps_kernel(np.linalg.norm(points[:, np.newaxis] - self.nodes[np.newaxis], axis=2))
+        return kernel.dot(self.weights) + self.affine[0] + points.dot(self.affine[1:])
+
+class _RemapTable:
+    # Values of a smooth 2D vector field sampled on a regular grid. Lookups
+    # are bilinear interpolations through cv2.remap, so their cost does not
+    # depend on how the field was computed. Outside the grid the border
+    # values are used.
+    MAX_POINTS = 32000  # cv2.remap maps are limited to SHRT_MAX rows
+
+    def __init__(self, field, lower, upper, size):
+        self.lower = np.asarray(lower, dtype=float)
+        self.step = (np.asarray(upper, dtype=float) - self.lower) / (size - 1)
+        x = self.lower[0] + self.step[0] * np.arange(size)
+        y = self.lower[1] + self.step[1] * np.arange(size)
+        grid = np.stack(np.meshgrid(x, y), axis=-1).reshape(-1, 2)
+        self.table = field(grid).reshape(size, size, -1).astype(np.float32)
+
+    def __call__(self, points):
+        coords = ((points - self.lower) / self.step).astype(np.float32)
+        result = np.empty((len(points), self.table.shape[2]))
+        for start in range(0, len(points), self.MAX_POINTS):
+            chunk = coords[start:start + self.MAX_POINTS]
+            result[start:start + len(chunk)] = cv2.remap(
+                self.table, chunk[:, :1], chunk[:, 1:], cv2.INTER_LINEAR,
+                borderMode=cv2.BORDER_REPLICATE).reshape(len(chunk), -1)
+        return result
+
+class DistortionModel:
+    # Non-linear mapping between calibration shifts (pixels relative to the
+    # reference snapshot) and piezo positions. A global affine fit is
+    # corrected by thin-plate splines fitted to its residuals in both
+    # directions. The splines are baked into lookup tables that cover the
+    # calibrated area plus a margin, so transforming points costs the same
+    # as with the affine model. If the splines do not predict left out
+    # points better than the affine fit, the affine fit is used on its own
+    # and kind says so.
+    def __init__(self, shifts, afm_positions, smoothing=None, table_size=65, margin=0.1):
+        shifts = np.asarray(shifts, dtype=float)
+        afm_positions = np.asarray(afm_positions, dtype=float)
+        if len(shifts) < 6:
+            raise ValueError("A distortion model needs at least 6 calibration points")
+        matrix = estimate_transformation(shifts, afm_positions)
+        if matrix is None:
+            raise ValueError("Affine calibration fit failed")
+        self.linear = CoordinateTransform(matrix)
+
+        forward = ThinPlateSpline(shifts, afm_positions - self.linear.image2rl(shifts), smoothing)
+        if forward.is_affine:
+            self.kind = 'affine'
+            self.forward_table = None
+            self.inverse_table = None
+        else:
+            self.kind = 'thin-plate spline'
+            inverse = ThinPlateSpline(afm_positions, shifts - self.linear.rl2image(afm_positions), smoothing)
+            self.forward_table = _RemapTable(forward, *self._bounds(shifts, margin), table_size)
+            self.inverse_table = _RemapTable(inverse, *self._bounds(afm_positions, margin), table_size)
+        self.residuals = np.linalg.norm(self.shift2rl(shifts) - afm_positions, axis=1)
+
+    @staticmethod
+    def _bounds(points, margin):
+        lower = points.min(axis=0)
+        upper = points.max(axis=0)
+        pad = margin * (upper - lower)
+        return lower - pad, upper + pad
+
+    def shift2rl(self, shifts):
+        shifts = np.atleast_2d(shifts)
+        if self.forward_table is None:
+            return self.linear.image2rl(shifts)
+        return self.linear.image2rl(shifts) + self.forward_table(shifts)
+
+    def rl2shift(self, positions):
+        positions = np.atleast_2d(positions)
+        if self.inverse_table is None:
+            return self.linear.rl2image(positions)
+        shifts = self.linear.rl2image(positions) + self.inverse_table(positions)
+        # One correction step with the affine Jacobian keeps both directions
+        # consistent with each other
+        return shifts + (positions - self.shift2rl(shifts)).dot(self.linear.inverse[:2, :2].T)
+
+class DistortionCorrectedTransform:
+    # Same interface as CoordinateTransform. The model works on shifts, so
+    # it does not depend on where the tip has been placed in the image.
+    def __init__(self, model, tip_in_image):
+        self.model = model
+        self.tip = np.asarray(tip_in_image, dtype=float)
+
+    def image2rl(self, points):
+        points = np.asarray(points, dtype=float)
+        return self.model.shift2rl(points - self.tip).reshape(points.shape)
+
+    def rl2image(self, points):
+        points = np.asarray(points, dtype=float)
+        return (self.model.rl2shift(points) + self.tip).reshape(points.shape)
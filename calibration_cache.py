@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk store for fitted calibrations, so a grid calibration can be reused
+across sessions as long as the optical setup has not changed.
+"""
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import cv2
+from calibration import preprocess_image, estimate_transformation, transform_coordinates
+
+
+CACHE_VERSION = 1
+
+
+def default_cache_path():
+    return os.path.join(os.path.expanduser("~"), ".bowstring", "calibration_cache.json")
+
+def reference_fingerprint(image, hash_size=8):
+    # Average hash of the cantilever mask. It only depends on the cantilever
+    # and the optics, not on the sample, so it identifies the setup across
+    # sessions while tolerating noise and small intensity changes.
+    small = cv2.resize(preprocess_image(image), (hash_size, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small > small.mean()).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+def fingerprint_distance(fingerprint1, fingerprint2):
+    return bin(int(fingerprint1, 16) ^ int(fingerprint2, 16)).count('1')
+
+def calibration_residuals(shifts, afm_positions):
+    # Distance between the measured stage positions and the affine fit. A
+    # constant offset of the shifts (the tip position) does not change them.
+    matrix = estimate_transformation(shifts, afm_positions)
+    if matrix is None:
+        return None
+    return [float(np.linalg.norm(transform_coordinates(shift, matrix) - np.array(afm)))
+            for shift, afm in zip(shifts, afm_positions)]
+
+def adjusted_shifts(entry, starting_tip_position):
+    # Shifts are measured relative to the reference snapshot, which was taken
+    # at the starting tip position of that session. Translate them to the
+    # current starting position with the linear part of the stored fit.
+    shifts = np.array(entry['shifts'], dtype=float)
+    offset = np.array(entry['starting_tip_position'], dtype=float) - np.array(starting_tip_position, dtype=float)
+    if not np.any(offset):
+        return [tuple(s) for s in shifts]
+    matrix = estimate_transformation(shifts, entry['afm_positions'])
+    stage_to_image = np.linalg.inv(matrix[:, :2])
+    shifts = shifts + stage_to_image.dot(offset)
+    return [tuple(s) for s in shifts]
+
+
+class CalibrationCache:
+    # Entries are keyed by magnification, pixel size, image size and the
+    # reference fingerprint. Only entries younger than max_age_days are
+    # offered.
+    def __init__(self, path=None, max_age_days=7, max_fingerprint_distance=10, max_entries=20):
+        self.path = default_cache_path() if path is None else path
+        self.max_age_days = max_age_days
+        self.max_fingerprint_distance = max_fingerprint_distance
+        self.max_entries = max_entries
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if data.get('version') != CACHE_VERSION:
+            return []
+        return data.get('entries', [])
+
+    def save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a broken cache
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'entries': entries}, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def matches(self, entry, magnification, pixel_size, image_size, fingerprint=None):
+        if not np.isclose(entry['magnification'], magnification, rtol=1e-6):
+            return False
+        if not np.isclose(entry['pixel_size'], pixel_size, rtol=1e-6):
+            return False
+        if list(entry['image_size']) != list(image_size):
+            return False
+        if fingerprint is not None and fingerprint_distance(entry['fingerprint'], fingerprint) > self.max_fingerprint_distance:
+            return False
+        return True
+
+    def is_valid(self, entry, now=None):
+        now = time.time() if now is None else now
+        return now - entry['created'] <= self.max_age_days * 24 * 3600
+
+    def lookup(self, magnification, pixel_size, image_size, fingerprint, now=None):
+        # Newest valid entry for this setup, or None
+        candidates = [entry for entry in self.load()
+                      if self.matches(entry, magnification, pixel_size, image_size, fingerprint)
+                      and self.is_valid(entry, now)]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda entry: entry['created'])
+
+    def store(self, magnification, pixel_size, image_size, fingerprint, shifts, afm_positions,
+              starting_tip_position, tip_position=None, calibration_matrix=None, grid_size=None):
+        residuals = calibration_residuals(shifts, afm_positions)
+        entry = {
+            'created': time.time(),
+            'magnification': float(magnification),
+            'pixel_size': float(pixel_size),
+            'image_size': [int(v) for v in image_size],
+            'fingerprint': fingerprint,
+            'grid_size': grid_size,
+            'shifts': [[float(v) for v in s] for s in shifts],
+            'afm_positions': [[float(v) for v in p] for p in afm_positions],
+            'starting_tip_position': [float(v) for v in starting_tip_position],
+            # Offset that turned the shifts into the transshifts of the fit
+            'tip_position': None if tip_position is None else [float(v) for v in tip_position],
+            'calibration_matrix': None if calibration_matrix is None else np.asarray(calibration_matrix).tolist(),
+            'residuals': residuals,
+            'rms_residual': None if residuals is None else float(np.sqrt(np.mean(np.square(residuals)))),
+        }
+
+        # A new calibration replaces older ones for the same setup
+        entries = [e for e in self.load()
+                   if not self.matches(e, magnification, pixel_size, image_size, fingerprint)
+                   and self.is_valid(e)]
+        entries.append(entry)
+        entries = sorted(entries, key=lambda e: e['created'])[-self.max_entries:]
+        try:
+            self.save(entries)
+        except OSError as e:
+            logging.error(f"Could not write calibration cache {self.path}: {e}")
+        return entry
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Single-file container for the snapshots of a grid calibration.
+
+Layout: an 8 byte magic, a fixed size JSON header (frame dtype and shape,
+grid indices, stage positions and which frames have been written), then the
+reference frame and all calibration frames as one raw, C-ordered array.
+The frames are memory-mapped, so a stored calibration can be sliced and
+re-correlated without decoding any image files.
+"""
+
+import os
+import json
+import numpy as np
+
+
+STACK_MAGIC = b'BSSTACK1'
+STACK_VERSION = 1
+# Reserved for the JSON header, so it can be rewritten in place while frames
+# are added. Data starts at a page aligned offset.
+HEADER_SIZE = 65536
+STACK_EXTENSION = '.bsstack'
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(STACK_MAGIC))
+        if magic != STACK_MAGIC:
+            raise ValueError(f"{path} is not a calibration stack")
+        raw = f.read(HEADER_SIZE - len(STACK_MAGIC))
+    header = json.loads(raw.rstrip(b'\0 ').decode('utf-8'))
+    if header.get('version') != STACK_VERSION:
+        raise ValueError(f"Unsupported calibration stack version {header.get('version')} in {path}")
+    return header
+
+def _encode_header(header):
+    raw = json.dumps(header).encode('utf-8')
+    if len(STACK_MAGIC) + len(raw) > HEADER_SIZE:
+        raise ValueError("Calibration stack header too large")
+    return STACK_MAGIC + raw.ljust(HEADER_SIZE - len(STACK_MAGIC), b' ')
+
+
+class CalibrationStackWriter:
+    # Preallocates the stack for all grid points of a calibration run. Frames
+    # may arrive in any order, each one is copied straight into the mapping.
+    def __init__(self, path, reference_image, afm_positions, grid_indices=None, metadata=None):
+        reference_image = np.asarray(reference_image)
+        if reference_image.ndim != 2:
+            raise ValueError("Calibration stacks hold single channel frames")
+        self.path = path
+        self.header = {
+            'version': STACK_VERSION,
+            'dtype': reference_image.dtype.str,
+            'frame_shape': list(reference_image.shape),
+            'num_frames': len(afm_positions),
+            'grid_indices': list(range(len(afm_positions))) if grid_indices is None else [int(i) for i in grid_indices],
+            'afm_positions': [[float(v) for v in p] for p in afm_positions],
+            'written': [False] * len(afm_positions),
+            'metadata': {} if metadata is None else metadata,
+        }
+        with open(path, 'wb') as f:
+            f.write(_encode_header(self.header))
+        shape = (len(afm_positions) + 1,) + reference_image.shape
+        self._data = np.memmap(path, dtype=reference_image.dtype, mode='r+', offset=HEADER_SIZE, shape=shape)
+        self._data[0] = reference_image
+
+    def write(self, idx, image):
+        if self._data is None:
+            raise ValueError(f"Calibration stack {self.path} is closed")
+        image = np.asarray(image)
+        if image.shape != self._data.shape[1:]:
+            raise ValueError(f"Frame {idx} has shape {image.shape}, expected {self._data.shape[1:]}")
+        self._data[idx + 1] = image
+        self.header['written'][idx] = True
+
+    def frame(self, idx):
+        return self._data[idx + 1]
+
+    @property
+    def complete(self):
+        return all(self.header['written'])
+
+    def close(self):
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data = None
+        with open(self.path, 'r+b') as f:
+            f.write(_encode_header(self.header))
+
+
+class CalibrationStack:
+    # Read-only, lazily loaded view of a stack file. Indexing returns
+    # memory-mapped frames, nothing is read from disk until it is used.
+    def __init__(self, path):
+        self.path = path
+        self.header = _read_header(path)
+        shape = (self.header['num_frames'] + 1,) + tuple(self.header['frame_shape'])
+        self._data = np.memmap(path, dtype=np.dtype(self.header['dtype']), mode='r', offset=HEADER_SIZE, shape=shape)
+
+    @property
+    def reference(self):
+        return self._data[0]
+
+    @property
+    def frames(self):
+        return self._data[1:]
+
+    @property
+    def afm_positions(self):
+        return [tuple(p) for p in self.header['afm_positions']]
+
+    @property
+    def grid_indices(self):
+        return self.header['grid_indices']
+
+    @property
+    def metadata(self):
+        return self.header['metadata']
+
+    @property
+    def complete(self):
+        return all(self.header['written'])
+
+    def __len__(self):
+        return self.header['num_frames']
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+
+def stack_path(folder, root_name):
+    return os.path.join(folder, root_name + STACK_EXTENSION)
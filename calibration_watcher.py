@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Watches the calibration snapshot folder and reports every
+calibration_image_<idx> as soon as it has been written completely, so the
+widget can correlate the images while the stage is still moving.
+"""
+
+import os
+import re
+import time
+import logging
+import PyQt5.QtCore as PyCore
+
+
+CALIBRATION_IMAGE_PATTERN = re.compile(r'^calibration_image_(\d+)\.(jpg|jpeg|png|tif|tiff)$', re.IGNORECASE)
+JPEG_END_OF_IMAGE = b'\xff\xd9'
+
+
+def is_jpeg_complete(path):
+    # A fully written JPEG ends with the EOI marker. Some encoders append
+    # padding, so look at the last few bytes rather than exactly the last two.
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < 4:
+                return False
+            f.seek(max(0, size - 16))
+            return JPEG_END_OF_IMAGE in f.read()
+    except OSError:
+        return False
+
+
+class CalibrationImageWatcher(PyCore.QObject):
+    # Emitted once per image with its grid index and path
+    image_ready = PyCore.pyqtSignal(int, str)
+    # Emitted when all expected images have been reported
+    finished = PyCore.pyqtSignal()
+    # Emitted with a reason ('timeout' or 'aborted') when watching stops early
+    failed = PyCore.pyqtSignal(str)
+
+    def __init__(self, folder, num_images, timeout=60, poll_interval=1000, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.num_images = num_images
+        # Seconds without a new image before giving up
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+        self.reported = set()
+        self._written = set()
+        self._sizes = {}
+        self._last_progress = time.monotonic()
+        self._running = False
+
+        # inotify (or the platform equivalent) through Qt. Network shares
+        # often do not deliver change events, so a timer keeps polling as a
+        # fallback and also drives the timeout.
+        self._fs_watcher = PyCore.QFileSystemWatcher(self)
+        self._fs_watcher.directoryChanged.connect(self.scan)
+        self._poll_timer = PyCore.QTimer(self)
+        self._poll_timer.timeout.connect(self._poll)
+
+    def start(self):
+        self._running = True
+        self._last_progress = time.monotonic()
+        if not self._fs_watcher.addPath(self.folder):
+            logging.debug(f"No file system events for {self.folder}, falling back to polling")
+        self._poll_timer.start(self.poll_interval)
+        self.scan()
+
+    def stop(self):
+        self._running = False
+        self._poll_timer.stop()
+        if self._fs_watcher.directories():
+            self._fs_watcher.removePaths(self._fs_watcher.directories())
+
+    def abort(self):
+        if not self._running:
+            return
+        self.stop()
+        self.failed.emit('aborted')
+
+    def image_written(self, idx):
+        # The instrument has confirmed that snapshot idx is saved, so it is
+        # reported without waiting for the next change event or poll
+        self._written.add(idx)
+        self.scan()
+
+    def _poll(self):
+        self.scan()
+        if self._running and time.monotonic() - self._last_progress > self.timeout:
+            logging.error(f"Calibration timed out after {self.timeout} s without a new image "
+                          f"({len(self.reported)}/{self.num_images} received)")
+            self.stop()
+            self.failed.emit('timeout')
+
+    def scan(self, *args):
+        if not self._running:
+            return
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError as e:
+            logging.debug(f"Could not scan {self.folder}: {e}")
+            return
+
+        pending = {}
+        for entry in entries:
+            match = CALIBRATION_IMAGE_PATTERN.match(entry.name)
+            if match is None:
+                continue
+            idx = int(match.group(1))
+            if idx not in self.reported:
+                pending[idx] = entry
+        if not pending:
+            return
+
+        highest_index = max(pending)
+        for idx in sorted(pending):
+            entry = pending[idx]
+            if self._is_complete(idx, entry, highest_index):
+                self.reported.add(idx)
+                self._sizes.pop(idx, None)
+                self._last_progress = time.monotonic()
+                self.image_ready.emit(idx, entry.path)
+
+        if len(self.reported) >= self.num_images:
+            self.stop()
+            self.finished.emit()
+
+    def _is_complete(self, idx, entry, highest_index):
+        try:
+            size = entry.stat().st_size
+        except OSError:
+            return False
+        if size == 0:
+            return False
+        # Snapshots are taken one after another, so a later image on disk
+        # means this one has been closed already.
+        if idx < highest_index or idx in self._written:
+            return True
+        if entry.name.lower().endswith(('.jpg', '.jpeg')):
+            return is_jpeg_complete(entry.path)
+        # Other formats: wait until the size is stable between two scans
+        previous_size = self._sizes.get(idx)
+        self._sizes[idx] = size
+        return previous_size == size
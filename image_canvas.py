@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+Scene based image canvas for the Bowstring widget. The microscope image and
+all overlays are persistent QGraphicsItems that are updated in place, so
+only the changed items are repainted and the user points can be dragged.
+The image is rendered from a tiled pyramid, so zooming and panning large
+frames only ever uploads and paints the visible tiles.
+"""
+
+import math
+from collections import OrderedDict
+import numpy as np
+import cv2
+import PyQt5.QtGui as PyGui
+import PyQt5.QtWidgets as PyWidgets
+import PyQt5.QtCore as PyCore
+from calibration import load_image
+
+
+class TiledImageItem(PyWidgets.QGraphicsItem):
+    # Image pyramid in full resolution scene coordinates. Every pyramid
+    # level halves the resolution and is only built when a zoom level needs
+    # it. Tiles are converted to pixmaps on first use and kept in an LRU
+    # cache.
+    TileSize = 512
+    MaxCachedTiles = 256
+
+    def __init__(self, Path):
+        super().__init__()
+        self.setFlag(PyWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+        Image = load_image(Path)
+        if Image is None:
+            raise ValueError(f"Could not load image {Path}")
+        self.Levels = [self.display_image(Image)]
+        self.Tiles = OrderedDict()
+
+    @staticmethod
+    def display_image(Image):
+        # 8 bit RGB for display. Deeper images are stretched to their own
+        # range, 12 bit cameras rarely fill a 16 bit container.
+        if Image.dtype != np.uint8:
+            Image = cv2.normalize(Image, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        if Image.ndim == 2:
+            return cv2.cvtColor(Image, cv2.COLOR_GRAY2RGB)
+        return cv2.cvtColor(Image, cv2.COLOR_BGR2RGB)
+
+    @property
+    def Width(self):
+        return self.Levels[0].shape[1]
+
+    @property
+    def Height(self):
+        return self.Levels[0].shape[0]
+
+    def boundingRect(self):
+        return PyCore.QRectF(0, 0, self.Width, self.Height)
+
+    def level(self, Index):
+        while len(self.Levels) <= Index:
+            self.Levels.append(cv2.pyrDown(self.Levels[-1]))
+        return self.Levels[Index]
+
+    def max_level(self):
+        return max(0, int(math.log2(max(self.Width, self.Height) / self.TileSize)) + 1)
+
+    def tile(self, Level, Column, Row):
+        Key = (Level, Column, Row)
+        Pixmap = self.Tiles.get(Key)
+        if Pixmap is not None:
+            self.Tiles.move_to_end(Key)
+            return Pixmap
+        # One extra row and column overlap with the neighbours, so smooth
+        # scaling has valid pixels to interpolate with at the tile edges
+        Data = np.ascontiguousarray(self.level(Level)[Row * self.TileSize:(Row + 1) * self.TileSize + 1,
+                                                      Column * self.TileSize:(Column + 1) * self.TileSize + 1])
+        Image = PyGui.QImage(Data.data, Data.shape[1], Data.shape[0], Data.strides[0], PyGui.QImage.Format_RGB888)
+        Pixmap = PyGui.QPixmap.fromImage(Image)
+        self.Tiles[Key] = Pixmap
+        if len(self.Tiles) > self.MaxCachedTiles:
+            self.Tiles.popitem(last=False)
+        return Pixmap
+
+    def paint(self, painter, option, widget=None):
+        # Coarsest level that still has at least one image pixel per screen
+        # pixel
+        Detail = option.levelOfDetailFromTransform(painter.worldTransform())
+        Level = 0 if Detail >= 1 else min(int(math.log2(1 / Detail)), self.max_level())
+        Scale = 2 ** Level
+        Step = self.TileSize * Scale
+
+        Exposed = option.exposedRect.intersected(self.boundingRect())
+        LevelImage = self.level(Level)
+        painter.save()
+        # Antialiased tile edges would let the background shine through
+        painter.setRenderHint(PyGui.QPainter.Antialiasing, False)
+        painter.setRenderHint(PyGui.QPainter.SmoothPixmapTransform, Detail < 1)
+        for Row in range(int(Exposed.top() // Step), int(math.ceil(Exposed.bottom() / Step))):
+            for Column in range(int(Exposed.left() // Step), int(math.ceil(Exposed.right() / Step))):
+                Pixmap = self.tile(Level, Column, Row)
+                Width = min(self.TileSize, LevelImage.shape[1] - Column * self.TileSize)
+                Height = min(self.TileSize, LevelImage.shape[0] - Row * self.TileSize)
+                # Target rectangle in full resolution coordinates, the
+                # coarse levels are scaled up by the painter
+                Target = PyCore.QRectF(Column * Step, Row * Step, Width * Scale, Height * Scale)
+                painter.drawPixmap(Target, Pixmap, PyCore.QRectF(0, 0, Width, Height))
+        painter.restore()
+
+class PointMarker(PyWidgets.QGraphicsItem):
+    # Red crosshair with a gap around the point. It keeps its size on screen
+    # and reports every move to the canvas.
+    Dist = 6
+    Len = 6
+
+    def __init__(self, Canvas, Index):
+        super().__init__()
+        self.Canvas = Canvas
+        self.Index = Index
+        self.Pen = PyGui.QPen(PyCore.Qt.red, 3)
+        self.setFlags(PyWidgets.QGraphicsItem.ItemIsMovable |
+                      PyWidgets.QGraphicsItem.ItemSendsGeometryChanges |
+                      PyWidgets.QGraphicsItem.ItemIgnoresTransformations)
+        self.setCursor(PyCore.Qt.SizeAllCursor)
+        self.setZValue(10)
+
+    def boundingRect(self):
+        Extent = self.Dist + self.Len + self.Pen.widthF()
+        return PyCore.QRectF(-Extent, -Extent, 2 * Extent, 2 * Extent)
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self.Pen)
+        painter.setRenderHint(PyGui.QPainter.Antialiasing)
+        DistLen = self.Dist + self.Len
+        painter.drawPoint(PyCore.QPointF(0, 0))
+        painter.drawLine(PyCore.QPointF(-DistLen, 0), PyCore.QPointF(-self.Dist, 0))
+        painter.drawLine(PyCore.QPointF(DistLen, 0), PyCore.QPointF(self.Dist, 0))
+        painter.drawLine(PyCore.QPointF(0, -DistLen), PyCore.QPointF(0, -self.Dist))
+        painter.drawLine(PyCore.QPointF(0, DistLen), PyCore.QPointF(0, self.Dist))
+
+    def itemChange(self, change, value):
+        if change == PyWidgets.QGraphicsItem.ItemPositionHasChanged and not self.Canvas.Updating:
+            self.Canvas.point_moved.emit(self.Index, self.pos().x(), self.pos().y())
+        return super().itemChange(change, value)
+
+
+class ImageCanvas(PyWidgets.QGraphicsView):
+    # Emitted with image coordinates when the image is clicked outside of
+    # any user point
+    clicked = PyCore.pyqtSignal(float, float)
+    # Emitted with the index and the new image coordinates of a dragged point
+    point_moved = PyCore.pyqtSignal(int, float, float)
+
+    # Zoom limits relative to the full resolution image
+    MinZoom = 1 / 64
+    MaxZoom = 16
+    ZoomStep = 1.25
+
+    def __init__(self, Path, parent=None):
+        super().__init__(parent)
+        self.Scene = PyWidgets.QGraphicsScene(self)
+        # Thousands of scratch lines are moved on every update, keeping a BSP
+        # tree for them up to date costs more than it saves
+        self.Scene.setItemIndexMethod(PyWidgets.QGraphicsScene.NoIndex)
+        self.setScene(self.Scene)
+        self.setAlignment(PyCore.Qt.AlignHCenter | PyCore.Qt.AlignTop)
+        self.setRenderHint(PyGui.QPainter.Antialiasing)
+        self.setViewportUpdateMode(PyWidgets.QGraphicsView.SmartViewportUpdate)
+        self.setTransformationAnchor(PyWidgets.QGraphicsView.AnchorUnderMouse)
+        self.Updating = False
+        self.PanStart = None
+
+        # The image is decoded once
+        self.ImageItem = TiledImageItem(Path)
+        self.ImageItem.setZValue(-1)
+        self.Scene.addItem(self.ImageItem)
+        self.Scene.setSceneRect(self.ImageItem.boundingRect())
+        self.setToolTip('Wheel: zoom, right or middle drag: pan, F: fit, 1: full resolution')
+
+        self.AreaItem = self.Scene.addPath(PyGui.QPainterPath(), self.cosmetic_pen(PyCore.Qt.cyan, 4))
+        self.BowItem = self.Scene.addPath(PyGui.QPainterPath(), self.cosmetic_pen(PyCore.Qt.green, 2))
+        self.BowBufferItem = self.Scene.addLine(PyCore.QLineF(), self.cosmetic_pen(PyCore.Qt.green, 1, PyCore.Qt.DashLine))
+        self.QueueItem = self.Scene.addPath(PyGui.QPainterPath(), self.cosmetic_pen(PyCore.Qt.yellow, 2))
+        # Tip position found by the live view, a circle of constant size
+        TipPath = PyGui.QPainterPath()
+        TipPath.addEllipse(PyCore.QPointF(0, 0), 10, 10)
+        TipPath.moveTo(-14, 0)
+        TipPath.lineTo(14, 0)
+        TipPath.moveTo(0, -14)
+        TipPath.lineTo(0, 14)
+        self.TrackedTipItem = self.Scene.addPath(TipPath, self.cosmetic_pen(PyCore.Qt.magenta, 2))
+        self.TrackedTipItem.setFlag(PyWidgets.QGraphicsItem.ItemIgnoresTransformations)
+        self.TrackedTipItem.setZValue(5)
+        self.ScratchPen = self.cosmetic_pen(PyCore.Qt.darkGreen, 1)
+        self.HighlightPen = self.cosmetic_pen(PyCore.Qt.red, 1)
+        self.ScratchItems = []
+        self.Markers = []
+        self.LayerItems = {
+            'Accessible Area': [self.AreaItem],
+            'Bowstring Geometry': [self.BowItem, self.BowBufferItem],
+            'Fibril Queue': [self.QueueItem],
+            'Tracked Tip': [self.TrackedTipItem],
+        }
+        for Item in [self.AreaItem, self.BowItem, self.BowBufferItem, self.QueueItem, self.TrackedTipItem]:
+            Item.setVisible(False)
+
+    @staticmethod
+    def cosmetic_pen(Color, Width, Style=PyCore.Qt.SolidLine):
+        # Line widths in screen pixels, independent of the zoom
+        Pen = PyGui.QPen(Color, Width, Style)
+        Pen.setCosmetic(True)
+        return Pen
+
+    @staticmethod
+    def polyline(Points, Closed=False):
+        Path = PyGui.QPainterPath(PyCore.QPointF(*Points[0]))
+        for P in Points[1:]:
+            Path.lineTo(PyCore.QPointF(*P))
+        if Closed:
+            Path.closeSubpath()
+        return Path
+
+    def set_layer(self, PaintedObject, PointList, Highlight=None):
+        # Highlight optionally flags scratch lines to draw in red
+        Points = np.asarray(PointList, dtype=float).reshape(-1, 2)
+        if len(Points) == 0:
+            self.clear_layer(PaintedObject)
+            return
+        self.Updating = True
+        if PaintedObject == 'User Points':
+            self.set_markers(Points)
+        elif PaintedObject == 'Accessible Area':
+            self.AreaItem.setPath(self.polyline(Points, Closed=True))
+            self.AreaItem.setVisible(True)
+        elif PaintedObject == 'Bowstring Geometry':
+            # Anchor1, Anchor2, final strain point, half point, buffer point
+            Path = self.polyline(Points[[0, 1, 2, 0]])
+            Path.moveTo(PyCore.QPointF(*Points[3]))
+            Path.lineTo(PyCore.QPointF(*Points[2]))
+            self.BowItem.setPath(Path)
+            self.BowBufferItem.setLine(PyCore.QLineF(*Points[4], *Points[3]))
+            self.BowItem.setVisible(True)
+            self.BowBufferItem.setVisible(True)
+        elif PaintedObject == 'Fibril Queue':
+            # Anchor pairs of the queued fibrils
+            Path = PyGui.QPainterPath()
+            for Anchor1, Anchor2 in Points[:len(Points) // 2 * 2].reshape(-1, 2, 2):
+                Path.moveTo(PyCore.QPointF(*Anchor1))
+                Path.lineTo(PyCore.QPointF(*Anchor2))
+            self.QueueItem.setPath(Path)
+            self.QueueItem.setVisible(True)
+        elif PaintedObject == 'Tracked Tip':
+            self.TrackedTipItem.setPos(PyCore.QPointF(*Points[0]))
+            self.TrackedTipItem.setVisible(True)
+        elif PaintedObject == 'Scratch-Off Geometry':
+            # First half are the final strain points, second half the
+            # matching buffer points
+            Half = len(Points) // 2
+            self.set_scratch_lines(np.hstack([Points[:Half], Points[Half:2 * Half]]), Highlight)
+        self.Updating = False
+
+    def clear_layer(self, PaintedObject):
+        if PaintedObject == 'User Points':
+            self.set_markers(np.empty((0, 2)))
+        elif PaintedObject == 'Scratch-Off Geometry':
+            self.set_scratch_lines(np.empty((0, 4)))
+        else:
+            for Item in self.LayerItems[PaintedObject]:
+                Item.setVisible(False)
+
+    def set_markers(self, Points):
+        while len(self.Markers) < len(Points):
+            Marker = PointMarker(self, len(self.Markers))
+            self.Scene.addItem(Marker)
+            self.Markers.append(Marker)
+        for Marker, P in zip(self.Markers, Points):
+            if Marker.pos() != PyCore.QPointF(*P):
+                Marker.setPos(*P)
+            Marker.setVisible(True)
+        for Marker in self.Markers[len(Points):]:
+            Marker.setVisible(False)
+
+    def set_scratch_lines(self, Lines, Highlight=None):
+        # Line items are kept in a pool and only moved, shown or hidden
+        while len(self.ScratchItems) < len(Lines):
+            Item = self.Scene.addLine(PyCore.QLineF(), self.ScratchPen)
+            self.ScratchItems.append(Item)
+        if Highlight is None:
+            Highlight = np.zeros(len(Lines), dtype=bool)
+        for Item, L, Flagged in zip(self.ScratchItems, Lines.tolist(), Highlight.tolist()):
+            Line = PyCore.QLineF(*L)
+            if Item.line() != Line:
+                Item.setLine(Line)
+            Pen = self.HighlightPen if Flagged else self.ScratchPen
+            if Item.pen() != Pen:
+                Item.setPen(Pen)
+            if not Item.isVisible():
+                Item.setVisible(True)
+        for Item in self.ScratchItems[len(Lines):]:
+            if not Item.isVisible():
+                break
+            Item.setVisible(False)
+
+    def sizeHint(self):
+        # Ask for the image at 1:1 like the plain label did, but not for
+        # more than a typical screen, large frames are zoomed and panned
+        Frame = 2 * self.frameWidth()
+        Size = self.sceneRect().size().toSize().boundedTo(PyCore.QSize(1600, 1200))
+        return Size + PyCore.QSize(Frame, Frame)
+
+    def zoom(self):
+        return self.transform().m11()
+
+    def zoom_by(self, Factor):
+        Factor = min(max(self.zoom() * Factor, self.MinZoom), self.MaxZoom) / self.zoom()
+        self.scale(Factor, Factor)
+
+    def fit_image(self):
+        self.fitInView(self.sceneRect(), PyCore.Qt.KeepAspectRatio)
+
+    def fit_if_larger(self):
+        # Large frames start out fitted to the view, small ones at 1:1
+        Viewport = self.viewport().size()
+        if self.sceneRect().width() > Viewport.width() or self.sceneRect().height() > Viewport.height():
+            self.fit_image()
+
+    def wheelEvent(self, event):
+        Steps = event.angleDelta().y() / 120
+        if Steps:
+            self.zoom_by(self.ZoomStep ** Steps)
+
+    def keyPressEvent(self, event):
+        if event.key() == PyCore.Qt.Key_F:
+            self.fit_image()
+        elif event.key() == PyCore.Qt.Key_1:
+            self.resetTransform()
+        elif event.key() in (PyCore.Qt.Key_Plus, PyCore.Qt.Key_Equal):
+            self.zoom_by(self.ZoomStep)
+        elif event.key() == PyCore.Qt.Key_Minus:
+            self.zoom_by(1 / self.ZoomStep)
+        else:
+            super().keyPressEvent(event)
+
+    def mousePressEvent(self, event):
+        # Left clicks set points, the middle or right button pans
+        if event.button() in (PyCore.Qt.MiddleButton, PyCore.Qt.RightButton):
+            self.PanStart = event.pos()
+            self.viewport().setCursor(PyCore.Qt.ClosedHandCursor)
+            return
+        if event.button() == PyCore.Qt.LeftButton and not isinstance(self.itemAt(event.pos()), PointMarker):
+            # Scene coordinates are full resolution image coordinates at
+            # any zoom
+            ScenePos = self.mapToScene(event.pos())
+            if self.sceneRect().contains(ScenePos):
+                self.clicked.emit(ScenePos.x(), ScenePos.y())
+            return
+        super().mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self.PanStart is not None:
+            Delta = event.pos() - self.PanStart
+            self.PanStart = event.pos()
+            self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() - Delta.x())
+            self.verticalScrollBar().setValue(self.verticalScrollBar().value() - Delta.y())
+            return
+        super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if self.PanStart is not None and event.button() in (PyCore.Qt.MiddleButton, PyCore.Qt.RightButton):
+            self.PanStart = None
+            self.viewport().unsetCursor()
+            return
+        super().mouseReleaseEvent(event)
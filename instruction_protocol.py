@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Framing of the instruction blocks the BowstringWidget writes to stdout and
+BowString.py reads in the JPK Experiment Planner.
+
+Shared by both ends, so it has to run under Jython 2.7 as well as Python 3
+and only uses the standard library. A block is a header line followed by a
+settings line, one line per point and a trailer:
+
+    BSI;<version>;<number of lines up to the trailer>;<block id>
+    S;<mode>;<record real time scan>;<record video>;<nth frame>[;...]*<crc32>
+    <x>;<y>;<velocity>;<holding time>;<A|R>*<crc32>
+    E;<crc32 of the settings and point lines>*<crc32>
+
+Every line carries the CRC32 of its payload. The parser checks each line as
+soon as it arrives, so a corrupt or truncated block is rejected before the
+rest of it is read, and points can be executed while the block is still
+being received. The trailer confirms that no line has gone missing.
+
+The instrument script reports back over a local TCP connection. The widget
+announces the port on stdout and the script sends one event per line, each
+naming the block by the id in its header:
+
+    BSC;<version>;<port>
+    EVT;<kind>;<block>[;<field>...]*<crc32>
+"""
+
+import random
+import socket
+import zlib
+
+
+PROTOCOL_VERSION = 2
+HEADER = 'BSI'
+SETTINGS = 'S'
+TRAILER = 'E'
+
+STATES = {'Approached': 'A', 'Retracted': 'R'}
+STATE_NAMES = dict((code, name) for name, code in STATES.items())
+LEGACY_STATES = dict((name, name) for name in STATES)
+
+# Events of the streaming parser
+BLOCK_SETTINGS = 'settings'
+BLOCK_POINT = 'point'
+BLOCK_END = 'end'
+
+CHANNEL = 'BSC'
+EVENT = 'EVT'
+
+# Events of the return channel and their fields
+EVENT_STARTED = 'started'    # number of points
+EVENT_POINT = 'point'        # index, seconds since the start
+EVENT_FAILED = 'failed'      # index, message
+EVENT_FINISHED = 'finished'  # seconds since the start
+EVENT_REJECTED = 'rejected'  # message
+EVENTS = (EVENT_STARTED, EVENT_POINT, EVENT_FAILED, EVENT_FINISHED, EVENT_REJECTED)
+
+# Blocks of widgets from before the framing was introduced
+LEGACY_START = 'InstructionStart'
+LEGACY_END = 'InstructionEnd'
+
+
+class ProtocolError(ValueError):
+    # block_id names the damaged block if its header has been read
+    def __init__(self, message, block_id=''):
+        ValueError.__init__(self, message)
+        self.block_id = block_id
+
+
+def _crc32(text, value=0):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return zlib.crc32(text, value) & 0xffffffff
+
+
+def _point_payload(point):
+    x, y, velocity, holding_time, state = point
+    try:
+        code = STATES[state]
+    except KeyError:
+        raise ProtocolError('Unknown tip state %r' % (state,))
+    # repr keeps the full precision of the doubles
+    return '%r;%r;%r;%r;%s' % (float(x), float(y), float(velocity), float(holding_time), code)
+
+
+def _line(payload):
+    return '%s*%08x' % (payload, _crc32(payload))
+
+
+def new_block_id():
+    return '%08x' % random.getrandbits(32)
+
+
+def iter_block(settings, points, num_points=None, block=None):
+    # settings: mode followed by its options, points: rows of
+    # x, y, velocity, holding time and 'Approached' or 'Retracted'.
+    # Yields the lines of the block without line breaks. With num_points
+    # given, points may be a generator and every line is produced as soon
+    # as its point is, so long programs can be sent while they are built.
+    fields = [str(S) for S in settings]
+    for S in fields:
+        if ';' in S or '*' in S or '\n' in S:
+            raise ProtocolError('Setting %r contains a reserved character' % S)
+    if num_points is None:
+        points = list(points)
+        num_points = len(points)
+    if block is None:
+        block = new_block_id()
+    yield '%s;%d;%d;%s' % (HEADER, PROTOCOL_VERSION, num_points + 1, block)
+
+    payload = ';'.join([SETTINGS] + fields)
+    block_crc = _crc32(payload + '\n')
+    yield _line(payload)
+    sent = 0
+    for P in points:
+        payload = _point_payload(P)
+        block_crc = _crc32(payload + '\n', block_crc)
+        sent += 1
+        yield _line(payload)
+    if sent != num_points:
+        raise ProtocolError('Block announced %d points but has %d' % (num_points, sent))
+    yield _line('%s;%08x' % (TRAILER, block_crc))
+
+
+def encode_block(settings, points, block=None):
+    return list(iter_block(settings, points, block=block))
+
+
+def block_id(lines):
+    # The id from the header names the block in events
+    return lines[0].split(';')[3]
+
+
+def decode_block(lines):
+    # Parses a complete block, e.g. from a log file
+    parser = InstructionParser()
+    for line in lines:
+        block = parser.feed(line)
+        if block is not None:
+            return block
+    raise ProtocolError('Block is incomplete')
+
+
+class InstructionParser(object):
+    # Reads the widget output line by line. Lines outside of a block, e.g.
+    # log output, are ignored. A damaged block raises ProtocolError and the
+    # parser waits for the next header. block_id names the block read last,
+    # it is empty for unframed blocks.
+    def __init__(self):
+        self.block_id = ''
+        self._block = None
+        self.reset()
+
+    def reset(self):
+        self._expected = None
+        self._received = 0
+        self._block_crc = 0
+        self._settings_read = False
+        self._legacy = False
+
+    @property
+    def in_block(self):
+        return self._expected is not None or self._legacy
+
+    def feed(self, line):
+        # Returns (settings, points) once a block is complete, None otherwise
+        event = self.read(line)
+        if event is None:
+            return None
+        if event[0] == BLOCK_SETTINGS:
+            self._block = (event[1], [])
+        elif event[0] == BLOCK_POINT:
+            self._block[1].append(event[1])
+        elif event[0] == BLOCK_END:
+            block = self._block
+            self._block = None
+            return block
+        return None
+
+    def read(self, line):
+        # Streaming interface, returns one event per line or None:
+        # (BLOCK_SETTINGS, settings, block id, number of points or None),
+        # (BLOCK_POINT, point) and (BLOCK_END, block id). Each point is
+        # checked on its own, the block as a whole only at its end.
+        line = line.rstrip('\r\n')
+        if line.startswith(HEADER + ';'):
+            interrupted = self.block_id if self.in_block else None
+            self.reset()
+            self._start(line)
+            if interrupted is not None:
+                raise ProtocolError('Block was truncated by the next header', interrupted)
+            return None
+        if self._legacy:
+            return self._read_legacy(line)
+        if self._expected is None:
+            if line == LEGACY_START:
+                self.block_id = ''
+                self._legacy = True
+            return None
+
+        payload, separator, crc = line.rpartition('*')
+        try:
+            valid = bool(separator) and int(crc, 16) == _crc32(payload)
+        except ValueError:
+            valid = False
+        if not valid:
+            self._fail('Checksum mismatch in line %d of the block' % (self._received + 1))
+
+        if self._received == self._expected:
+            # Trailer with the checksum of all lines
+            fields = payload.split(';')
+            if len(fields) != 2 or fields[0] != TRAILER or fields[1] != '%08x' % self._block_crc:
+                self._fail('Block checksum mismatch')
+            block = self.block_id
+            self.reset()
+            return (BLOCK_END, block)
+
+        self._block_crc = _crc32(payload + '\n', self._block_crc)
+        self._received += 1
+        fields = payload.split(';')
+        if not self._settings_read:
+            if fields[0] != SETTINGS or len(fields) < 5:
+                self._fail('Block does not start with its settings')
+            self._settings_read = True
+            return (BLOCK_SETTINGS, fields[1:], self.block_id, self._expected - 1)
+        if fields[0] == TRAILER:
+            self._fail('Block ended after %d of %d lines' % (self._received - 1, self._expected))
+        return (BLOCK_POINT, self._parse_point(fields, STATE_NAMES))
+
+    def _start(self, header):
+        fields = header.split(';')
+        self.block_id = fields[3] if len(fields) > 3 else ''
+        try:
+            version, count = int(fields[1]), int(fields[2])
+        except (IndexError, ValueError):
+            raise ProtocolError('Malformed header %r' % header, self.block_id)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError('Unsupported protocol version %d' % version, self.block_id)
+        if count < 1:
+            raise ProtocolError('Block without settings', self.block_id)
+        self._expected = count
+
+    def _fail(self, message):
+        self.reset()
+        raise ProtocolError(message, self.block_id)
+
+    def _parse_point(self, fields, states):
+        if len(fields) != 5 or fields[4] not in states:
+            self._fail('Malformed point %r' % ';'.join(fields))
+        try:
+            return [float(fields[0]), float(fields[1]), float(fields[2]), float(fields[3]), states[fields[4]]]
+        except ValueError:
+            self._fail('Malformed point %r' % ';'.join(fields))
+
+    def _read_legacy(self, line):
+        # Unframed block between InstructionStart and InstructionEnd with
+        # spelled out tip states and no checksums
+        if line == LEGACY_START:
+            self.reset()
+            self._legacy = True
+            return None
+        if line == LEGACY_END:
+            if not self._settings_read:
+                self._fail('Block does not start with its settings')
+            self.reset()
+            return (BLOCK_END, '')
+        fields = line.split(';')
+        if not self._settings_read:
+            if len(fields) < 4:
+                self._fail('Block does not start with its settings')
+            self._settings_read = True
+            return (BLOCK_SETTINGS, fields, '', None)
+        return (BLOCK_POINT, self._parse_point(fields, LEGACY_STATES))
+
+
+def encode_announcement(port):
+    return '%s;%d;%d' % (CHANNEL, PROTOCOL_VERSION, port)
+
+
+def parse_announcement(line):
+    # Port of the widget's return channel, None for any other line
+    fields = line.rstrip('\r\n').split(';')
+    if len(fields) != 3 or fields[0] != CHANNEL or fields[1] != str(PROTOCOL_VERSION):
+        return None
+    try:
+        return int(fields[2])
+    except ValueError:
+        return None
+
+
+def _field(value):
+    return str(value).replace(';', ',').replace('*', ' ').replace('\r', ' ').replace('\n', ' ')
+
+
+def encode_event(kind, block, *fields):
+    payload = ';'.join([EVENT, kind, block] + [_field(F) for F in fields])
+    return '%s*%08x' % (payload, _crc32(payload))
+
+
+def decode_event(line):
+    # Returns kind, block and the fields as strings
+    payload, separator, crc = line.rstrip('\r\n').rpartition('*')
+    try:
+        valid = bool(separator) and int(crc, 16) == _crc32(payload)
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ProtocolError('Checksum mismatch in event %r' % line)
+    fields = payload.split(';')
+    if len(fields) < 3 or fields[0] != EVENT or fields[1] not in EVENTS:
+        raise ProtocolError('Malformed event %r' % line)
+    return fields[1], fields[2], fields[3:]
+
+
+class EventSender(object):
+    # Instrument side of the return channel. Sending never raises, the
+    # program keeps running if the widget has gone away. Events go to the
+    # block set in block.
+    def __init__(self):
+        self.block = ''
+        self._socket = None
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    def connect(self, port, host='127.0.0.1', timeout=5.0):
+        self.close()
+        try:
+            self._socket = socket.create_connection((host, port), timeout)
+        except socket.error as e:
+            print('Could not connect to the widget on port %d: %s' % (port, e))
+            self._socket = None
+        return self.connected
+
+    def send(self, kind, *fields):
+        if self._socket is None:
+            return
+        try:
+            self._socket.sendall((encode_event(kind, self.block, *fields) + '\n').encode('utf-8'))
+        except socket.error:
+            self.close()
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
+            self._socket = None
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Stands in for stdout, which the widget shares between its log output and
+the instruction blocks for BowString.py.
+
+The instrument script reads only a few points ahead of the stage, so
+writing a long block takes about as long as executing it. Everything
+written to stdout is therefore passed on to one writer thread: neither the
+GUI nor a logging worker waits for the stage, and text written while a
+block is being sent follows its trailer instead of ending up inside it.
+"""
+
+import queue
+import threading
+
+
+class InstructionWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='InstructionWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self, name):
+        # encoding, isatty() etc. of the wrapped stream
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        self._queue.put((text, None, None))
+        return len(text)
+
+    def flush(self):
+        # The writer thread flushes after every write
+        pass
+
+    def write_block(self, lines, chunk_size, on_error=None):
+        # lines: iterator over the lines of one block, e.g. from iter_block.
+        # They are produced on the writer thread and written chunk_size at a
+        # time. on_error(message) is called from the writer thread if the
+        # block could not be written completely.
+        self._queue.put((lines, chunk_size, on_error))
+
+    def close(self):
+        # Writes out everything queued so far, e.g. at exit
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            lines, chunk_size, on_error = item
+            if chunk_size is None:
+                try:
+                    self._write(lines)
+                except Exception:
+                    # Log output has nowhere else to go
+                    pass
+                continue
+            chunk = []
+            try:
+                for line in lines:
+                    chunk.append(line)
+                    if len(chunk) >= chunk_size:
+                        self._write('\n'.join(chunk) + '\n')
+                        chunk = []
+                if chunk:
+                    self._write('\n'.join(chunk) + '\n')
+            except Exception as error:
+                if on_error is not None:
+                    on_error('%s: %s' % (type(error).__name__, error))
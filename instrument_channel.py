@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Widget side of the return channel from BowString.py. A local TCP server
+receives the events the instrument script sends while it executes a block
+and hands them on as signals on the GUI thread.
+"""
+
+import logging
+import PyQt5.QtCore as PyCore
+import PyQt5.QtNetwork as PyNetwork
+from instruction_protocol import (ProtocolError, decode_event, EVENT_STARTED, EVENT_POINT, EVENT_FAILED,
+                                  EVENT_FINISHED, EVENT_REJECTED)
+
+
+class InstrumentChannel(PyCore.QObject):
+    # All signals name the block by its id from the header
+    # Number of points
+    program_started = PyCore.pyqtSignal(str, int)
+    # Index of the point and seconds since the start
+    point_done = PyCore.pyqtSignal(str, int, float)
+    # Index of the point and the error of the instrument
+    point_failed = PyCore.pyqtSignal(str, int, str)
+    # Seconds since the start
+    program_finished = PyCore.pyqtSignal(str, float)
+    # Reason why the block has not been executed
+    program_rejected = PyCore.pyqtSignal(str, str)
+    # The instrument script has closed the connection
+    disconnected = PyCore.pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.server = PyNetwork.QTcpServer(self)
+        self.server.newConnection.connect(self._accept)
+        self.connection = None
+
+    def listen(self):
+        # Port to announce to the instrument script, None if the server
+        # could not be started
+        if not self.server.listen(PyNetwork.QHostAddress.LocalHost, 0):
+            logging.error(f"Could not open the instrument channel: {self.server.errorString()}")
+            return None
+        return self.server.serverPort()
+
+    @property
+    def connected(self):
+        return self.connection is not None
+
+    def _accept(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            # Only the latest script run reports back
+            if self.connection is not None:
+                self.connection.disconnected.disconnect(self._on_disconnected)
+                self.connection.disconnectFromHost()
+            self.connection = connection
+            connection.readyRead.connect(self._read)
+            connection.disconnected.connect(self._on_disconnected)
+            logging.info("Instrument script connected")
+
+    def _on_disconnected(self):
+        if self.sender() is self.connection:
+            self.connection.deleteLater()
+            self.connection = None
+            logging.info("Instrument script disconnected")
+            self.disconnected.emit()
+
+    def _read(self):
+        connection = self.sender()
+        while connection.canReadLine():
+            line = bytes(connection.readLine()).decode('utf-8', 'replace')
+            try:
+                self._dispatch(*decode_event(line))
+            except (ProtocolError, ValueError, IndexError) as e:
+                logging.error(f"Invalid event from the instrument: {e}")
+
+    def _dispatch(self, kind, block, fields):
+        if kind == EVENT_STARTED:
+            self.program_started.emit(block, int(fields[0]))
+        elif kind == EVENT_POINT:
+            self.point_done.emit(block, int(fields[0]), float(fields[1]))
+        elif kind == EVENT_FAILED:
+            self.point_failed.emit(block, int(fields[0]), fields[1])
+        elif kind == EVENT_FINISHED:
+            self.program_finished.emit(block, float(fields[0]))
+        elif kind == EVENT_REJECTED:
+            self.program_rejected.emit(block, fields[0] if fields else '')
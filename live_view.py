@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Live view: frames from a watched snapshot folder or a camera are kept in a
+ring buffer and the cantilever is tracked from frame to frame, so drift
+between the launch snapshot and the experiment becomes visible.
+
+Frames are processed on a single worker thread. If a frame arrives while the
+previous one is still being tracked, the older pending frame is dropped, so
+the overlay never lags behind by more than one frame.
+"""
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+import cv2
+import PyQt5.QtCore as PyCore
+from calibration import load_image, PhaseCorrelator
+from calibration_watcher import is_jpeg_complete
+
+
+LIVE_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+class FrameRingBuffer:
+    # Keeps the last capacity frames in one preallocated array. Memory is
+    # allocated with the first frame and again only if the frame size changes.
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.frames = None
+        self.timestamps = np.zeros(capacity)
+        self.count = 0
+
+    def push(self, frame, timestamp):
+        if self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype:
+            self.frames = np.empty((self.capacity,) + frame.shape, frame.dtype)
+            self.count = 0
+        slot = self.count % self.capacity
+        self.frames[slot] = frame
+        self.timestamps[slot] = timestamp
+        self.count += 1
+        return self.frames[slot]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def latest(self, n=1):
+        # The n most recent frames, newest first
+        n = min(n, len(self))
+        slots = [(self.count - 1 - i) % self.capacity for i in range(n)]
+        return self.frames[slots], self.timestamps[slots]
+
+
+class CantileverTracker:
+    # Follows the cantilever tip through a sequence of frames. Each frame is
+    # registered against a key frame, starting with the reference snapshot.
+    # Once the cantilever has moved by more than rekey_distance pixels the
+    # current frame becomes the key frame, reusing its spectrum. Registering
+    # every frame against its direct predecessor would add up the sub-pixel
+    # bias of many tiny shifts instead.
+    # Frames are reduced by scale before tracking, the reported positions are
+    # in full resolution pixels.
+    def __init__(self, reference_image, tip_in_image, scale=1.0, rekey_distance=8.0):
+        self.scale = scale
+        self.rekey_distance = rekey_distance
+        self.key_tip = np.asarray(tip_in_image, dtype=float)
+        self.tip = self.key_tip
+        if reference_image.ndim == 3:
+            reference_image = cv2.cvtColor(reference_image, cv2.COLOR_BGR2GRAY)
+        self.correlator = PhaseCorrelator(self._resize(reference_image))
+
+    def _resize(self, frame):
+        if self.scale == 1.0:
+            return frame
+        return cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def track(self, frame):
+        shift = np.array(self.correlator.correlate(self._resize(frame)))
+        self.tip = self.key_tip + shift / self.scale
+        if np.hypot(*shift) > self.rekey_distance:
+            self.correlator.keep_as_reference()
+            self.key_tip = self.tip
+        return self.tip
+
+
+class LiveView(PyCore.QObject):
+    # Tracked tip position in image pixels and the time from the arrival of
+    # the frame to the result in seconds
+    tip_tracked = PyCore.pyqtSignal(float, float, float)
+    failed = PyCore.pyqtSignal(str)
+
+    def __init__(self, reference_image, tip_in_image, capacity=64, scale=1.0, parent=None):
+        super().__init__(parent)
+        self.buffer = FrameRingBuffer(capacity)
+        self.tracker = CantileverTracker(reference_image, tip_in_image, scale)
+        self.frame_size = reference_image.shape[:2]
+        self.max_latency = 0.0
+        self.dropped = 0
+        # Frames that could not be read or registered. The worker doesn't
+        # log per frame, log output shares stdout with the instructions, so
+        # these are only summarised when the live view stops.
+        self.unreadable = 0
+        self.tracking_errors = 0
+        self.last_error = None
+        self._pending = queue.Queue(maxsize=1)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, frame):
+        # frame is an image or the path of one, may be called from any thread
+        item = (frame, time.perf_counter())
+        try:
+            self._pending.put_nowait(item)
+        except queue.Full:
+            try:
+                self._pending.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self._pending.put_nowait(item)
+
+    def stop(self, timeout=1.0):
+        # Returns False if the frame in progress hasn't finished in time
+        self._running = False
+        try:
+            self._pending.put_nowait(None)
+        except queue.Full:
+            try:
+                self._pending.get_nowait()
+            except queue.Empty:
+                pass
+            self._pending.put_nowait(None)
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        while self._running:
+            item = self._pending.get()
+            if item is None or not self._running:
+                break
+            frame, arrival = item
+            if isinstance(frame, str):
+                path = frame
+                frame = load_image(path, grayscale=True)
+                if frame is None:
+                    self.unreadable += 1
+                    continue
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if frame.shape[:2] != self.frame_size:
+                self.failed.emit(f"Live frames of size {frame.shape[1]}x{frame.shape[0]} do not match the snapshot")
+                break
+            try:
+                tip = self.tracker.track(self.buffer.push(frame, arrival))
+            except cv2.error as e:
+                self.tracking_errors += 1
+                self.last_error = str(e)
+                continue
+            latency = time.perf_counter() - arrival
+            self.max_latency = max(self.max_latency, latency)
+            self.tip_tracked.emit(tip[0], tip[1], latency)
+
+
+class DirectoryFrameSource(PyCore.QObject):
+    # Hands the newest completely written image of a folder to the live view.
+    # Like the calibration watcher it listens for change events and polls as
+    # a fallback for network shares.
+    def __init__(self, folder, live_view, poll_interval=100, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.live_view = live_view
+        self._last = None
+        self._sizes = {}
+        self._fs_watcher = PyCore.QFileSystemWatcher(self)
+        self._fs_watcher.directoryChanged.connect(self.scan)
+        self._poll_timer = PyCore.QTimer(self)
+        self._poll_timer.timeout.connect(self.scan)
+        self._poll_interval = poll_interval
+
+    def start(self):
+        # Only frames written from now on are shown
+        self._last = self._newest()
+        self._fs_watcher.addPath(self.folder)
+        self._poll_timer.start(self._poll_interval)
+
+    def stop(self):
+        self._poll_timer.stop()
+        if self._fs_watcher.directories():
+            self._fs_watcher.removePaths(self._fs_watcher.directories())
+
+    def _newest(self):
+        # Path and modification time of the latest image, frames may be
+        # deleted by the instrument software while the folder is scanned
+        try:
+            entries = [(entry.stat().st_mtime_ns, entry.name, entry.path) for entry in os.scandir(self.folder)
+                       if entry.name.lower().endswith(LIVE_IMAGE_EXTENSIONS)]
+        except OSError:
+            return None
+        if not entries:
+            return None
+        mtime, _, path = max(entries)
+        return (path, mtime)
+
+    def scan(self, *args):
+        newest = self._newest()
+        if newest is None or newest == self._last:
+            return
+        path = newest[0]
+        if path.lower().endswith(('.jpg', '.jpeg')):
+            complete = is_jpeg_complete(path)
+        else:
+            # Wait until the size is stable between two scans
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            complete = self._sizes.get(path) == size
+            self._sizes = {path: size}
+        if complete:
+            self._last = newest
+            self.live_view.submit(path)
+
+
+class CaptureFrameSource:
+    # Reads frames from a local camera (or video file) with OpenCV on its own
+    # thread and hands every frame to the live view.
+    def __init__(self, device, live_view):
+        self.device = device
+        self.live_view = live_view
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        capture = cv2.VideoCapture(self.device)
+        if not capture.isOpened():
+            raise OSError(f"Could not open video source {self.device}")
+        self._running = True
+        self._thread = threading.Thread(target=self._run, args=(capture,), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, capture):
+        try:
+            while self._running:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                self.live_view.submit(frame)
+        finally:
+            capture.release()